@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Shared async API clients for OpenAI and Gemini.
+
+One AsyncOpenAI client (httpx connection pool with keep-alive) and one set
+of Gemini models (gRPC asyncio channel) are created per event loop and
+reused by every pipeline run in the process, so concurrent API stages
+overlap without worker threads and without a new TLS handshake per
+request. Clients are bound to the loop they were created on; a process
+that calls asyncio.run() several times gets a fresh pool for each loop.
+
+OPENAI_BASE_URL and GEMINI_API_ENDPOINT redirect the clients, e.g. to the
+local fake_api_server.py for load tests without network access; a Gemini
+endpoint on localhost is reached over a plaintext gRPC channel.
+"""
+
+import os
+import asyncio
+import logging
+import weakref
+
+import grpc
+import httpx
+import openai
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.ai import generativelanguage_v1beta as glm
+from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+    GenerativeServiceGrpcAsyncIOTransport,
+)
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+API_KEEPALIVE_SECONDS = float(os.getenv("API_KEEPALIVE_SECONDS", "120"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "600"))
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT") or None
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "[::1]")
+
+_openai_clients = weakref.WeakKeyDictionary() # event loop -> AsyncOpenAI
+_gemini_models = weakref.WeakKeyDictionary() # event loop -> {model_name: GenerativeModel}
+_gemini_async_clients = weakref.WeakKeyDictionary() # event loop -> GenerativeServiceAsyncClient
+
+# genai.configure() is process-wide; do it once and reuse it for every query
+_gemini_configured = False
+
+
+def get_openai_client():
+    """Returns the AsyncOpenAI client of the running event loop (created on first use)."""
+    loop = asyncio.get_running_loop()
+    client = _openai_clients.get(loop)
+    if client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise EnvironmentError("OPENAI_API_KEY not found in environment variables")
+        http_client = openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                keepalive_expiry=API_KEEPALIVE_SECONDS,
+            ),
+        )
+        client = openai.AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client,
+                                    timeout=OPENAI_TIMEOUT_SECONDS)
+        _openai_clients[loop] = client
+        logger.debug(f"Создан общий OpenAI клиент (до {OPENAI_MAX_CONNECTIONS} соединений, {client.base_url})")
+    return client
+
+
+def configure_gemini():
+    """Configure the Gemini client once per process. Returns True on success."""
+    global _gemini_configured
+    if _gemini_configured:
+        return True
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        logger.error("GEMINI_API_KEY not found in environment variables.")
+        return False
+    try:
+        if GEMINI_API_ENDPOINT:
+            genai.configure(api_key=api_key, client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+        else:
+            genai.configure(api_key=api_key)
+    except Exception as e:
+        logger.error(f"Error configuring Gemini API: {e}")
+        return False
+    _gemini_configured = True
+    return True
+
+
+def _is_local_endpoint(endpoint):
+    return endpoint.rsplit(":", 1)[0] in LOCAL_HOSTS
+
+
+def _make_gemini_async_client():
+    if GEMINI_API_ENDPOINT and _is_local_endpoint(GEMINI_API_ENDPOINT):
+        # The SDK always uses TLS; a local (fake) server only speaks plaintext gRPC
+        channel = grpc.aio.insecure_channel(GEMINI_API_ENDPOINT, options=[
+            ("grpc.max_send_message_length", -1),
+            ("grpc.max_receive_message_length", -1),
+        ])
+        transport = GenerativeServiceGrpcAsyncIOTransport(host=GEMINI_API_ENDPOINT, channel=channel)
+        return glm.GenerativeServiceAsyncClient(transport=transport)
+    return genai_client._client_manager.make_client("generative_async")
+
+
+def get_gemini_model(model_name):
+    """Returns a GenerativeModel for `model_name` whose async calls use the loop's shared channel."""
+    if not configure_gemini():
+        raise EnvironmentError("Gemini API is not configured")
+    loop = asyncio.get_running_loop()
+    models = _gemini_models.setdefault(loop, {})
+    model = models.get(model_name)
+    if model is None:
+        async_client = _gemini_async_clients.get(loop)
+        if async_client is None:
+            # The SDK caches one async client per process, but a gRPC asyncio
+            # channel only works on the loop it was created on. _client_manager
+            # and GenerativeModel._async_client are SDK internals: the version
+            # is pinned in requirements.txt, check them when upgrading
+            async_client = _make_gemini_async_client()
+            _gemini_async_clients[loop] = async_client
+        model = genai.GenerativeModel(model_name)
+        model._async_client = async_client
+        models[model_name] = model
+    return model
+
+
+async def close_api_clients():
+    """Closes the clients of the running event loop (call on shutdown)."""
+    loop = asyncio.get_running_loop()
+    client = _openai_clients.pop(loop, None)
+    if client is not None:
+        await client.close()
+    _gemini_models.pop(loop, None)
+    async_client = _gemini_async_clients.pop(loop, None)
+    if async_client is not None:
+        await async_client.transport.close()
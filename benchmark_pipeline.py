@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the analysis pipeline without network access.
+
+Runs run_pipeline over a corpus of screenshots (by default every image in
+tests/ and the tall crops in tests/report_images/) with the APIs either
+served by the in-process fake server (fake_api_server.py, `--api fake`) or
+replayed from the LLM response cache (`--api replay`, record it first with
+`--llm-cache record`).
+
+Writes a JSON report with:
+    - p50/p95/mean/max wall time of every stage and of the whole run;
+    - orchestration overhead (run time minus the critical path of stages);
+    - peak RSS of the process and of every run;
+    - artifact sizes per kind;
+    - throughput (images/minute) and the per-run raw numbers.
+
+`--baseline PREVIOUS.json` compares p95 stage times and peak RSS with an
+earlier report and exits with 1 if any got worse by more than
+`--max-regression`.
+
+Usage:
+    python benchmark_pipeline.py --repeat 3 --output bench.json
+    python benchmark_pipeline.py --gpt-latency lognormal:2:0.3 --concurrency 8 --baseline bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+# The benchmark never talks to the real APIs; the clients only need a key to start
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+import api_clients
+import fake_api_server
+from run_analysis_pipeline import (
+    run_pipeline_async, configure_pipeline_logging, PIPELINE_GRAPH, OUTPUTS_ROOT,
+)
+from run_batch_analysis import collect_images
+from llm_cache import llm_cache, MODE_OFF, MODE_REPLAY
+from stage_graph import RESOURCE_LLM, RESOURCE_CPU
+from pipeline_manifest import STATUS_OK
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS_DIR = os.path.join(OUTPUTS_ROOT, "benchmarks")
+DEFAULT_CORPUS = [
+    os.path.join(SCRIPT_DIR, "tests", "*.png"),
+    os.path.join(SCRIPT_DIR, "tests", "report_images"),
+]
+REPORT_VERSION = 1
+
+API_FAKE = "fake"
+API_REPLAY = "replay"
+
+
+class RSSSampler:
+    """Samples the resident set size of the process in a background thread."""
+
+    def __init__(self, interval_s=0.02):
+        self.interval_s = interval_s
+        self.samples = [] # (perf_counter, rss bytes)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def current_rss(self):
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except (OSError, ValueError, IndexError):
+            # No procfs (macOS): fall back to the peak so far
+            return peak_rss_bytes()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append((time.perf_counter(), self.current_rss()))
+            self._stop.wait(self.interval_s)
+
+    def peak_between(self, start, end):
+        values = [rss for t, rss in self.samples if start <= t <= end]
+        return max(values) if values else self.current_rss()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def peak_rss_bytes():
+    """Peak RSS of this process (ru_maxrss is in KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentiles(values):
+    """Summary statistics of a list of numbers (empty list -> count only)."""
+    if not values:
+        return {"count": 0}
+    data = np.asarray(values, dtype=float)
+    return {
+        "count": len(values),
+        "p50": round(float(np.percentile(data, 50)), 4),
+        "p95": round(float(np.percentile(data, 95)), 4),
+        "mean": round(float(data.mean()), 4),
+        "max": round(float(data.max()), 4),
+    }
+
+
+def critical_path_s(stage_durations):
+    """Longest chain of stage durations through PIPELINE_GRAPH."""
+    finish = {}
+    for name in PIPELINE_GRAPH.order:
+        stage = PIPELINE_GRAPH[name]
+        start = max((finish.get(dep, 0.0) for dep in stage.dependencies), default=0.0)
+        finish[name] = start + stage_durations.get(name, 0.0)
+    return max(finish.values(), default=0.0)
+
+
+def describe_corpus(image_paths):
+    corpus = []
+    for path in image_paths:
+        with Image.open(path) as img:
+            width, height = img.size
+        corpus.append({"image": os.path.relpath(path, SCRIPT_DIR), "width": width, "height": height,
+                       "bytes": os.path.getsize(path)})
+    return corpus
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def benchmark_runs(image_paths, repeat, warmup, concurrency, work_dir, sampler):
+    """Runs the pipeline over the corpus; returns the per-run records and the measured wall time."""
+    limits = {RESOURCE_LLM: asyncio.Semaphore(max(1, concurrency)),
+              RESOURCE_CPU: asyncio.Semaphore(max(1, min(concurrency, os.cpu_count() or 1)))}
+    active = asyncio.Semaphore(max(1, concurrency))
+
+    for path in image_paths[:warmup]:
+        # Imports, font caches and connection setup are not part of the numbers
+        await run_pipeline_async(path, output_root=work_dir, use_cache=False)
+
+    async def measure(path, iteration):
+        async with active:
+            started = time.perf_counter()
+            result = await run_pipeline_async(path, output_root=work_dir, use_cache=False, limits=limits)
+            ended = time.perf_counter()
+        stages = {stage.name: stage.duration_s for stage in result.stages if stage.status == STATUS_OK}
+        return {
+            "image": os.path.relpath(path, SCRIPT_DIR),
+            "iteration": iteration,
+            "success": result.success,
+            "duration_s": round(ended - started, 4),
+            "overhead_s": round(max(0.0, (ended - started) - critical_path_s(stages)), 4),
+            "peak_rss_mb": round(sampler.peak_between(started, ended) / 2**20, 1),
+            "stages": {stage.name: {"status": stage.status, "duration_s": stage.duration_s} for stage in result.stages},
+            "artifact_bytes": {kind: os.path.getsize(p) for kind, p in result.artifacts.items() if p and os.path.exists(p)},
+            "errors": result.errors,
+        }
+
+    started = time.perf_counter()
+    runs = await asyncio.gather(*(measure(path, i) for i in range(repeat) for path in image_paths))
+    return runs, time.perf_counter() - started
+
+
+def summarize(runs, wall_s):
+    stage_names = PIPELINE_GRAPH.order
+    artifact_kinds = sorted({kind for run in runs for kind in run["artifact_bytes"]})
+    succeeded = sum(1 for run in runs if run["success"])
+    return {
+        "runs": len(runs),
+        "succeeded": succeeded,
+        "failed": len(runs) - succeeded,
+        "wall_time_s": round(wall_s, 3),
+        "images_per_minute": round(len(runs) / wall_s * 60, 2) if wall_s > 0 else 0.0,
+        "peak_rss_mb": round(peak_rss_bytes() / 2**20, 1),
+        "run_s": percentiles([run["duration_s"] for run in runs]),
+        "overhead_s": percentiles([run["overhead_s"] for run in runs]),
+        "run_peak_rss_mb": percentiles([run["peak_rss_mb"] for run in runs]),
+        "stages_s": {
+            name: dict(
+                percentiles([run["stages"][name]["duration_s"] for run in runs
+                             if run["stages"].get(name, {}).get("status") == STATUS_OK]),
+                failed=sum(1 for run in runs if run["stages"].get(name, {}).get("status") not in (None, STATUS_OK)),
+            )
+            for name in stage_names
+        },
+        "artifact_bytes": {
+            kind: percentiles([run["artifact_bytes"][kind] for run in runs if kind in run["artifact_bytes"]])
+            for kind in artifact_kinds
+        },
+    }
+
+
+def compare_with_baseline(summary, baseline, max_regression):
+    """Returns human readable regressions of p95 stage/run times and peak RSS."""
+    regressions = []
+    base = baseline.get("summary", {})
+
+    def check(label, current, previous):
+        if current is None or not previous:
+            return
+        if current > previous * (1 + max_regression):
+            regressions.append(f"{label}: {previous} -> {current} (+{(current / previous - 1) * 100:.0f}%)")
+
+    for name, stats in summary["stages_s"].items():
+        check(f"{name} p95 s", stats.get("p95"), base.get("stages_s", {}).get(name, {}).get("p95"))
+    check("run p95 s", summary["run_s"].get("p95"), base.get("run_s", {}).get("p95"))
+    check("overhead p95 s", summary["overhead_s"].get("p95"), base.get("overhead_s", {}).get("p95"))
+    check("peak RSS MB", summary["peak_rss_mb"], base.get("peak_rss_mb"))
+    return regressions
+
+
+async def run_benchmark(args, image_paths, work_dir):
+    server = None
+    if args.api == API_FAKE:
+        gpt_faults, gemini_faults = fake_api_server.fault_profiles_from_args(args)
+        server = fake_api_server.FakeAPIServer(http_port=0, grpc_port=0,
+                                               gpt_faults=gpt_faults, gemini_faults=gemini_faults)
+        await server.start()
+        # Read by the clients when they are first created on this loop
+        api_clients.OPENAI_BASE_URL = server.openai_base_url
+        api_clients.GEMINI_API_ENDPOINT = server.gemini_endpoint
+    try:
+        with RSSSampler() as sampler:
+            runs, wall_s = await benchmark_runs(image_paths, args.repeat, args.warmup, args.concurrency,
+                                                work_dir, sampler)
+    finally:
+        await api_clients.close_api_clients()
+        if server is not None:
+            await server.stop()
+    return runs, wall_s, dict(server.stats) if server else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline against fake or replayed APIs.")
+    parser.add_argument("inputs", nargs="*", help="Images, directories or globs. Default: tests/*.png and tests/report_images/.")
+    parser.add_argument("--api", choices=(API_FAKE, API_REPLAY), default=API_FAKE,
+                        help="fake: in-process fake API server; replay: LLM cache in replay mode.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per image.")
+    parser.add_argument("--warmup", type=int, default=1, help="Images run once before measuring.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Images in flight at once.")
+    parser.add_argument("--output", help=f"Report path. Default: {BENCHMARKS_DIR}/benchmark_<timestamp>.json")
+    parser.add_argument("--keep-runs", action="store_true", help="Keep the run directories of the benchmark.")
+    parser.add_argument("--baseline", help="Earlier report to compare with; exit code 1 on regression.")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Allowed relative growth of p95 times and peak RSS against the baseline (default 0.2).")
+    parser.add_argument("--log-level", default="WARNING", help="Log level of the pipeline output.")
+    fake_api_server.add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=args.log_level.upper())
+    configure_pipeline_logging(args.log_level.upper())
+    logger.setLevel(logging.INFO)
+    llm_cache.mode = MODE_REPLAY if args.api == API_REPLAY else MODE_OFF
+
+    image_paths = collect_images(args.inputs or DEFAULT_CORPUS)
+    if not image_paths:
+        logger.error("Не найдено ни одного изображения")
+        sys.exit(1)
+
+    os.makedirs(BENCHMARKS_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="runs_", dir=BENCHMARKS_DIR)
+    logger.info(f"Бенчмарк: {len(image_paths)} изображений x {args.repeat}, API: {args.api}")
+    try:
+        runs, wall_s, server_stats = asyncio.run(run_benchmark(args, image_paths, work_dir))
+    finally:
+        if not args.keep_runs:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarize(runs, wall_s)
+    report = {
+        "report_version": REPORT_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("inputs", "output", "baseline")},
+        "corpus": describe_corpus(image_paths),
+        "api_stats": server_stats,
+        "summary": summary,
+        "runs": runs,
+    }
+    output_path = args.output or os.path.join(BENCHMARKS_DIR, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\nПрогонов: {summary['runs']} ({summary['failed']} с ошибками), "
+          f"{summary['images_per_minute']:.1f} изображений/мин, пик RSS {summary['peak_rss_mb']} МБ")
+    for name, stats in summary["stages_s"].items():
+        if stats["count"]:
+            print(f"    {name}: p50 {stats['p50']:.3f} с, p95 {stats['p95']:.3f} с")
+    print(f"    overhead: p50 {summary['overhead_s'].get('p50', 0):.3f} с, p95 {summary['overhead_s'].get('p95', 0):.3f} с")
+    if server_stats:
+        # Which request paths of the fake API were exercised (gemini_detection, gemini_crop, ...)
+        print("    API: " + ", ".join(f"{name} {count}" for name, count in sorted(server_stats.items())))
+    print(f"Отчет: {output_path}")
+
+    exit_code = 0 if summary["failed"] == 0 else 1
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(summary, json.load(f), args.max_regression)
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}")
+        if regressions:
+            exit_code = 1
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
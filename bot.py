@@ -1,18 +1,21 @@
 # redeploy trigger: cosmetic bump
 import os
 import logging
-import subprocess
 import tempfile
-import re
 import shutil
-import asyncio
-import sys
 import mimetypes
 import telegram
 from telegram import Update, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 import json
+from run_analysis_pipeline import run_pipeline_async, format_summary, configure_pipeline_logging, OUTPUTS_ROOT
+from pipeline_manifest import (
+    ARTIFACT_REPORT_PDF, ARTIFACT_REPORT_TEX, ARTIFACT_HEATMAP, ARTIFACT_HEATMAP_PREVIEW,
+    ARTIFACT_INTERPRETATION, ARTIFACT_RECOMMENDATIONS,
+)
+from job_queue import AnalysisJobQueue, QueueFullError, ChatJobLimitError
+from api_clients import close_api_clients
 
 # Загрузка переменных окружения (токен бота)
 load_dotenv()
@@ -23,11 +26,11 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logging.getLogger("httpx").setLevel(logging.WARNING) # Уменьшаем шум от библиотеки httpx
+configure_pipeline_logging() # Уровень логов пайплайна задается PIPELINE_LOG_LEVEL
 logger = logging.getLogger(__name__)
 
-# --- Define script path relative to bot.py ---
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-PIPELINE_SCRIPT_PATH = os.path.join(SCRIPT_DIR, 'run_analysis_pipeline.py')
+# Очередь задач анализа: ограничивает число одновременных пайплайнов (см. job_queue.py)
+job_queue = AnalysisJobQueue()
 
 # --- Обработчики команд ---
 
@@ -47,13 +50,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "1. Отправь мне изображение (скриншот) интерфейса, который нужно проанализировать (как фото или как файл).\n"
         "2. Я запущу полный пайплайн анализа (GPT-4, Gemini Coordinates, Heatmap, Report).\n"
         "3. В ответ я пришлю PDF-отчет и тепловую карту.\n\n"
-        "Пожалуйста, отправляй только одно изображение за раз."
+        f"Одновременно обрабатывается до {job_queue.max_concurrent_jobs} изображений, "
+        f"остальные ждут в очереди. От одного чата принимается не больше "
+        f"{job_queue.max_jobs_per_chat} изображений одновременно."
     )
 
 # --- Обработчик изображений ---
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает полученное изображение (фото или документ), запускает анализ и отправляет результаты."""
+    """Принимает изображение (фото или документ) и ставит его анализ в очередь."""
     message = update.message
     chat_id = update.effective_chat.id
     file_to_get = None
@@ -65,7 +70,7 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if photo:
         # Process photo
-        await message.reply_text("Фото получено. Начинаю анализ... Это может занять несколько минут ⏳")
+        received_text = "Фото получено."
         try:
             file_to_get = await message.photo[-1].get_file()
             file_unique_id = file_to_get.file_unique_id
@@ -75,7 +80,7 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     elif document and document.mime_type and document.mime_type.startswith('image/'):
         # Process document image
-        await message.reply_text("Изображение (как документ) получено. Начинаю анализ... Это может занять несколько минут ⏳")
+        received_text = "Изображение (как документ) получено."
         try:
             file_to_get = await document.get_file()
             file_unique_id = file_to_get.file_unique_id
@@ -89,6 +94,35 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await message.reply_text("Пожалуйста, отправь изображение (как фото или как файл изображения).")
         return
 
+    async def job():
+        await process_image(message, context, chat_id, file_to_get, file_unique_id, file_extension)
+
+    async def on_start():
+        if jobs_ahead > 0:
+            await message.reply_text("Подошла ваша очередь. Начинаю анализ... ⏳")
+
+    try:
+        jobs_ahead = job_queue.submit(chat_id, job, on_start=on_start)
+    except ChatJobLimitError:
+        await message.reply_text(
+            f"У вас уже {job_queue.max_jobs_per_chat} изображения в обработке. "
+            "Дождитесь результатов и отправьте следующее."
+        )
+        return
+    except QueueFullError:
+        await message.reply_text("Сейчас слишком много запросов. Попробуйте отправить изображение чуть позже.")
+        return
+
+    if jobs_ahead == 0:
+        await message.reply_text(f"{received_text} Начинаю анализ... Это может занять несколько минут ⏳")
+    else:
+        await message.reply_text(
+            f"{received_text} Ваше место в очереди: {jobs_ahead + 1}. "
+            "Я напишу, когда начну анализ ⏳"
+        )
+
+async def process_image(message, context: ContextTypes.DEFAULT_TYPE, chat_id, file_to_get, file_unique_id, file_extension):
+    """Скачивает изображение, запускает анализ и отправляет результаты. Выполняется воркером очереди."""
     # Создаем временную директорию для изображения
     with tempfile.TemporaryDirectory() as temp_dir:
         # Use unique ID and determined extension for filename
@@ -102,41 +136,20 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_text("Произошла ошибка при сохранении изображения. Попробуйте еще раз.")
             return
 
-        # Запускаем пайплайн анализа
+        # Запускаем пайплайн анализа (в этом же процессе)
         try:
-            # Check if pipeline script exists
-            if not os.path.exists(PIPELINE_SCRIPT_PATH):
-                logger.error(f"Скрипт анализа не найден по пути: {PIPELINE_SCRIPT_PATH}")
-                await message.reply_text("Критическая ошибка: не найден скрипт анализа на сервере.")
-                return
-
-            logger.info(f"Запуск {PIPELINE_SCRIPT_PATH} для {image_path}")
-            process = await asyncio.create_subprocess_exec(
-                sys.executable, # Используем тот же python, что и для бота
-                PIPELINE_SCRIPT_PATH, # Use the absolute path
-                image_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                # Set working directory to the script's directory? Maybe not needed if paths inside pipeline are ok.
-                # cwd=SCRIPT_DIR
-            )
-            stdout, stderr = await process.communicate()
-            stdout_str = stdout.decode('utf-8', errors='ignore')
-            stderr_str = stderr.decode('utf-8', errors='ignore')
-
-            logger.info(f"{PIPELINE_SCRIPT_PATH} завершился с кодом {process.returncode}")
-            # Treat pipelines that generated a LaTeX or PDF report as success, even if return code is non-zero
-            # Override return code if summary indicates success
-            if "✅ PDF Отчет:" in stdout_str or "✅ LaTeX Отчет" in stdout_str:
-                return_code = 0
-            else:
-                return_code = process.returncode
-            if return_code != 0:
-                logger.error(f"Ошибка выполнения {PIPELINE_SCRIPT_PATH}:\nstdout:\n{stdout_str}\nstderr:\n{stderr_str}")
+            logger.info(f"Запуск пайплайна анализа для {image_path}")
+            result = await run_pipeline_async(image_path)
+            logger.info(format_summary(result))
+            logger.info(f"Пайплайн завершился, success={result.success}")
+
+            # Treat pipelines that generated a LaTeX or PDF report as success
+            if not result.success:
+                logger.error(f"Ошибка выполнения пайплайна:\n{result.error_text}")
                 error_message = "Произошла ошибка во время анализа."
-                # Send stderr as plain text
-                if stderr_str:
-                    error_message += f"\n\nДетали ошибки (raw):\n```\n...{stderr_str[-700:]}\n```"
+                # Send error details as plain text
+                if result.errors:
+                    error_message += f"\n\nДетали ошибки (raw):\n```\n...{result.error_text[-700:]}\n```"
                 
                 try:
                     await message.reply_text(error_message) # Send plain text error
@@ -145,32 +158,20 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Continue to send attachments even if pipeline returned an error
                 # (do not return here)
 
-            logger.info(f"stdout {PIPELINE_SCRIPT_PATH}:\n{stdout_str}") # Log received stdout
-            if stderr_str: # Логируем stderr даже при успешном выполнении
-                logger.warning(f"stderr {PIPELINE_SCRIPT_PATH} (при коде 0):\n{stderr_str}")
-
-            # Извлекаем пути к результатам из stdout
-            logger.info("Parsing pipeline stdout for result paths...")
-            pdf_path_match = re.search(r"✅ PDF Отчет: (.*\.pdf)", stdout_str)
-            heatmap_path_match = re.search(r"✅ Тепловая карта: (.*\.png)", stdout_str)
-            interp_match = re.search(r"✅ Файл интерпретации: (.*\.json)", stdout_str)
-            rec_match = re.search(r"✅ Файл рекомендаций: (.*\.json)", stdout_str)
-            tex_match = re.search(r"✅ LaTeX Отчет.*: (.*\.tex)", stdout_str)
-
-            pdf_path = pdf_path_match.group(1).strip() if pdf_path_match else None
-            heatmap_path = heatmap_path_match.group(1).strip() if heatmap_path_match else None
-            interp_path = interp_match.group(1).strip() if interp_match else None
-            rec_path = rec_match.group(1).strip() if rec_match else None
-            tex_path = tex_match.group(1).strip() if tex_match else None
-            output_dir_match = re.search(r"Результаты будут сохранены в: (?:\./)?(analysis_outputs/run_\d{8}_\d{6})", stdout_str)
-            output_dir = output_dir_match.group(1).strip() if output_dir_match else None # Group 1 is the analysis_outputs/... part
-
-            logger.info(f"  Parsed PDF path: {pdf_path}")
-            logger.info(f"  Parsed Heatmap path: {heatmap_path}")
-            logger.info(f"  Parsed Interpretation path: {interp_path}")
-            logger.info(f"  Parsed Recommendations path: {rec_path}")
-            logger.info(f"  Parsed Fallback TeX path: {tex_path}")
-            logger.info(f"  Parsed Output dir for cleanup: {output_dir}")
+            pdf_path = result.artifact(ARTIFACT_REPORT_PDF)
+            heatmap_path = result.artifact(ARTIFACT_HEATMAP)
+            heatmap_preview_path = result.artifact(ARTIFACT_HEATMAP_PREVIEW)
+            interp_path = result.artifact(ARTIFACT_INTERPRETATION)
+            rec_path = result.artifact(ARTIFACT_RECOMMENDATIONS)
+            tex_path = result.artifact(ARTIFACT_REPORT_TEX)
+            output_dir = result.run_dir
+
+            logger.info(f"  PDF path: {pdf_path}")
+            logger.info(f"  Heatmap path: {heatmap_path}")
+            logger.info(f"  Interpretation path: {interp_path}")
+            logger.info(f"  Recommendations path: {rec_path}")
+            logger.info(f"  Fallback TeX path: {tex_path}")
+            logger.info(f"  Output dir for cleanup: {output_dir}")
 
             # Отправляем результаты
             await message.reply_text("Анализ завершен! Отправляю результаты...")
@@ -192,9 +193,20 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         except Exception as reply_e:
                              logger.error(f"Failed to send error reply for PDF: {reply_e}")
                 else:
-                    logger.warning(f"PDF file path found in stdout, but file does not exist at: {pdf_path}")
+                    logger.warning(f"PDF file path reported by pipeline, but file does not exist at: {pdf_path}")
             else:
-                logger.info("No PDF path found in stdout.")
+                logger.info("No PDF path reported by pipeline.")
+
+            # --- Sending Heatmap preview (inline photo, sized for Telegram) ---
+            if heatmap_preview_path:
+                try:
+                    logger.info(f"Attempting to send Heatmap preview as photo: {heatmap_preview_path}")
+                    with open(heatmap_preview_path, "rb") as photo:
+                        await context.bot.send_photo(chat_id=chat_id, photo=photo, caption="Тепловая карта проблемных зон")
+                    results_sent = True
+                except Exception as e:
+                    # Very long pages exceed Telegram's aspect ratio limit; the full file is sent below anyway
+                    logger.warning(f"Не удалось отправить превью тепловой карты {heatmap_preview_path}: {e}")
 
             # --- Sending Heatmap --- 
             if heatmap_path:
@@ -214,9 +226,9 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         except Exception as reply_e:
                              logger.error(f"Failed to send error reply for Heatmap: {reply_e}")
                 else:
-                    logger.warning(f"Heatmap file path found in stdout, but file does not exist at: {heatmap_path}")
+                    logger.warning(f"Heatmap file path reported by pipeline, but file does not exist at: {heatmap_path}")
             else:
-                logger.info("No Heatmap path found in stdout.")
+                logger.info("No Heatmap path reported by pipeline.")
 
             # --- Sending Interpretation JSON file --- 
             if interp_path:
@@ -234,9 +246,9 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         except Exception as reply_e:
                              logger.error(f"Failed to send error reply for Interpretation JSON: {reply_e}")
                 else:
-                    logger.warning(f"Interpretation JSON path found in stdout, but file does not exist at: {interp_path}")
+                    logger.warning(f"Interpretation JSON path reported by pipeline, but file does not exist at: {interp_path}")
             else:
-                logger.info("No Interpretation JSON path found in stdout.")
+                logger.info("No Interpretation JSON path reported by pipeline.")
 
             # --- Sending Recommendations JSON file --- 
             if rec_path:
@@ -254,12 +266,12 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         except Exception as reply_e:
                              logger.error(f"Failed to send error reply for Recommendations JSON: {reply_e}")
                 else:
-                    logger.warning(f"Recommendations JSON path found in stdout, but file does not exist at: {rec_path}")
+                    logger.warning(f"Recommendations JSON path reported by pipeline, but file does not exist at: {rec_path}")
             else:
-                logger.info("No Recommendations JSON path found in stdout.")
+                logger.info("No Recommendations JSON path reported by pipeline.")
 
             # --- Fallback Sending TeX file --- 
-            if not pdf_path_match: # Only if PDF path wasn't found or didn't exist
+            if not pdf_path: # Only if PDF wasn't generated
                 logger.info("PDF path missing or file not found, attempting fallback to TeX file.")
                 if tex_path:
                     logger.info(f"Checking existence of Fallback TeX: {tex_path}")
@@ -276,9 +288,9 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             except Exception as reply_e:
                                  logger.error(f"Failed to send error reply for Fallback TeX: {reply_e}")
                     else:
-                        logger.warning(f"Fallback TeX path found in stdout, but file does not exist at: {tex_path}")
+                        logger.warning(f"Fallback TeX path reported by pipeline, but file does not exist at: {tex_path}")
                 else:
-                    logger.info("No Fallback TeX path found in stdout.")
+                    logger.info("No Fallback TeX path reported by pipeline.")
 
             # --- Sending Interpretation Text --- 
             if interp_path:
@@ -301,9 +313,9 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     except Exception as e:
                         logger.error(f"Не удалось отправить текст интерпретации {interp_path}: {e}")
                 else:
-                    logger.warning(f"Interpretation JSON path found in stdout, but file does not exist at: {interp_path} (for text sending)")
+                    logger.warning(f"Interpretation JSON path reported by pipeline, but file does not exist at: {interp_path} (for text sending)")
             else:
-                logger.info("No Interpretation JSON path found in stdout (for text sending).")
+                logger.info("No Interpretation JSON path reported by pipeline (for text sending).")
 
             # --- Sending Recommendations Text --- 
             if rec_path:
@@ -323,9 +335,9 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     except Exception as e:
                         logger.error(f"Не удалось отправить текст рекомендаций {rec_path}: {e}")
                 else:
-                    logger.warning(f"Recommendations JSON path found in stdout, but file does not exist at: {rec_path} (for text sending)")
+                    logger.warning(f"Recommendations JSON path reported by pipeline, but file does not exist at: {rec_path} (for text sending)")
             else:
-                logger.info("No Recommendations JSON path found in stdout (for text sending).")
+                logger.info("No Recommendations JSON path reported by pipeline (for text sending).")
 
             if not results_sent:
                 # If after all attempts nothing was sent, inform the user
@@ -333,10 +345,8 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await message.reply_text("Не удалось найти или отправить файлы результатов после анализа.")
 
             # Очистка: удаляем папку с результатами
-            if output_dir and os.path.exists(output_dir) and output_dir.startswith("analysis_outputs/"):
+            if output_dir and os.path.exists(output_dir) and os.path.dirname(os.path.abspath(output_dir)) == OUTPUTS_ROOT:
                 try:
-                    # Use absolute path for safety? Though relative should work if bot CWD is /app
-                    # output_dir_abs = os.path.join(SCRIPT_DIR, output_dir) # If needed
                     shutil.rmtree(output_dir)
                     logger.info(f"Удалена директория с результатами: {output_dir}")
                 except Exception as e:
@@ -345,7 +355,7 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.warning(f"Директория для удаления не найдена или небезопасна: {output_dir}")
 
         except Exception as e:
-            logger.exception("Неожиданная ошибка в handle_image")
+            logger.exception("Неожиданная ошибка в process_image")
             await message.reply_text("Произошла неожиданная ошибка во время обработки вашего запроса.")
 
 # --- Обработчик ошибок ---
@@ -355,6 +365,17 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
     # No need to check for Markdown error here anymore, as we send plain text
 
+# --- Жизненный цикл очереди ---
+
+async def start_job_queue(application: Application):
+    """Запускает воркеры очереди после инициализации приложения."""
+    job_queue.start()
+
+async def stop_job_queue(application: Application):
+    """Останавливает воркеры очереди и закрывает соединения с API при завершении работы."""
+    await job_queue.stop()
+    await close_api_clients()
+
 # --- Основная функция ---
 
 def main():
@@ -364,7 +385,13 @@ def main():
         return
 
     # Создание приложения и передача токена
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(start_job_queue)
+        .post_shutdown(stop_job_queue)
+        .build()
+    )
 
     # Регистрация обработчиков
     application.add_handler(CommandHandler("start", start))
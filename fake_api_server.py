@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI and Gemini APIs, for offline load testing.
+
+Implements the subset of the APIs the pipeline uses:
+    - OpenAI chat completions with a forced tool call
+      (POST /v1/chat/completions), as called by api_test.run_gpt_analysis,
+      also streamed as server-sent events (GPT_STREAMING);
+    - Gemini GenerativeService.GenerateContent over gRPC, as called by the
+      google.generativeai SDK (api_test.run_gemini_coordinates,
+      get_gemini_recommendations.query_gemini), plus the equivalent REST
+      route POST /v1beta/models/{model}:generateContent.
+
+Responses are canned from the coordinates fixture
+(tests/gemini_response_raw.json) and routed on the prompt: coordinate
+requests get the boxes of the ids they list, detection requests the
+fixture boxes as detected elements, and tile or crop requests
+(gemini_localization section and crop notes) those boxes relative to the
+part of the page they show. Text-only requests get
+tests/recommendations_output.json, and GPT gets an analysis whose problem
+area ids match the fixture. stats counts the requests per route
+(gemini_coords, gemini_detection, gemini_tile, gemini_crop, gemini_text).
+Latency, error rates and 429s (RESOURCE_EXHAUSTED over gRPC) are
+injectable per API.
+
+Point the pipeline at it with:
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+    GEMINI_API_ENDPOINT=127.0.0.1:8766
+
+Usage:
+    python fake_api_server.py --gpt-latency lognormal:20:0.3 --gemini-latency uniform:5:15 --rate-limit-rate 0.05
+"""
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+from collections import Counter
+
+import grpc
+from aiohttp import web
+from google.ai import generativelanguage_v1beta as glm
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_COORDS_RESPONSE = os.path.join(SCRIPT_DIR, "tests", "gemini_response_raw.json")
+DEFAULT_TEXT_RESPONSE = os.path.join(SCRIPT_DIR, "tests", "recommendations_output.json")
+
+GEMINI_SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+# Prompts of gemini_localization: detection, and the notes of tiles and crops (percent of the page)
+DETECTION_PROMPT_MARK = "detects user interface elements"
+SECTION_NOTE_PATTERN = re.compile(r"section \d+ of \d+ of a tall page.*?from (\d+)% to (\d+)% of the page height", re.S)
+CROP_NOTE_PATTERN = re.compile(
+    r"crop of a page screenshot.*?from (\d+)% to (\d+)% of the page width and from (\d+)% to (\d+)% of the page height",
+    re.S)
+PROBLEM_ID_PATTERN = re.compile(r"^- ID: ([^,]+),", re.M)
+# Streamed completions: pieces of the response, and the share of the latency before the first one
+STREAM_PIECES = 60
+STREAM_FIRST_PIECE_SHARE = 0.1
+
+# Category names as written by GPT (see generate_report_v2.determine_category)
+CATEGORIES = [
+    ("structuralVisualOrganization", "Structural Visual Organization",
+     ["gridStructure", "elementDensity", "whiteSpace", "colorEntropy", "visualSymmetry", "statisticalAnalysis"]),
+    ("visualPerceptualComplexity", "Visual Perceptual Complexity",
+     ["edgeDensity", "colorComplexity", "visualSaliency", "textureComplexity", "perceptualContrast"]),
+    ("typographicComplexity", "Typographic Complexity",
+     ["fontDiversity", "textScaling", "textDensity", "textAlignment", "textHierarchy", "readability"]),
+    ("informationLoad", "Information Load",
+     ["informationDensity", "informationStructure", "informationNoise", "informationRelevance",
+      "informationProcessingComplexity"]),
+    ("cognitiveLoad", "Cognitive Load",
+     ["intrinsicLoad", "extrinsicLoad", "germaneCognitiveLoad", "workingMemoryLoad"]),
+    ("operationalComplexity", "Operational Complexity",
+     ["decisionComplexity", "physicalComplexity", "operationalSequence", "interactionEfficiency",
+      "feedbackVisibility"]),
+]
+
+
+class LatencyModel:
+    """Response delay distribution, parsed from "<kind>:<a>[:<b>]" (seconds).
+
+    fixed:A, uniform:A:B, normal:MEAN:STD (clipped at 0), lognormal:MEDIAN:SIGMA.
+    """
+
+    def __init__(self, spec="fixed:0"):
+        self.spec = spec
+        kind, *params = spec.split(":")
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(self.params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec '{spec}'")
+
+    def sample(self, rng):
+        a, *rest = self.params
+        if self.kind == "fixed":
+            return a
+        if self.kind == "uniform":
+            return rng.uniform(a, rest[0])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(a, rest[0]))
+        return a * rng.lognormvariate(0.0, rest[0])
+
+
+class FaultProfile:
+    """Latency and failure injection for one API."""
+
+    def __init__(self, latency="fixed:0", error_rate=0.0, rate_limit_rate=0.0, rng=None):
+        self.latency = LatencyModel(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = rng or random.Random()
+
+    async def outcome(self):
+        """Waits for the sampled latency and returns "ok", "error" or "rate_limited"."""
+        await asyncio.sleep(self.latency.sample(self.rng))
+        return self.roll()
+
+    def roll(self):
+        """"ok", "error" or "rate_limited", without waiting."""
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            return "rate_limited"
+        if roll < self.rate_limit_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+
+def build_gpt_analysis(coordinates_data):
+    """Builds a schema-valid GPT analysis whose problem areas match the coordinates fixture."""
+    problem_areas = []
+    for i, element in enumerate(coordinates_data.get("element_coordinates", [])):
+        coords = element.get("coordinates") or [500, 0, 500, 1000]
+        vertical = "top" if coords[0] < 333 else "middle" if coords[0] < 666 else "bottom"
+        category = CATEGORIES[i % len(CATEGORIES)][1]
+        problem_areas.append({
+            "id": element["id"],
+            "category": category,
+            "subcategory": element.get("element", "Element"),
+            "description": f"{element.get('element', 'Element')} increases the visual complexity of the page.",
+            "location": f"{vertical} of the page",
+            "severity": 30 + (i * 37) % 70,
+            "scientificReasoning": "Dense, competing elements increase extraneous cognitive load (Sweller, 1988).",
+        })
+    complexity_scores = {"overall": 62}
+    for key, name, components in CATEGORIES:
+        complexity_scores[key] = {
+            "score": 60,
+            "components": {component: 55 for component in components},
+            "reasoning": f"Canned reasoning for {name}.",
+            "componentReasonings": {component: f"Canned reasoning for {component}." for component in components},
+        }
+    return {
+        "metaInfo": {
+            "interfaceType": "Canned test interface",
+            "userScenarios": ["Canned scenario"],
+            "overallComplexityScore": 62,
+            "analysisTimestamp": "2025-01-01T00:00:00",
+        },
+        "complexityScores": complexity_scores,
+        "problemAreas": problem_areas,
+    }
+
+
+class CannedResponses:
+    """Texts returned by the fake APIs."""
+
+    def __init__(self, coords_path=DEFAULT_COORDS_RESPONSE, text_path=DEFAULT_TEXT_RESPONSE, gpt_path=None):
+        with open(coords_path, "r", encoding="utf-8") as f:
+            self.gemini_coords_text = f.read()
+        self.gemini_elements = json.loads(self.gemini_coords_text).get("element_coordinates", [])
+        with open(text_path, "r", encoding="utf-8") as f:
+            self.gemini_text = f.read()
+        if gpt_path:
+            with open(gpt_path, "r", encoding="utf-8") as f:
+                self.gpt_arguments = f.read()
+        else:
+            self.gpt_arguments = json.dumps(build_gpt_analysis(json.loads(self.gemini_coords_text)), ensure_ascii=False)
+
+
+def region_of_prompt(prompt):
+    """("tile" | "crop" | None, (top, left, bottom, right) in 0-1000 of the page) named by a prompt's note."""
+    match = CROP_NOTE_PATTERN.search(prompt)
+    if match:
+        left, right, top, bottom = (int(value) * 10 for value in match.groups())
+        return "crop", (top, left, bottom, right)
+    match = SECTION_NOTE_PATTERN.search(prompt)
+    if match:
+        top, bottom = (int(value) * 10 for value in match.groups())
+        return "tile", (top, 0, bottom, 1000)
+    return None, (0, 0, 1000, 1000)
+
+
+def to_region(coordinates, region):
+    """A page box (0-1000) clipped to the region and in 0-1000 of it; None if outside."""
+    top, left, bottom, right = region
+    y_min, x_min, y_max, x_max = coordinates
+    y_min, y_max = max(y_min, top), min(y_max, bottom)
+    x_min, x_max = max(x_min, left), min(x_max, right)
+    if y_min >= y_max or x_min >= x_max:
+        return None
+
+    def scale(value, start, end):
+        return round((value - start) / (end - start) * 1000)
+    return [scale(y_min, top, bottom), scale(x_min, left, right), scale(y_max, top, bottom), scale(x_max, left, right)]
+
+
+def gemini_boxes(elements, prompt):
+    """(route, response text) for an image request, from the fixture elements (boxes in 0-1000 of the page)."""
+    kind, region = region_of_prompt(prompt)
+    if DETECTION_PROMPT_MARK in prompt:
+        route = "detection"
+        elements = [{"id": f"e{i + 1}", "element": element.get("element"), "text": "",
+                     "coordinates": element.get("coordinates"), "confidence": element.get("confidence", 0.8)}
+                    for i, element in enumerate(elements)]
+    else:
+        route = kind or "coords"
+        wanted = {value.strip() for value in PROBLEM_ID_PATTERN.findall(prompt)}
+        if wanted:
+            elements = [element for element in elements if str(element.get("id")) in wanted]
+    boxes = []
+    for element in elements:
+        coordinates = element.get("coordinates")
+        if coordinates is not None:
+            coordinates = to_region(coordinates, region)
+        if coordinates is None and kind == "tile":
+            continue # A section lists only the elements it shows
+        boxes.append(dict(element, coordinates=coordinates))
+    return route, json.dumps({"element_coordinates": boxes}, ensure_ascii=False)
+
+
+class FakeAPIServer:
+    """HTTP (OpenAI + Gemini REST) and gRPC (Gemini) fake API server.
+
+    Use `await start()` / `await stop()` or `async with`. Port 0 binds a free
+    port; the actual ports are available after start().
+    """
+
+    def __init__(self, host="127.0.0.1", http_port=8765, grpc_port=8766, responses=None,
+                 gpt_faults=None, gemini_faults=None):
+        self.host = host
+        self.http_port = http_port
+        self.grpc_port = grpc_port
+        self.responses = responses or CannedResponses()
+        self.gpt_faults = gpt_faults or FaultProfile()
+        self.gemini_faults = gemini_faults or FaultProfile()
+        self.stats = Counter()
+        self._ids = itertools.count(1)
+        self._runner = None
+        self._grpc_server = None
+
+    @property
+    def openai_base_url(self):
+        return f"http://{self.host}:{self.http_port}/v1"
+
+    @property
+    def gemini_endpoint(self):
+        return f"{self.host}:{self.grpc_port}"
+
+    def client_env(self):
+        """Environment variables that point the pipeline's clients at this server."""
+        return {"OPENAI_BASE_URL": self.openai_base_url, "GEMINI_API_ENDPOINT": self.gemini_endpoint}
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self._handle_chat_completions)
+        app.router.add_post("/v1beta/models/{model}:generateContent", self._handle_gemini_rest)
+        app.router.add_get("/stats", self._handle_stats)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.http_port)
+        await site.start()
+        self.http_port = site._server.sockets[0].getsockname()[1]
+
+        self._grpc_server = grpc.aio.server(options=[
+            ("grpc.max_receive_message_length", 64 * 1024 * 1024),
+        ])
+        self._grpc_server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(GEMINI_SERVICE, {
+            "GenerateContent": grpc.unary_unary_rpc_method_handler(
+                self._handle_gemini_grpc,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+        }),))
+        self.grpc_port = self._grpc_server.add_insecure_port(f"{self.host}:{self.grpc_port}")
+        await self._grpc_server.start()
+        logger.info(f"Fake API: OpenAI {self.openai_base_url}, Gemini gRPC {self.gemini_endpoint}")
+        return self
+
+    async def stop(self):
+        if self._grpc_server is not None:
+            await self._grpc_server.stop(grace=None)
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    # --- OpenAI ---
+
+    async def _handle_chat_completions(self, request):
+        body = await request.json()
+        self.stats["openai_requests"] += 1
+        if body.get("stream"):
+            return await self._stream_chat_completion(request, body)
+        outcome = await self.gpt_faults.outcome()
+        if outcome != "ok":
+            return self._openai_error(outcome)
+
+        tool_choice = body.get("tool_choice")
+        message = {"role": "assistant", "content": None}
+        if isinstance(tool_choice, dict):
+            message["tool_calls"] = [{
+                "id": f"call_fake_{next(self._ids)}",
+                "type": "function",
+                "function": {"name": tool_choice["function"]["name"], "arguments": self.responses.gpt_arguments},
+            }]
+            finish_reason = "tool_calls"
+        else:
+            message["content"] = self.responses.gpt_arguments
+            finish_reason = "stop"
+        self.stats["openai_ok"] += 1
+        return web.json_response({
+            "id": f"chatcmpl-fake-{next(self._ids)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    async def _stream_chat_completion(self, request, body):
+        """The canned response as chat.completion.chunk events, spread over the sampled latency."""
+        latency = self.gpt_faults.latency.sample(self.gpt_faults.rng)
+        outcome = self.gpt_faults.roll()
+        if outcome != "ok":
+            await asyncio.sleep(latency)
+            return self._openai_error(outcome)
+
+        completion_id = f"chatcmpl-fake-{next(self._ids)}"
+        tool_choice = body.get("tool_choice")
+        text = self.responses.gpt_arguments
+        size = max(1, -(-len(text) // STREAM_PIECES))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+
+        def event(delta, finish_reason=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        await asyncio.sleep(latency * STREAM_FIRST_PIECE_SHARE)
+        if isinstance(tool_choice, dict):
+            await response.write(event({"role": "assistant", "content": None, "tool_calls": [{
+                "index": 0, "id": f"call_fake_{next(self._ids)}", "type": "function",
+                "function": {"name": tool_choice["function"]["name"], "arguments": ""},
+            }]}))
+        else:
+            await response.write(event({"role": "assistant", "content": ""}))
+        for piece in pieces:
+            await asyncio.sleep(latency * (1 - STREAM_FIRST_PIECE_SHARE) / len(pieces))
+            if isinstance(tool_choice, dict):
+                await response.write(event({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]}))
+            else:
+                await response.write(event({"content": piece}))
+        await response.write(event({}, "tool_calls" if isinstance(tool_choice, dict) else "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        self.stats["openai_ok"] += 1
+        return response
+
+    def _openai_error(self, outcome):
+        if outcome == "rate_limited":
+            self.stats["openai_429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": "1"})
+        self.stats["openai_500"] += 1
+        return web.json_response({"error": {"message": "Injected server error (fake)", "type": "server_error"}},
+                                 status=500)
+
+    # --- Gemini ---
+
+    def _gemini_text(self, prompt, has_image):
+        """Response text for a request, routed on its prompt (see gemini_boxes); counted per route."""
+        if not has_image:
+            self.stats["gemini_text"] += 1
+            return self.responses.gemini_text
+        route, text = gemini_boxes(self.responses.gemini_elements, prompt)
+        self.stats[f"gemini_{route}"] += 1
+        return text
+
+    async def _handle_gemini_grpc(self, request, context):
+        self.stats["gemini_requests"] += 1
+        outcome = await self.gemini_faults.outcome()
+        if outcome == "rate_limited":
+            self.stats["gemini_429"] += 1
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Resource has been exhausted (fake)")
+        if outcome == "error":
+            self.stats["gemini_500"] += 1
+            await context.abort(grpc.StatusCode.INTERNAL, "Injected server error (fake)")
+        has_image = any(part.inline_data.data for content in request.contents for part in content.parts)
+        prompt = "\n".join(part.text for content in request.contents for part in content.parts if part.text)
+        self.stats["gemini_ok"] += 1
+        return glm.GenerateContentResponse(candidates=[glm.Candidate(
+            index=0,
+            content=glm.Content(role="model", parts=[glm.Part(text=self._gemini_text(prompt, has_image))]),
+            finish_reason=glm.Candidate.FinishReason.STOP,
+        )])
+
+    async def _handle_gemini_rest(self, request):
+        body = await request.json()
+        self.stats["gemini_requests"] += 1
+        outcome = await self.gemini_faults.outcome()
+        if outcome != "ok":
+            status = 429 if outcome == "rate_limited" else 500
+            self.stats[f"gemini_{status}"] += 1
+            return web.json_response({"error": {"code": status, "message": "Injected error (fake)"}}, status=status)
+        has_image = any("inlineData" in part or "inline_data" in part
+                        for content in body.get("contents", []) for part in content.get("parts", []))
+        prompt = "\n".join(part["text"] for content in body.get("contents", [])
+                           for part in content.get("parts", []) if part.get("text"))
+        self.stats["gemini_ok"] += 1
+        return web.json_response({"candidates": [{
+            "index": 0,
+            "content": {"role": "model", "parts": [{"text": self._gemini_text(prompt, has_image)}]},
+            "finishReason": "STOP",
+        }]})
+
+    async def _handle_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+
+def add_fault_arguments(parser):
+    """Adds the latency / error injection options (shared with the benchmark)."""
+    parser.add_argument("--gpt-latency", default="fixed:0",
+                        help="GPT latency: fixed:S, uniform:A:B, normal:MEAN:STD, lognormal:MEDIAN:SIGMA (seconds).")
+    parser.add_argument("--gemini-latency", default="fixed:0", help="Gemini latency, same format.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 500/INTERNAL.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Share of requests failing with 429/RESOURCE_EXHAUSTED.")
+    parser.add_argument("--seed", type=int, help="Random seed for latencies and injected failures.")
+
+
+def fault_profiles_from_args(args):
+    rng = random.Random(args.seed)
+    return (
+        FaultProfile(args.gpt_latency, args.error_rate, args.rate_limit_rate, rng),
+        FaultProfile(args.gemini_latency, args.error_rate, args.rate_limit_rate, rng),
+    )
+
+
+async def serve(args):
+    gpt_faults, gemini_faults = fault_profiles_from_args(args)
+    server = FakeAPIServer(
+        host=args.host, http_port=args.http_port, grpc_port=args.grpc_port,
+        responses=CannedResponses(args.coords_response, args.text_response, args.gpt_response),
+        gpt_faults=gpt_faults, gemini_faults=gemini_faults,
+    )
+    await server.start()
+    for name, value in server.client_env().items():
+        print(f"export {name}={value}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI/Gemini API server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--http-port", type=int, default=8765, help="OpenAI + Gemini REST port.")
+    parser.add_argument("--grpc-port", type=int, default=8766, help="Gemini gRPC port.")
+    parser.add_argument("--gpt-response", help="File with the GPT tool call arguments (JSON). Default: built from the coordinates fixture.")
+    parser.add_argument("--coords-response", default=DEFAULT_COORDS_RESPONSE, help="Gemini response for requests with an image.")
+    parser.add_argument("--text-response", default=DEFAULT_TEXT_RESPONSE, help="Gemini response for text-only requests.")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,999 @@
+#!/usr/bin/env python3
+"""
+Bounding boxes of the GPT problem areas, requested from Gemini: page tiles,
+chunked and refined requests, speculative element detection and prefetch.
+"""
+
+import os
+import re
+import json
+import math
+import hashlib
+import asyncio
+import logging
+from dataclasses import dataclass, replace
+from typing import Optional
+
+from api_clients import get_gemini_model
+from llm_cache import llm_cache, LLMCache, LLMCacheMiss
+
+logger = logging.getLogger(__name__)
+
+MAX_AREAS = 30
+# Pages taller than this many widths and COORDS_TILE_MIN_HEIGHT pixels are localized in tiles; 0 disables tiling
+COORDS_TILE_MIN_ASPECT = float(os.getenv("COORDS_TILE_MIN_ASPECT", "3"))
+COORDS_TILE_MIN_HEIGHT = int(os.getenv("COORDS_TILE_MIN_HEIGHT", "3072")) # Sent whole at full resolution below that
+COORDS_TILE_ASPECT = float(os.getenv("COORDS_TILE_ASPECT", "2")) # Tile height in page widths
+COORDS_TILE_OVERLAP = float(os.getenv("COORDS_TILE_OVERLAP", "0.15")) # Share of the tile height
+COORDS_MAX_TILES = int(os.getenv("COORDS_MAX_TILES", "8"))
+COORDS_CHUNK_SIZE = int(os.getenv("COORDS_CHUNK_SIZE", "10")) # Problem areas per request; 0: all in one
+COORDS_PARSE_RETRIES = int(os.getenv("COORDS_PARSE_RETRIES", "1"))
+# Second request for boxes that are missing, degenerate or less confident than this; 0 disables it
+COORDS_REFINE_CONFIDENCE = float(os.getenv("COORDS_REFINE_CONFIDENCE", "0.5"))
+# Two passes: approximate boxes on a downscaled page, then every box on a full-resolution crop
+COORDS_COARSE_TO_FINE = os.getenv("COORDS_COARSE_TO_FINE", "0").lower() in ("1", "true", "yes")
+COORDS_COARSE_MAX_SIDE = int(os.getenv("COORDS_COARSE_MAX_SIDE", "1024"))
+# Detect all UI elements alongside the GPT analysis and match the problem areas to them
+COORDS_SPECULATIVE_DETECTION = os.getenv("COORDS_SPECULATIVE_DETECTION", "0").lower() in ("1", "true", "yes")
+COORDS_DETECTION_MAX_ELEMENTS = int(os.getenv("COORDS_DETECTION_MAX_ELEMENTS", "80")) # Per image or tile
+COORDS_MATCH_MIN_SCORE = float(os.getenv("COORDS_MATCH_MIN_SCORE", "0.6"))
+# Gemini box requests of one run in flight at the same time (detection, prefetch and coordinates together)
+COORDS_MAX_CONCURRENCY = int(os.getenv("COORDS_MAX_CONCURRENCY", "8"))
+
+GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "max_output_tokens": 8192,
+}
+# A box this close (0-1000 grid of the tile) to an inner tile edge is taken as cut by it
+EDGE_TOLERANCE = 5
+# Boxes of the same element from two tiles overlapping by this share of the narrower one are joined
+MERGE_MIN_X_OVERLAP = 0.5
+# Boxes smaller than this on the page (pixels) are degenerate, as in generate_report_v2.get_problem_image
+MIN_BOX_PIXELS = 10
+# Refine crop around a box: this many times its size, at least REFINE_MIN_CONTEXT pixels on every side
+REFINE_CONTEXT = 2.0
+REFINE_MIN_CONTEXT = 200
+# Parts of the page (share of height or width) named by location hints, English and Russian;
+# whole words or their inflections only ("top bar", not "desktop"; "правый", not "правильный")
+ADJECTIVE_ENDINGS = r"(?:ий|ый|яя|ая|ее|ое|ей|ой|его|ого|ем|ом|ему|ому|юю|ую|ие|ые|их|ых|ими|ыми)"
+
+
+def hint_pattern(*words):
+    return re.compile(r"\b(?:" + "|".join(words) + r")\b")
+
+
+VERTICAL_HINTS = (
+    (hint_pattern(r"top(?:most)?", r"headers?", r"upper(?:most)?",
+                  r"(?:в|на|с)?верху", r"верх(?:а|е)?", r"верхн" + ADJECTIVE_ENDINGS, r"шапк(?:а|е|и|у|ой)"),
+     (0.0, 0.4)),
+    (hint_pattern(r"middle", r"cent(?:er|re|ral|ered)", r"(?:по)?середин(?:а|е|у|ы|ой)",
+                  r"центр(?:а|е|у|ом)?", r"центральн" + ADJECTIVE_ENDINGS),
+     (0.3, 0.7)),
+    (hint_pattern(r"bottom(?:most)?", r"footers?", r"lower", r"lowest",
+                  r"(?:в|с)?низу", r"низ(?:а|е)?", r"нижн" + ADJECTIVE_ENDINGS,
+                  r"подвал(?:а|е|ом)?", r"футер(?:а|е|ом)?"),
+     (0.6, 1.0)),
+)
+HORIZONTAL_HINTS = (
+    (hint_pattern(r"left(?:most|-hand)?", r"слева", r"лев" + ADJECTIVE_ENDINGS), (0.0, 0.6)),
+    (hint_pattern(r"right(?:most|-hand)?", r"справа", r"прав" + ADJECTIVE_ENDINGS), (0.4, 1.0)),
+)
+
+COORDS_PROMPT_TEMPLATE = """
+You are a specialized visual analysis system designed to extract precise coordinates for identified UI usability issues in images. Your task is to locate specific problematic elements and provide their bounding box coordinates using a normalized coordinate system.
+{section_note}
+
+These are the problematic elements you need to locate:
+
+<problematic_elements>
+{elements_text}
+</problematic_elements>
+
+Instructions:
+
+1. Coordinate System:
+   - Use a normalized coordinate system between 0-1000 for both X and Y axes.
+   - The origin (0,0) is at the TOP LEFT of the image.
+   - For each element, return coordinates as [y_min, x_min, y_max, x_max].
+   - y_min = top edge, y_max = bottom edge, x_min = left edge, x_max = right edge.
+
+2. Element Location Process:
+   - Carefully examine the provided image.
+   - For each element ID listed in the problematic_elements, find the described element.
+   - Create the MOST PRECISE, TIGHTEST possible bounding box around ONLY the specific visual element mentioned in the description. Use the 'Location Hint' to help pinpoint it.
+   - **CRITICAL: AVOID creating bounding boxes that span nearly the entire width of the image content area unless the described element itself is explicitly that wide (e.g., a full-width header background). Focus on the specific, local element.**
+   - **Example: If a problem description is 'misaligned button within a panel', the bounding box MUST encompass ONLY the button, NOT the entire panel or the row it sits in.**
+   - If multiple instances exist, choose the one most relevant to the description.
+   - {missing_rule}
+
+3. Coordinate Validation:
+   - Ensure that x_min < x_max and y_min < y_max for all bounding boxes.
+   - If this condition is not met, do not include the coordinates in the final output JSON's element_coordinates list for that element.
+
+4. Confidence Assessment:
+   - Assign a confidence score (0.0-1.0) to each element based on how certain you are of its location and bounding box accuracy.
+
+Output Format:
+Provide your response ONLY as valid JSON with the following structure (no other text before or after the JSON block):
+
+{{
+  "element_coordinates": [
+    {{
+      "id": "problem_area_id from input",
+      "element": "brief description of the identified element",
+      "coordinates": [y_min, x_min, y_max, x_max], // Normalized 0-1000 or null
+      "confidence": 0.0-1.0
+    }}
+    // ... (repeat for each element where valid coordinates were found)
+  ]
+}}
+
+Remember:
+- Strictly adhere to the JSON format as the ONLY output.
+- Only include valid coordinates (y_min < y_max, x_min < x_max) or null in the 'coordinates' field.
+- Ensure that all coordinate values are between 0 and 1000.
+
+Begin your coordinate extraction now.
+"""
+
+DETECTION_PROMPT_TEMPLATE = """
+You are a specialized visual analysis system that detects user interface elements in screenshots.
+{section_note}
+Detect the salient UI elements of the image: buttons, links, navigation items, form fields, headings, text blocks, images, icons, banners, cards, tables and similar. List at most {max_elements}, the most prominent first; do not list every word of running text separately.
+
+For each element return:
+- "id": "e1", "e2", ... in the order listed
+- "element": its type and a short description (e.g. "button: orange 'Subscribe' button in the header")
+- "text": its visible text, at most 8 words ("" if none)
+- "coordinates": [y_min, x_min, y_max, x_max], normalized 0-1000, origin at the TOP LEFT of the image, the tightest box around the element
+- "confidence": 0.0-1.0
+
+Provide your response ONLY as valid JSON with the following structure (no other text before or after the JSON block):
+
+{{
+  "element_coordinates": [
+    {{"id": "e1", "element": "...", "text": "...", "coordinates": [y_min, x_min, y_max, x_max], "confidence": 0.9}}
+  ]
+}}
+"""
+
+SECTION_NOTE = """
+The image is section {number} of {count} of a tall page screenshot; it shows the full page width and the part from {top}% to {bottom}% of the page height. Neighbouring sections overlap. All coordinates refer to THIS section image, not to the whole page.
+"""
+
+CROP_NOTE = """
+The image is a crop of a page screenshot where the elements below are expected; it shows the part from {left}% to {right}% of the page width and from {top}% to {bottom}% of the page height. All coordinates refer to THIS cropped image, not to the whole page.
+"""
+
+
+@dataclass(frozen=True)
+class Region:
+    """Part of the page sent in one request, in pixels of the original screenshot."""
+    left: int
+    top: int
+    right: int
+    bottom: int
+    page_width: int
+    page_height: int
+    index: int = 0
+    count: int = 1
+    refine: bool = False # A crop of the refine pass rather than a tile
+
+    @property
+    def box(self):
+        return (self.left, self.top, self.right, self.bottom)
+
+    @property
+    def is_page(self):
+        return self.box == (0, 0, self.page_width, self.page_height)
+
+    def to_page(self, coordinates):
+        """Maps [y_min, x_min, y_max, x_max] (0-1000 of the region) to 0-1000 of the page."""
+        y_min, x_min, y_max, x_max = coordinates
+        height, width = self.bottom - self.top, self.right - self.left
+
+        def page_y(y):
+            return round((self.top + y / 1000 * height) / self.page_height * 1000, 1)
+
+        def page_x(x):
+            return round((self.left + x / 1000 * width) / self.page_width * 1000, 1)
+        return [page_y(y_min), page_x(x_min), page_y(y_max), page_x(x_max)]
+
+    def cut_edges(self, coordinates):
+        """(top, bottom): whether a box (0-1000 of the region) touches an edge shared with another region."""
+        y_min, _, y_max, _ = coordinates
+        return (self.top > 0 and y_min <= EDGE_TOLERANCE,
+                self.bottom < self.page_height and y_max >= 1000 - EDGE_TOLERANCE)
+
+    def describe(self):
+        info = {"index": self.index, "box": list(self.box)}
+        if self.refine:
+            info["refine"] = True
+        return info
+
+
+def prompt_hash(*templates):
+    return hashlib.sha256("".join(templates).encode("utf-8")).hexdigest()
+
+
+def settings():
+    """Settings that change the boxes returned, for stage fingerprints and cache keys."""
+    return {
+        "prompt": prompt_hash(COORDS_PROMPT_TEMPLATE, SECTION_NOTE, CROP_NOTE),
+        "max_areas": MAX_AREAS,
+        "tile_min_aspect": COORDS_TILE_MIN_ASPECT,
+        "tile_min_height": COORDS_TILE_MIN_HEIGHT,
+        "tile_aspect": COORDS_TILE_ASPECT,
+        "tile_overlap": COORDS_TILE_OVERLAP,
+        "max_tiles": COORDS_MAX_TILES,
+        "chunk_size": COORDS_CHUNK_SIZE,
+        "refine_confidence": COORDS_REFINE_CONFIDENCE,
+        "coarse_to_fine": COORDS_COARSE_TO_FINE,
+        "coarse_max_side": COORDS_COARSE_MAX_SIDE if COORDS_COARSE_TO_FINE else None,
+        "match_min_score": COORDS_MATCH_MIN_SCORE if COORDS_SPECULATIVE_DETECTION else None,
+    }
+
+
+def detection_settings():
+    """Settings of the speculative detection (element_detection stage)."""
+    return {
+        "enabled": COORDS_SPECULATIVE_DETECTION,
+        "prompt": prompt_hash(DETECTION_PROMPT_TEMPLATE, SECTION_NOTE),
+        "max_elements": COORDS_DETECTION_MAX_ELEMENTS,
+        "tile_min_aspect": COORDS_TILE_MIN_ASPECT,
+        "tile_min_height": COORDS_TILE_MIN_HEIGHT,
+        "tile_aspect": COORDS_TILE_ASPECT,
+        "tile_overlap": COORDS_TILE_OVERLAP,
+        "max_tiles": COORDS_MAX_TILES,
+    }
+
+
+def page_region(width, height):
+    """The whole page as one Region."""
+    return Region(0, 0, width, height, width, height)
+
+
+def split_rows(top, bottom, tile_height, overlap=COORDS_TILE_OVERLAP, max_tiles=COORDS_MAX_TILES):
+    """Overlapping (top, bottom) row ranges of about tile_height covering top..bottom.
+
+    Neighbours share `overlap` of the tile height; there are at most
+    max_tiles ranges (taller ones beyond that). All ranges have the same
+    height and the last one ends at `bottom`.
+    """
+    height = bottom - top
+    if height <= tile_height:
+        return [(top, bottom)]
+    overlap = min(max(overlap, 0.0), 0.5)
+    count = max(2, math.ceil((height - overlap * tile_height) / ((1 - overlap) * tile_height)))
+    count = min(count, max(max_tiles, 2))
+    # count tiles of equal height, each sharing `overlap` of it with the next, span the range exactly
+    tile_height = min(height, math.ceil(height / (count - (count - 1) * overlap)))
+    stride = (height - tile_height) / (count - 1)
+    return [(top + round(i * stride), top + round(i * stride) + tile_height) for i in range(count)]
+
+
+def plan_tiles(width, height, min_aspect=COORDS_TILE_MIN_ASPECT, min_height=COORDS_TILE_MIN_HEIGHT,
+               tile_aspect=COORDS_TILE_ASPECT, overlap=COORDS_TILE_OVERLAP, max_tiles=COORDS_MAX_TILES):
+    """Overlapping full-width tiles covering the page, top to bottom (see split_rows).
+
+    A page not taller than min_aspect widths or min_height pixels (or
+    min_aspect 0) is one region. Otherwise tiles are about tile_aspect
+    widths high.
+    """
+    if min_aspect <= 0 or height <= width * min_aspect or height <= min_height:
+        return [page_region(width, height)]
+    rows = split_rows(0, height, width * tile_aspect, overlap, max_tiles)
+    return [Region(0, top, width, bottom, width, height, i, len(rows)) for i, (top, bottom) in enumerate(rows)]
+
+
+def hint_box(location, width, height):
+    """(left, top, right, bottom) of the part of the page a GPT location hint names; the page if none."""
+    text = (location or "").lower()
+
+    def span(hints):
+        matched = [extent for pattern, extent in hints if pattern.search(text)]
+        if not matched:
+            return 0.0, 1.0
+        return min(start for start, _ in matched), max(end for _, end in matched)
+    top, bottom = span(VERTICAL_HINTS)
+    left, right = span(HORIZONTAL_HINTS)
+    return round(left * width), round(top * height), round(right * width), round(bottom * height)
+
+
+def refine_boxes(area, element, width, height, tile_aspect=COORDS_TILE_ASPECT):
+    """Crops (left, top, right, bottom) in which to look for an area again.
+
+    Around the element's box if it has a valid one (REFINE_CONTEXT), in
+    the part of the page named by the location hint otherwise. A hint part
+    taller than tile_aspect of its width is split like the tiles.
+    """
+    coordinates = (element or {}).get("coordinates")
+    if valid_box(coordinates):
+        y_min, x_min, y_max, x_max = (c / 1000 * size for c, size in zip(coordinates, (height, width, height, width)))
+        margin_y = max((y_max - y_min) * REFINE_CONTEXT / 2, REFINE_MIN_CONTEXT)
+        margin_x = max((x_max - x_min) * REFINE_CONTEXT / 2, REFINE_MIN_CONTEXT)
+        return [(max(0, round(x_min - margin_x)), max(0, round(y_min - margin_y)),
+                 min(width, round(x_max + margin_x)), min(height, round(y_max + margin_y)))]
+    left, top, right, bottom = hint_box(area.get("location"), width, height)
+    return [(left, row_top, right, row_bottom)
+            for row_top, row_bottom in split_rows(top, bottom, (right - left) * tile_aspect)]
+
+
+def top_problem_areas(problem_areas, limit=MAX_AREAS):
+    """The `limit` most severe problem areas (all of them if they cannot be sorted)."""
+    try:
+        return sorted(problem_areas, key=lambda x: x.get('severity', 0), reverse=True)[:limit]
+    except Exception as e:
+        logger.error(f"Ошибка сортировки проблемных зон: {e}. Используются все найденные.")
+        return problem_areas
+
+
+def chunk_areas(areas, chunk_size=COORDS_CHUNK_SIZE):
+    """The areas split into consecutive chunks of at most chunk_size (one chunk if 0)."""
+    if chunk_size <= 0 or len(areas) <= chunk_size:
+        return [list(areas)]
+    return [list(areas[i:i + chunk_size]) for i in range(0, len(areas), chunk_size)]
+
+
+def format_elements(areas):
+    """The problem areas as lines of the <problematic_elements> list."""
+    elements_text = ""
+    for i, area in enumerate(areas):
+        desc = area.get('description', 'N/A')
+        loc = area.get('location', 'N/A')
+        sev = area.get('severity', 'N/A')
+        area_id = area.get('id', f'unknown_{i}')
+        elements_text += f"- ID: {area_id}, Severity: {sev}, Description: {desc}, Location Hint: {loc}\n"
+    return elements_text
+
+
+def build_prompt(areas, region=None):
+    """Coordinates prompt for the areas; a tile or crop gets a note on which part of the page it shows."""
+    def percent(value, size):
+        return round(value / size * 100)
+    if region is None or region.is_page:
+        section_note = ""
+        missing_rule = "If an element cannot be located, set its coordinates to null."
+    elif region.refine:
+        section_note = CROP_NOTE.format(
+            left=percent(region.left, region.page_width), right=percent(region.right, region.page_width),
+            top=percent(region.top, region.page_height), bottom=percent(region.bottom, region.page_height),
+        )
+        missing_rule = "If an element cannot be located in this crop, set its coordinates to null."
+    else:
+        section_note = SECTION_NOTE.format(
+            number=region.index + 1, count=region.count,
+            top=round(region.top / region.page_height * 100), bottom=round(region.bottom / region.page_height * 100),
+        )
+        missing_rule = ("Only list the elements that are visible in this section; leave the others out. "
+                        "For an element cut off at the top or bottom edge of the section, box its visible part.")
+    return COORDS_PROMPT_TEMPLATE.format(section_note=section_note, elements_text=format_elements(areas),
+                                         missing_rule=missing_rule)
+
+
+def parse_response(response_text):
+    """Parses a coordinates response (optionally in a ```json fence).
+
+    Raises:
+        ValueError: the text is not JSON or has no element_coordinates list.
+    """
+    if "```json" in response_text:
+        json_str = response_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in response_text and response_text.strip().startswith("```"):
+        json_str = response_text.split("```")[1].split("```")[0].strip()
+    else:
+        json_str = response_text.strip() # Assume it's just JSON
+    coordinates_data = json.loads(json_str)
+    if not isinstance(coordinates_data, dict) or not isinstance(coordinates_data.get("element_coordinates"), list):
+        raise ValueError("Отсутствует ключ 'element_coordinates' в ответе Gemini")
+    return coordinates_data
+
+
+def valid_box(coordinates):
+    """Whether coordinates are [y_min, x_min, y_max, x_max] within 0-1000 with min < max."""
+    if not isinstance(coordinates, (list, tuple)) or len(coordinates) != 4:
+        return False
+    if not all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in coordinates):
+        return False
+    y_min, x_min, y_max, x_max = coordinates
+    return all(0 <= c <= 1000 for c in coordinates) and y_min < y_max and x_min < x_max
+
+
+def box_ok(coordinates, width, height):
+    """valid_box, and at least MIN_BOX_PIXELS in both directions on a width × height page."""
+    if not valid_box(coordinates):
+        return False
+    y_min, x_min, y_max, x_max = coordinates
+    return (y_max - y_min) / 1000 * height >= MIN_BOX_PIXELS and (x_max - x_min) / 1000 * width >= MIN_BOX_PIXELS
+
+
+def confidence_of(element):
+    try:
+        return float(element.get("confidence") or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+@dataclass
+class RequestResult:
+    """Outcome of one request: a region of the page with one chunk of the problem areas."""
+    region: Region
+    upload: object # image_context.EncodedImage
+    chunk: int = 0
+    chunks: int = 1
+    attempt: int = 0
+    response_text: Optional[str] = None
+    coordinates_data: Optional[dict] = None # parsed response, coordinates of the region
+    error: Optional[str] = None
+    parse_failed: bool = False
+
+    @property
+    def ok(self):
+        return self.coordinates_data is not None
+
+    @property
+    def label(self):
+        return f"область {self.region.index + 1}/{self.region.count}, часть {self.chunk + 1}/{self.chunks}"
+
+    def describe(self):
+        return {**self.region.describe(), "chunk": self.chunk, "attempts": self.attempt + 1,
+                "upload": self.upload.describe(), "error": self.error}
+
+
+async def request_region(image, region, prompt, model, profile, semaphore=None, chunk=0, chunks=1, attempt=0):
+    """Sends one region of the page with its prompt and parses the response.
+
+    API and parse errors are returned in RequestResult.error; only
+    LLMCacheMiss (replay mode) is raised. A retry (attempt > 0) has its own
+    cache key, so it does not get the cached unparsable response back.
+    """
+    upload = await asyncio.to_thread(image.encoded, profile, None if region.is_page else region.box)
+    result = RequestResult(region, upload, chunk, chunks, attempt)
+
+    async def request_coordinates():
+        logger.debug(f"Отправка запроса в Gemini API (Координаты, {result.label})...")
+        response = await get_gemini_model(model).generate_content_async(
+            contents=[prompt, {"mime_type": upload.mime_type, "data": upload.data}],
+            generation_config=GENERATION_CONFIG,
+        )
+        logger.debug(f"Ответ от Gemini API получен ({result.label}).")
+        if hasattr(response, 'text'):
+            return response.text
+        if hasattr(response, 'candidates') and len(response.candidates) > 0 and response.candidates[0].content.parts:
+            return response.candidates[0].content.parts[0].text
+        return None
+
+    params = dict(GENERATION_CONFIG, retry=attempt) if attempt else GENERATION_CONFIG
+    cache_key = LLMCache.make_key(model, prompt, image_data=upload.data, params=params)
+    try:
+        if semaphore is None:
+            result.response_text = await llm_cache.fetch(cache_key, request_coordinates, model=model)
+        else:
+            async with semaphore:
+                result.response_text = await llm_cache.fetch(cache_key, request_coordinates, model=model)
+    except LLMCacheMiss:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при вызове Gemini API ({result.label}): {e}", exc_info=True)
+        result.error = f"api: {e}"
+        return result
+
+    if result.response_text is None:
+        result.error = "empty response"
+        return result
+    try:
+        result.coordinates_data = parse_response(result.response_text)
+    except ValueError as e:
+        logger.error(f"Ошибка парсинга JSON ответа Gemini ({result.label}): {e}")
+        logger.debug(f"Raw response text:\n{result.response_text[:1000]}...")
+        result.error = f"parse: {e}"
+        result.parse_failed = True
+    return result
+
+
+def merge_candidates(candidates):
+    """One box per problem area from the boxes found in several regions.
+
+    candidates: dicts with id, element, coordinates (0-1000 of the page),
+    confidence and cut ((top, bottom) edges touched, see Region.cut_edges).
+    Boxes of the same id that overlap horizontally and vertically are the
+    same element seen from two tiles: an uncut box is preferred (the most
+    confident one), otherwise the parts are joined into one box. Of the
+    resulting elements the most confident is kept, as a single request
+    would choose "the one most relevant".
+    """
+    by_id = {}
+    for candidate in candidates:
+        by_id.setdefault(str(candidate["id"]), []).append(candidate)
+
+    merged = []
+    for element_id, boxes in by_id.items():
+        clusters = []
+        for box in sorted(boxes, key=confidence_of, reverse=True):
+            for cluster in clusters:
+                if any(_same_element(box["coordinates"], other["coordinates"]) for other in cluster):
+                    cluster.append(box)
+                    break
+            else:
+                clusters.append([box])
+        joined = [_join_cluster(cluster) for cluster in clusters]
+        merged.append(max(joined, key=lambda e: (e["confidence"], e["parts"])))
+    for element in merged:
+        del element["parts"]
+    return merged
+
+
+def _same_element(a, b):
+    a_y_min, a_x_min, a_y_max, a_x_max = a
+    b_y_min, b_x_min, b_y_max, b_x_max = b
+    if min(a_y_max, b_y_max) < max(a_y_min, b_y_min):
+        return False
+    x_overlap = min(a_x_max, b_x_max) - max(a_x_min, b_x_min)
+    return x_overlap >= MERGE_MIN_X_OVERLAP * min(a_x_max - a_x_min, b_x_max - b_x_min)
+
+
+def _join_cluster(cluster):
+    best = cluster[0] # The most confident
+    uncut = [box for box in cluster if not any(box["cut"])]
+    if uncut:
+        coordinates = uncut[0]["coordinates"]
+    else:
+        coordinates = [
+            min(box["coordinates"][0] for box in cluster),
+            min(box["coordinates"][1] for box in cluster),
+            max(box["coordinates"][2] for box in cluster),
+            max(box["coordinates"][3] for box in cluster),
+        ]
+    return {
+        "id": best["id"],
+        "element": (uncut[0] if uncut else best).get("element"),
+        "coordinates": coordinates,
+        "confidence": confidence_of(best),
+        "parts": len(cluster),
+    }
+
+
+def page_candidates(result):
+    """Valid boxes of a successful RequestResult, mapped to the page."""
+    candidates = []
+    for element in result.coordinates_data["element_coordinates"]:
+        if not isinstance(element, dict) or element.get("id") is None or not valid_box(element.get("coordinates")):
+            continue
+        candidates.append({
+            "id": element["id"],
+            "element": element.get("element"),
+            "coordinates": result.region.to_page(element["coordinates"]),
+            "confidence": confidence_of(element),
+            "cut": result.region.cut_edges(element["coordinates"]),
+        })
+        if element.get("text"):
+            candidates[-1]["text"] = str(element["text"])
+    return candidates
+
+
+def build_detection_prompt(region=None, max_elements=COORDS_DETECTION_MAX_ELEMENTS):
+    """Prompt of the speculative detection; a tile gets the section note."""
+    section_note = ""
+    if region is not None and not region.is_page:
+        section_note = SECTION_NOTE.format(
+            number=region.index + 1, count=region.count,
+            top=round(region.top / region.page_height * 100), bottom=round(region.bottom / region.page_height * 100),
+        )
+    return DETECTION_PROMPT_TEMPLATE.format(section_note=section_note, max_elements=max_elements)
+
+
+def overlap_share(a, b):
+    """Intersection of two [y_min, x_min, y_max, x_max] boxes as a share of the smaller one."""
+    height = min(a[2], b[2]) - max(a[0], b[0])
+    width = min(a[3], b[3]) - max(a[1], b[1])
+    if height <= 0 or width <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return height * width / smaller if smaller > 0 else 0.0
+
+
+def merge_detections(candidates, min_overlap=0.7):
+    """Detected elements of all tiles, with duplicates from the tile overlaps removed.
+
+    A box mostly inside an already kept box of the same text (or type) is
+    the same element; a kept box cut by a tile edge is replaced by an
+    uncut one. The elements are numbered d1, d2, ... top to bottom.
+    """
+    kept = []
+    for candidate in sorted(candidates, key=confidence_of, reverse=True):
+        for i, other in enumerate(kept):
+            same_label = (candidate.get("text") or candidate.get("element")) == (other.get("text") or other.get("element"))
+            if same_label and overlap_share(candidate["coordinates"], other["coordinates"]) >= min_overlap:
+                if any(other["cut"]) and not any(candidate["cut"]):
+                    kept[i] = candidate
+                break
+        else:
+            kept.append(candidate)
+    kept.sort(key=lambda c: (c["coordinates"][0], c["coordinates"][1]))
+    elements = []
+    for i, candidate in enumerate(kept):
+        element = {key: value for key, value in candidate.items() if key != "cut"}
+        element["id"] = f"d{i + 1}"
+        elements.append(element)
+    return elements
+
+
+def request_semaphore():
+    """Limit of the Gemini requests of one run in flight (COORDS_MAX_CONCURRENCY)."""
+    return asyncio.Semaphore(max(1, COORDS_MAX_CONCURRENCY))
+
+
+async def detect_elements(image, model, profile, semaphore=None):
+    """Boxes of all salient UI elements of the page, in tiles for tall pages.
+
+    Returns a Localization whose coordinates_data lists the elements
+    (id, element, text, coordinates in 0-1000 of the page, confidence);
+    None if every request failed. `semaphore` (request_semaphore) is
+    shared with the other Gemini requests of the run.
+    """
+    width, height = await asyncio.to_thread(lambda: image.size)
+    regions = plan_tiles(width, height)
+    semaphore = semaphore or request_semaphore()
+    jobs = [(region, 0, 1, build_detection_prompt(region)) for region in regions]
+    results = await request_all(image, jobs, model, profile, semaphore)
+    succeeded = [result for result in results if result.ok]
+    if not succeeded:
+        return Localization(results, None)
+    elements = merge_detections([c for result in succeeded for c in page_candidates(result)])
+    logger.debug(f"Обнаружено {len(elements)} элементов интерфейса ({len(succeeded)} из {len(results)} запросов)")
+    return Localization(results, {
+        "element_coordinates": elements,
+        "requests": [result.describe() for result in results],
+    })
+
+
+# Words that say little about which element is meant
+STOP_WORDS = frozenset((
+    "the", "and", "for", "with", "that", "this", "are", "from", "into", "its", "has", "have", "not", "but",
+    "page", "element", "elements", "area", "which", "their", "there", "too", "can", "may", "more", "less",
+    "increases", "makes", "visual", "complexity", "users", "user",
+))
+# UI types that alone do not identify an element
+GENERIC_WORDS = frozenset((
+    "button", "buttons", "text", "link", "links", "image", "images", "icon", "icons", "block", "section",
+    "card", "cards", "field", "menu", "item", "items", "heading", "title", "label",
+))
+QUOTED = re.compile(r"[\"'«“„]([^\"'»”“]{2,80})[\"'»”“]")
+
+
+def words(text):
+    return {word for word in re.findall(r"\w+", (text or "").lower()) if len(word) >= 3 and word not in STOP_WORDS}
+
+
+def match_score(area, element, width, height):
+    """How well a detected element fits a problem area, 0-1.
+
+    The share of the element's words (type, description, visible text)
+    that the area's description and subcategory contain; 1.0 if the
+    description quotes the element's visible text. A single shared generic
+    word ("button") counts half, and an element outside the part of the
+    page named by the location hint gets 0.6 of the score.
+    """
+    description = f"{area.get('description', '')} {area.get('subcategory', '')}"
+    text = (element.get("text") or "").strip().lower()
+    if text and any(quote.strip().lower() == text for quote in QUOTED.findall(description)):
+        score = 1.0
+    else:
+        element_words = words(f"{element.get('element', '')} {text}")
+        shared = element_words & words(description)
+        if not shared:
+            return 0.0
+        score = len(shared) / len(element_words)
+        if len(shared) == 1 and shared <= GENERIC_WORDS:
+            score *= 0.5
+    if area.get("location"):
+        left, top, right, bottom = hint_box(area["location"], width, height)
+        y_min, x_min, y_max, x_max = element["coordinates"]
+        center_x, center_y = (x_min + x_max) / 2000 * width, (y_min + y_max) / 2000 * height
+        if not (left <= center_x <= right and top <= center_y <= bottom):
+            score *= 0.6
+    return score
+
+
+def match_detections(areas, detections, width, height, min_score=COORDS_MATCH_MIN_SCORE):
+    """Boxes for the problem areas taken from the detected elements.
+
+    Every area gets its best-scoring element (match_score) if that reaches
+    min_score; several areas may point at the same element. Returns
+    {area id: element entry}; the confidence of an entry is the lower of
+    the detection confidence and the match score, so weak matches are
+    still refined.
+    """
+    matched = {}
+    for area in areas:
+        if area.get("id") is None:
+            continue
+        scored = [(match_score(area, element, width, height), confidence_of(element), element)
+                  for element in detections if valid_box(element.get("coordinates"))]
+        if not scored:
+            continue
+        score, confidence, element = max(scored, key=lambda item: (item[0], item[1]))
+        if score < min_score:
+            continue
+        matched[str(area["id"])] = {
+            "id": area["id"],
+            "element": element.get("element"),
+            "coordinates": list(element["coordinates"]),
+            "confidence": round(min(confidence or 1.0, score), 3),
+            "detection": element.get("id"),
+        }
+    return matched
+
+
+@dataclass
+class Localization:
+    """Boxes of the problem areas for the whole page, with the requests that produced them."""
+    results: list # final RequestResult per region and chunk
+    coordinates_data: Optional[dict] # {"element_coordinates": [...]} in 0-1000 of the page; None if every request failed
+
+    def raw(self):
+        """The raw response text (one request) or JSON with the response of every request."""
+        if len(self.results) == 1:
+            return self.results[0].response_text
+        return json.dumps({"requests": [
+            {**result.region.describe(), "chunk": result.chunk, "response": result.response_text, "error": result.error}
+            for result in self.results
+        ]}, indent=2, ensure_ascii=False)
+
+
+async def request_all(image, jobs, model, profile, semaphore=None):
+    """Runs the requests concurrently; jobs are (region, chunk, chunks, prompt[, first attempt]).
+
+    A request whose response cannot be parsed is sent again, up to
+    COORDS_PARSE_RETRIES times, as soon as it fails. Returns the final
+    RequestResult of every job.
+    """
+    async def request(region, chunk, chunks, prompt, first_attempt=0):
+        result = await request_region(image, region, prompt, model, profile, semaphore, chunk, chunks, first_attempt)
+        while result.parse_failed and result.attempt < first_attempt + COORDS_PARSE_RETRIES:
+            logger.warning(f"Повторный запрос координат после ошибки парсинга ({result.label})")
+            result = await request_region(image, region, prompt, model, profile, semaphore,
+                                          chunk, chunks, result.attempt + 1)
+        return result
+    return list(await asyncio.gather(*(request(*job) for job in jobs)))
+
+
+def needs_refine(element, width, height, threshold=COORDS_REFINE_CONFIDENCE):
+    """Whether an element (None: not returned) has no usable box or a confidence below threshold."""
+    if element is None or not box_ok(element.get("coordinates"), width, height):
+        return True
+    return element.get("confidence") is not None and confidence_of(element) < threshold
+
+
+async def refine(image, areas, coordinates_data, model, profile, semaphore=None, threshold=COORDS_REFINE_CONFIDENCE,
+                 all_areas=False):
+    """Asks again, on crops, for the areas whose boxes need it (needs_refine), or for all of them.
+
+    The crops come from refine_boxes; areas sharing a crop go out in one
+    request (chunked). A refined box replaces the element's box if that
+    one was unusable or less confident, or always with all_areas (the
+    second pass of coarse-to-fine); replaced elements are marked
+    "refined". coordinates_data (0-1000 of the page) is updated in place.
+    Returns the RequestResults of the pass.
+    """
+    width, height = image.size
+    elements = {
+        str(element["id"]): element for element in coordinates_data["element_coordinates"]
+        if isinstance(element, dict) and element.get("id") is not None
+    }
+    targets = [area for area in areas if area.get("id") is not None and (
+        all_areas or needs_refine(elements.get(str(area["id"])), width, height, threshold))]
+    if not targets:
+        return []
+    target_ids = {str(area["id"]) for area in targets}
+    crops = {}
+    for area in targets:
+        for box in refine_boxes(area, elements.get(str(area["id"])), width, height):
+            crops.setdefault(box, []).append(area)
+    jobs = []
+    for i, (box, crop_areas) in enumerate(crops.items()):
+        region = Region(*box, width, height, i, len(crops), refine=True)
+        chunks = chunk_areas(crop_areas)
+        jobs.extend((region, chunk, len(chunks), build_prompt(chunk_of_areas, region))
+                    for chunk, chunk_of_areas in enumerate(chunks))
+    logger.info(f"Уточнение координат: {len(targets)} проблемных зон, {len(jobs)} запросов")
+    results = await request_all(image, jobs, model, profile, semaphore)
+
+    best = {}
+    for result in results:
+        if not result.ok:
+            continue
+        for candidate in page_candidates(result):
+            element_id = str(candidate["id"])
+            if element_id not in target_ids:
+                continue
+            if not box_ok(candidate["coordinates"], width, height):
+                continue
+            if element_id not in best or candidate["confidence"] > best[element_id]["confidence"]:
+                best[element_id] = candidate
+    refined = 0
+    for element_id, candidate in best.items():
+        element = elements.get(element_id)
+        if element is None:
+            element = {"id": candidate["id"]}
+            coordinates_data["element_coordinates"].append(element)
+        elif (not all_areas and box_ok(element.get("coordinates"), width, height)
+              and candidate["confidence"] <= confidence_of(element)):
+            continue
+        element.update(coordinates=candidate["coordinates"], confidence=candidate["confidence"], refined=True)
+        if candidate.get("element"):
+            element["element"] = candidate["element"]
+        refined += 1
+    logger.debug(f"Уточнено {refined} из {len(targets)} проблемных зон")
+    return results
+
+
+def first_pass_profile(profile):
+    """Upload profile of the first requests: downscaled to COORDS_COARSE_MAX_SIDE in coarse-to-fine mode."""
+    if not COORDS_COARSE_TO_FINE:
+        return profile
+    return replace(profile, format=profile.format or "JPEG",
+                   max_side=min(profile.max_side or COORDS_COARSE_MAX_SIDE, COORDS_COARSE_MAX_SIDE))
+
+
+class CoordinatePrefetch:
+    """Coordinate requests started while the GPT analysis is still streaming its problem areas.
+
+    add() is called for every problem area as soon as it is complete; each
+    time a chunk (COORDS_CHUNK_SIZE areas) is full, its requests (one per
+    tile) start in the background. localize(prefetch=...) then uses the
+    results for the areas it needs and requests only the others; the
+    areas of an incomplete last chunk are requested there as usual.
+
+    localize keeps at most `limit` areas, so no more than that many are
+    prefetched. The requests wait on `semaphore`, which the caller also
+    passes to localize, so both together stay within COORDS_MAX_CONCURRENCY.
+    The caller owns the prefetch and cancels it once the coordinates are
+    done or the run ends.
+    """
+
+    def __init__(self, image, model, profile, semaphore=None, chunk_size=COORDS_CHUNK_SIZE or MAX_AREAS,
+                 limit=MAX_AREAS):
+        self.image = image
+        self.model = model
+        self.profile = profile
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.skipped = 0 # Areas added after `limit` were started
+        self._pending = []
+        self._batches = [] # (areas, task)
+        self._semaphore = semaphore or request_semaphore()
+
+    def add(self, area):
+        """Adds a complete problem area (must be called from the event loop)."""
+        if not isinstance(area, dict) or area.get("id") is None:
+            return
+        if self.started >= self.limit:
+            self.skipped += 1
+            if self.skipped == 1:
+                logger.debug(f"Предварительные запросы остановлены: запрошено {self.limit} проблемных зон")
+            return
+        self._pending.append(area)
+        if len(self._pending) >= min(self.chunk_size, self.limit - self.started):
+            self._start(self._pending)
+            self._pending = []
+
+    def _start(self, areas):
+        regions = plan_tiles(*self.image.size)
+        chunk = len(self._batches)
+        jobs = [(region, chunk, chunk + 1, build_prompt(areas, region)) for region in regions]
+        logger.debug(f"Предварительный запрос координат для {len(areas)} проблемных зон (часть {chunk + 1})")
+        task = asyncio.create_task(request_all(self.image, jobs, self.model, first_pass_profile(self.profile),
+                                               self._semaphore))
+        self._batches.append((areas, task))
+
+    @property
+    def started(self):
+        return sum(len(areas) for areas, _ in self._batches)
+
+    async def results(self):
+        """[(areas, [RequestResult])] of every started chunk, waiting for those still running."""
+        return [(areas, await task) for areas, task in self._batches]
+
+    def cancel(self):
+        """Stops the requests still running (GPT failed, the coordinates are done or the run ended)."""
+        for _, task in self._batches:
+            task.cancel()
+
+
+async def localize(image, areas, model, profile, detections=None, prefetch=None, semaphore=None):
+    """Requests the boxes of the problem areas, in tiles for tall pages and in chunks of areas.
+
+    Boxes that need it are requested again on crops (refine) unless
+    COORDS_REFINE_CONFIDENCE is 0. With COORDS_COARSE_TO_FINE the first
+    requests get a copy downscaled to COORDS_COARSE_MAX_SIDE and every box
+    is refined.
+
+    Args:
+        image: ImageContext of the screenshot.
+        areas: GPT problem areas to locate (see top_problem_areas).
+        model: Gemini model name.
+        profile: image_context.UploadProfile of the model.
+        detections: elements found by detect_elements; the areas matched
+            to one of them (match_detections) are not requested.
+        prefetch: CoordinatePrefetch of the streamed GPT analysis; the
+            areas it requested are not requested again (nor matched),
+            except on the tiles whose prefetched request failed.
+        semaphore: request_semaphore of the run, shared with the prefetch
+            and the detection (a new one if omitted).
+    """
+    width, height = await asyncio.to_thread(lambda: image.size)
+    regions = plan_tiles(width, height)
+    wanted = {str(area.get("id")) for area in areas}
+    prefetched, requeued, covered = [], [], set()
+    if prefetch is not None:
+        for prefetched_areas, chunk_results in await prefetch.results():
+            chunk_wanted = [area for area in prefetched_areas if str(area["id"]) in wanted]
+            if not chunk_wanted:
+                continue
+            covered.update(str(area["id"]) for area in chunk_wanted)
+            for result in chunk_results:
+                if result.ok:
+                    prefetched.append(result)
+                else:
+                    # Only this tile is missing for the chunk: request it again (a new cache key after a parse error)
+                    requeued.append((result.region, result.chunk, result.chunks,
+                                     build_prompt(chunk_wanted, result.region),
+                                     result.attempt + 1 if result.parse_failed else 0))
+        logger.info(f"Координаты получены заранее (потоковый GPT): {len(covered)} из {len(areas)} проблемных зон")
+        if requeued:
+            logger.warning(f"Повторно запрашиваются {len(requeued)} неудавшихся предварительных запросов")
+    uncovered = [area for area in areas if str(area.get("id")) not in covered]
+    matched = match_detections(uncovered, detections, width, height) if detections else {}
+    if detections:
+        logger.info(f"Сопоставлено с обнаруженными элементами: {len(matched)} из {len(uncovered)} проблемных зон")
+    remaining = [area for area in uncovered if str(area.get("id")) not in matched]
+    chunks = chunk_areas(remaining) if remaining else []
+    semaphore = semaphore or request_semaphore()
+    single = not matched and not covered and len(regions) == 1 and len(chunks) == 1
+    first_profile = first_pass_profile(profile)
+    if COORDS_COARSE_TO_FINE:
+        logger.debug(f"Грубый проход координат: изображение до {first_profile.max_side} px")
+    if len(regions) > 1 and chunks:
+        logger.info(f"Координаты запрашиваются по {len(regions)} фрагментам страницы {width}x{height}")
+    if len(chunks) > 1:
+        logger.debug(f"Проблемные зоны разбиты на {len(chunks)} частей по {COORDS_CHUNK_SIZE}")
+    jobs = requeued + [
+        (region, chunk, len(chunks), build_prompt(chunk_of_areas, region))
+        for region in regions for chunk, chunk_of_areas in enumerate(chunks)
+    ]
+    results = prefetched + await request_all(image, jobs, model, first_profile, semaphore)
+
+    succeeded = [result for result in results if result.ok]
+    if not succeeded and not matched:
+        return Localization(results, None)
+    if single:
+        coordinates_data = results[0].coordinates_data
+        coordinates_data["upload"] = results[0].upload.describe()
+    else:
+        failed = len(results) - len(succeeded)
+        if failed:
+            logger.warning(f"Не получены координаты для {failed} из {len(results)} запросов")
+        merged = merge_candidates([c for result in succeeded for c in page_candidates(result) if str(c["id"]) in wanted])
+        merged = [element for element in merged if str(element["id"]) not in matched] + list(matched.values())
+        found = {str(element["id"]) for element in merged}
+        for area in areas:
+            if area.get("id") is not None and str(area["id"]) not in found:
+                merged.append({"id": area["id"], "element": None, "coordinates": None, "confidence": 0.0})
+        logger.debug(f"Ответы объединены: {len(found)} из {len(areas)} проблемных зон найдены")
+        coordinates_data = {
+            "element_coordinates": merged,
+            "requests": [result.describe() for result in results],
+        }
+        if detections:
+            coordinates_data["matched_detections"] = len(matched)
+        if prefetch is not None:
+            coordinates_data["prefetched"] = len(covered)
+
+    if COORDS_COARSE_TO_FINE or COORDS_REFINE_CONFIDENCE > 0:
+        refine_results = await refine(image, areas, coordinates_data, model, profile, semaphore,
+                                      all_areas=COORDS_COARSE_TO_FINE)
+        if refine_results:
+            coordinates_data["refine_requests"] = [result.describe() for result in refine_results]
+            results = results + refine_results
+    return Localization(results, coordinates_data)
@@ -20,6 +20,17 @@ import io
 import tempfile
 from urllib.parse import urlparse
 import sys
+import logging
+
+import heatmap_engine
+from image_context import ImageContext
+
+logger = logging.getLogger(__name__)
+
+# Heatmap figure of the report: at most this many screenshot rows, split into the densest windows
+REPORT_HEATMAP_MAX_ROWS = 6000
+REPORT_HEATMAP_WINDOWS = 3
+REPORT_HEATMAP_WIDTH = heatmap_engine.REPORT_WIDTH
 
 def load_analysis_data(json_file_path):
     """Load analysis data from a JSON file."""
@@ -28,7 +39,7 @@ def load_analysis_data(json_file_path):
             data = json.load(f)
         return data
     except Exception as e:
-        print(f"Error loading analysis data: {e}")
+        logger.error(f"Error loading analysis data: {e}")
         return None
 
 def sanitize_latex(text):
@@ -88,56 +99,64 @@ def generate_introduction(data):
 def process_heatmap_for_report(heatmap_path, output_path=None):
     """Обрабатывает тепловую карту для включения в отчет.
     
-    Функция обрезает длинное изображение тепловой карты, оставляя только наиболее значимые области
-    с высокой плотностью проблем.
+    Если тепловая карта сохранена вместе с .npy интенсивности и версией шириной отчета,
+    в отчет попадают самые "горячие" окна страницы (по таблице сумм), вырезанные
+    из версии для отчета без повторного масштабирования. Иначе длинное изображение
+    обрезается сверху.
     """
     try:
-        from PIL import Image
-        import tempfile
-        import os
-        
         if not os.path.exists(heatmap_path):
-            print(f"Ошибка: Файл тепловой карты {heatmap_path} не найден")
+            logger.error(f"Файл тепловой карты {heatmap_path} не найден")
             return None
-            
+
+        if output_path is None:
+            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png", prefix="report_heatmap_")
+            output_path = temp_file.name
+            temp_file.close()
+
+        report_body_path = heatmap_engine.report_heatmap_path(heatmap_path)
+        intensity_path = heatmap_engine.intensity_path(heatmap_path)
+        if os.path.exists(report_body_path) and os.path.exists(intensity_path):
+            intensity = heatmap_engine.load_intensity(intensity_path)
+            if intensity is not None:
+                windows = heatmap_engine.densest_windows(
+                    intensity, REPORT_HEATMAP_MAX_ROWS // REPORT_HEATMAP_WINDOWS, REPORT_HEATMAP_WINDOWS)
+                logger.info(f"Тепловая карта для отчета: окна {windows} из {intensity.shape[0]} строк")
+                with Image.open(report_body_path) as body:
+                    heatmap_engine.render_regions(body, windows, intensity.shape[0], output_path)
+                logger.info(f"Обработанная тепловая карта сохранена как {output_path}")
+                return output_path
+
         img = Image.open(heatmap_path)
         width, height = img.size
-        print(f"Обработка тепловой карты размером {width}x{height}")
+        logger.info(f"Обработка тепловой карты размером {width}x{height}")
         
-        # Определяем область для обрезки (первые 6000 пикселей высоты)
-        # Это должно содержать наиболее важные области тепловой карты
-        crop_height = min(6000, height)
+        # Без данных интенсивности: первые REPORT_HEATMAP_MAX_ROWS пикселей высоты
+        crop_height = min(REPORT_HEATMAP_MAX_ROWS, height)
         cropped_img = img.crop((0, 0, width, crop_height))
         
         # Масштабируем изображение для лучшего отображения в отчете
-        max_width = 1800
+        max_width = REPORT_HEATMAP_WIDTH
         if width > max_width:
             ratio = max_width / width
             new_height = int(crop_height * ratio)
             cropped_img = cropped_img.resize((max_width, new_height), Image.LANCZOS)
-            print(f"Масштабировано до {max_width}x{new_height}")
-        
-        # Сохраняем обработанное изображение
-        if output_path is None:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png", prefix="report_heatmap_")
-            output_path = temp_file.name
-            temp_file.close()
+            logger.info(f"Масштабировано до {max_width}x{new_height}")
         
         cropped_img.save(output_path, format="PNG")
-        print(f"Обработанная тепловая карта сохранена как {output_path}")
+        logger.info(f"Обработанная тепловая карта сохранена как {output_path}")
         return output_path
         
     except Exception as e:
-        print(f"Ошибка при обработке тепловой карты: {e}")
+        logger.error(f"Ошибка при обработке тепловой карты: {e}")
         return None
 
-def generate_heatmap_section(data, heatmap_path):
+def generate_heatmap_section(data, heatmap_path, report_dir='.'):
     """Генерирует раздел с тепловой картой для отчета."""
     if not heatmap_path or not os.path.exists(heatmap_path):
         return ""
     
     # Обрабатываем тепловую карту
-    report_dir = os.path.dirname(latex_path) if 'latex_path' in globals() and latex_path else '.'
     images_subdir = os.path.join(report_dir, "report_images")
     if not os.path.exists(images_subdir):
         try:
@@ -508,68 +527,75 @@ def generate_component_table(data):
 """
     return section
 
-def generate_detailed_category_sections(data):
-    """Generate detailed sections for each category using 1-100 scale."""
+def generate_detailed_category_sections(data, report_dir='.', image=None):
+    """Generate detailed sections for each category using 1-100 scale.
+
+    `image` is the ImageContext of the screenshot, if the caller already has one;
+    otherwise the screenshot is decoded here, once for all problem crops.
+    """
     complexity_scores = data.get("complexityScores", {})
     problem_areas = data.get("problemAreas", [])
     coordinates = data.get("coordinates", {}).get("element_coordinates", [])
     image_path = data.get("metaInfo", {}).get("imagePath", "")
+    heatmap_path = data.get("metaInfo", {}).get("heatmapPath", "")
     
-    print("--- Debug: Entering generate_detailed_category_sections ---")
-    print(f"  Image path from data: {image_path}")
-    print(f"  Number of coordinates loaded: {len(coordinates)}")
+    logger.debug("--- Debug: Entering generate_detailed_category_sections ---")
+    logger.debug(f"Image path from data: {image_path}")
+    logger.debug(f"Number of coordinates loaded: {len(coordinates)}")
     
     coordinate_map = {}
     if coordinates and image_path:
         if not os.path.exists(image_path):
-            print(f"  ERROR: Image path {image_path} does not exist! Cannot create coordinate map.")
+            logger.error(f"Image path {image_path} does not exist! Cannot create coordinate map.")
         else:
-            print(f"  Image exists at {image_path}. Creating coordinate map...")
+            logger.debug(f"Image exists at {image_path}. Creating coordinate map...")
             for coord in coordinates:
                 element_id = coord.get("id") 
                 if element_id:
                     coordinate_map[str(element_id)] = coord # Ensure key is string
-            print(f"  Coordinate map created with {len(coordinate_map)} entries.")
+            logger.debug(f"Coordinate map created with {len(coordinate_map)} entries.")
+            if image is None:
+                image = ImageContext(image_path)
     else:
-        print("  Coordinates or image path missing, coordinate map not created.")
+        logger.debug("Coordinates or image path missing, coordinate map not created.")
 
     def get_problem_image(problem, original_image_path):
-        print(f"\nAttempting to find image for problem ID: {problem.get('id', 'N/A')} (Subcategory: {problem.get('subcategory', 'N/A')})")
+        logger.debug(f"Attempting to find image for problem ID: {problem.get('id', 'N/A')} (Subcategory: {problem.get('subcategory', 'N/A')})")
         if not coordinate_map:
-            print("  Coordinate map is empty.")
+            logger.debug("Coordinate map is empty.")
             return None
         if not os.path.exists(original_image_path):
-            print(f"  Original image path does not exist: {original_image_path}")
+            logger.debug(f"Original image path does not exist: {original_image_path}")
             return None
             
         problem_id = str(problem.get("id")) 
         if not problem_id:
-             print("  Problem has no ID. Cannot find coordinates.")
+             logger.debug("Problem has no ID. Cannot find coordinates.")
              return None
              
         matched_coord_data = coordinate_map.get(problem_id)
         
         if not matched_coord_data:
-             print(f"  No coordinates found in map for problem ID '{problem_id}'.")
+             logger.debug(f"No coordinates found in map for problem ID '{problem_id}'.")
              return None
              
-        print(f"  Found coordinate data for ID '{problem_id}': {matched_coord_data}")
+        logger.debug(f"Found coordinate data for ID '{problem_id}': {matched_coord_data}")
         bounds = matched_coord_data.get("coordinates")
         
         if bounds is None:
-            print(f"  Coordinates for ID '{problem_id}' are null. Skipping image.")
+            logger.warning(f"Coordinates for ID '{problem_id}' are null. Skipping image.")
             return None
             
         if bounds: 
             try:
-                original_img = Image.open(original_image_path)
+                original_img = image.image() # Decoded once, shared by all problems
                 
                 if not (isinstance(bounds, list) and len(bounds) == 4 and all(isinstance(b, (int, float)) for b in bounds)):
-                     print(f"    Invalid bounding box format: {bounds}. Skipping image.")
+                     logger.warning(f"Invalid bounding box format: {bounds}. Skipping image.")
                      return None
                 
                 if all(0 <= b <= 1 for b in bounds):
-                    print(f"    Warning: bounds seem to be in 0-1 range: {bounds}. Converting to 0-1000.")
+                    logger.warning(f"Warning: bounds seem to be in 0-1 range: {bounds}. Converting to 0-1000.")
                     bounds = [b * 1000 for b in bounds]
                 
                 if all(0 <= b <= 1000 for b in bounds):
@@ -584,9 +610,9 @@ def generate_detailed_category_sections(data):
                         int(y_max * height / 1000), 
                         int(x_max * width / 1000)
                     ]
-                    print(f"    Converted normalized bounds {bounds} to pixel bounds {pixel_bounds}")
+                    logger.debug(f"Converted normalized bounds {bounds} to pixel bounds {pixel_bounds}")
                 else:
-                    print(f"    Using bounds as pixel coordinates: {bounds}")
+                    logger.debug(f"Using bounds as pixel coordinates: {bounds}")
                     pixel_bounds = [int(b) for b in bounds]
                 
                 padding = 30 
@@ -594,12 +620,12 @@ def generate_detailed_category_sections(data):
                 
                 # Проверка на корректность координат
                 if x_min_p >= x_max_p or y_min_p >= y_max_p:
-                    print(f"    Degenerate pixel bounds: {pixel_bounds}. Skipping image.")
+                    logger.warning(f"Degenerate pixel bounds: {pixel_bounds}. Skipping image.")
                     return None
                 
                 # Проверим, может быть координаты перепутаны местами
                 if x_max_p - x_min_p < 10 or y_max_p - y_min_p < 10:
-                    print(f"    Very small bounding box. Swapping coordinates to try to fix.")
+                    logger.debug("Very small bounding box. Swapping coordinates to try to fix.")
                     # Попробуем поменять xy местами
                     x_min_p, y_min_p, x_max_p, y_max_p = y_min_p, x_min_p, y_max_p, x_max_p
                     pixel_bounds = [y_min_p, x_min_p, y_max_p, x_max_p]
@@ -610,7 +636,7 @@ def generate_detailed_category_sections(data):
                 y_max_crop = min(height, y_max_p + padding)
                 x_max_crop = min(width, x_max_p + padding)
                 
-                print(f"    Cropping area (with padding): ({x_min_crop}, {y_min_crop}, {x_max_crop}, {y_max_crop})")
+                logger.debug(f"Cropping area (with padding): ({x_min_crop}, {y_min_crop}, {x_max_crop}, {y_max_crop})")
                 cropped_img = original_img.crop((x_min_crop, y_min_crop, x_max_crop, y_max_crop))
                 
                 from PIL import ImageDraw
@@ -621,18 +647,17 @@ def generate_detailed_category_sections(data):
                 rect_y_max = y_max_p - y_min_crop
                 draw.rectangle([rect_x_min, rect_y_min, rect_x_max, rect_y_max], outline="red", width=3)
                 
-                report_dir = os.path.dirname(latex_path) if 'latex_path' in globals() and latex_path else '.'
                 images_subdir = os.path.join(report_dir, "report_images")
                 if not os.path.exists(images_subdir):
                     try:
                         os.makedirs(images_subdir)
-                        print(f"    Created image subdirectory: {images_subdir}")
+                        logger.debug(f"Created image subdirectory: {images_subdir}")
                     except OSError as e:
-                        print(f"    ERROR: Could not create image subdirectory {images_subdir}: {e}. Saving to report dir.")
+                        logger.error(f"Could not create image subdirectory {images_subdir}: {e}. Saving to report dir.")
                         images_subdir = report_dir 
                 
                 if not os.path.isdir(images_subdir):
-                     print(f"    ERROR: Target image directory is not valid: {images_subdir}. Cannot save image.")
+                     logger.error(f"Target image directory is not valid: {images_subdir}. Cannot save image.")
                      return None
                      
                 temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png", dir=images_subdir, prefix="problem_img_")
@@ -640,17 +665,26 @@ def generate_detailed_category_sections(data):
                 cropped_img.save(temp_path, format="PNG")
                 temp_file.close() 
                 
-                report_dir = os.path.dirname(latex_path) if 'latex_path' in globals() and latex_path else '.'
                 relative_image_dir_path = os.path.relpath(images_subdir, report_dir)
                 relative_image_path = os.path.join(relative_image_dir_path, os.path.basename(temp_path))
                 return relative_image_path.replace("\\", "/")
             except Exception as e:
-                print(f"    Error processing image for problem: {e}")
+                logger.error(f"Error processing image for problem: {e}")
         else:
-            print("  No suitable coordinate match found for this problem.")
+            logger.debug("No suitable coordinate match found for this problem.")
         
         return None
     
+    def get_category_heatmap(category_key):
+        """Слой тепловой карты категории, отрисованный вместе с основной картой (без пересчета)."""
+        if not heatmap_path:
+            return None
+        category_heatmap = heatmap_engine.category_heatmap_path(heatmap_path, category_key)
+        if not os.path.exists(category_heatmap):
+            logger.debug(f"Нет тепловой карты категории {category_key}: {category_heatmap}")
+            return None
+        return os.path.relpath(category_heatmap, report_dir).replace("\\", "/")
+    
     category_mapping = {
         "структурная визуальная организация": ["структур", "организац"],
         "визуальная перцептивная сложность": ["визуал", "перцептив"],
@@ -672,10 +706,10 @@ def generate_detailed_category_sections(data):
         
         for full_name, substrings in category_mapping.items():
             if any(substr in category_text for substr in substrings):
-                print(f"  [Category Match Debug] Matched '{category_text}' to '{full_name}' by substring")
+                logger.debug(f"[Category Match Debug] Matched '{category_text}' to '{full_name}' by substring")
                 return full_name
                 
-        print(f"  [Category Match Debug] Could not match category: '{category_text}'") 
+        logger.debug(f"[Category Match Debug] Could not match category: '{category_text}'")
         return "другое"  
     
     categories = [
@@ -690,7 +724,7 @@ def generate_detailed_category_sections(data):
     all_sections = ""
     
     for category_key, category_name in categories:
-        print(f"--- Debug: Processing category: {category_name} ({category_key}) ---")
+        logger.debug(f"--- Debug: Processing category: {category_name} ({category_key}) ---")
         category_data = complexity_scores.get(category_key, {})
         category_score = category_data.get("score", 0)
         category_reasoning = category_data.get("reasoning", "")
@@ -702,7 +736,7 @@ def generate_detailed_category_sections(data):
             if determine_category(problem) == category_name.lower()
         ]
         category_problems.sort(key=lambda x: x.get("severity", 0), reverse=True)
-        print(f"  Found {len(category_problems)} problems for this category.")
+        logger.debug(f"Found {len(category_problems)} problems for this category.")
         
         components_text = ""
         for component, score in components_data.items():
@@ -730,14 +764,14 @@ def generate_detailed_category_sections(data):
         
         problems_text = ""
         for i, problem in enumerate(category_problems):
-            print(f"  Processing problem {i+1}/{len(category_problems)}: {problem.get('subcategory', 'N/A')}")
+            logger.debug(f"Processing problem {i+1}/{len(category_problems)}: {problem.get('subcategory', 'N/A')}")
             subcategory = problem.get("subcategory", "")
             description = problem.get("description", "")
             severity = problem.get("severity", 0)
             location = problem.get("location", "")
             reasoning = problem.get("scientificReasoning", "")
             
-            print(f"    Calling get_problem_image for problem subcategory: {subcategory}")
+            logger.debug(f"Calling get_problem_image for problem subcategory: {subcategory}")
             image_path_for_problem = get_problem_image(problem, image_path)
             image_latex = ""
             if image_path_for_problem:
@@ -773,6 +807,18 @@ def generate_detailed_category_sections(data):
 \\end{{itemize}}
 {image_latex}
 \\end{{tcolorbox}}
+"""
+        
+        category_heatmap_latex = ""
+        category_heatmap = get_category_heatmap(category_key)
+        if category_heatmap:
+            category_heatmap_latex = f"""
+\\begin{{figure}}[H]
+\\centering
+\\includegraphics[width=0.8\\textwidth, height=0.6\\textheight, keepaspectratio]{{{category_heatmap}}}
+\\caption{{Тепловая карта проблем категории: {sanitize_latex(category_name)}}}
+\\label{{fig:heatmap_{category_key}}}
+\\end{{figure}}
 """
         
         section = f"""
@@ -780,7 +826,7 @@ def generate_detailed_category_sections(data):
 
 \\subsection{{Общая оценка: {category_score:.0f}/100}} 
 {sanitize_latex(category_reasoning)}
-
+{category_heatmap_latex}
 \\subsection{{Компоненты}}
 {components_text}
 
@@ -819,11 +865,14 @@ def generate_conclusions(data):
 """
     return section
 
-def generate_latex_document(data):
-    """Generate the complete LaTeX document."""
+def generate_latex_document(data, report_dir='.', image=None):
+    """Generate the complete LaTeX document.
+
+    Images referenced by the report are written to ``report_dir/report_images``
+    and included by paths relative to ``report_dir``. ``image`` is an optional
+    ImageContext of the screenshot (see generate_detailed_category_sections).
+    """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
-    global latex_path 
-    latex_path = "" 
     
     latex_document = f"""
 \\documentclass[10pt, a4paper]{{article}}
@@ -888,11 +937,11 @@ def generate_latex_document(data):
 
 {generate_introduction(data)}
 {generate_overall_score_section(data)}
-{generate_heatmap_section(data, data.get("metaInfo", {}).get("heatmapPath"))}
+{generate_heatmap_section(data, data.get("metaInfo", {}).get("heatmapPath"), report_dir)}
 {generate_key_findings(data)}
 {generate_category_scores(data)}
 {generate_component_table(data)}
-{generate_detailed_category_sections(data)}
+{generate_detailed_category_sections(data, report_dir, image)}
 {generate_conclusions(data)}
 
 \\end{{document}}
@@ -901,19 +950,18 @@ def generate_latex_document(data):
 
 def save_latex_to_file(content, output_path):
     """Save the generated LaTeX content to a file."""
-    global latex_path
-    latex_path = os.path.abspath(output_path)
     try:
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(content)
-        print(f"LaTeX report saved to {output_path}")
+        logger.info(f"LaTeX report saved to {output_path}")
         return True
     except Exception as e:
-        print(f"Error saving LaTeX file: {e}")
+        logger.error(f"Error saving LaTeX file: {e}")
         return False
 
 def generate_pdf(latex_path):
     """Generate PDF from LaTeX using Python."""
+    latex_path = os.path.abspath(latex_path)
     pdf_path = latex_path.replace(".tex", ".pdf")
     log_path = latex_path.replace(".tex", ".log") # Define log file path
     aux_path = latex_path.replace(".tex", ".aux") # Define aux file path
@@ -925,23 +973,23 @@ def generate_pdf(latex_path):
     if not os.path.exists(images_subdir):
         try:
             os.makedirs(images_subdir)
-            print(f"Created directory for images: {images_subdir}")
+            logger.info(f"Created directory for images: {images_subdir}")
         except OSError as e:
-            print(f"Error creating directory {images_subdir}: {e}")
+            logger.error(f"Error creating directory {images_subdir}: {e}")
             pass 
     
     pdflatex_path = shutil.which("pdflatex")
     if not pdflatex_path:
         if os.path.exists("/Library/TeX/texbin/pdflatex"):
             pdflatex_path = "/Library/TeX/texbin/pdflatex"
-            print(f"Using pdflatex from /Library/TeX/texbin/")
+            logger.info("Using pdflatex from /Library/TeX/texbin/")
     
     pdf_generated_successfully = False
     if pdflatex_path:
         try:
             final_return_code = 0
             for i in range(2):
-                print(f"Running pdflatex attempt {i+1}...")
+                logger.info(f"Running pdflatex attempt {i+1}...")
                 # Ensure output directory exists for pdflatex
                 os.makedirs(report_dir, exist_ok=True)
                 result = subprocess.run(
@@ -949,24 +997,25 @@ def generate_pdf(latex_path):
                      "-interaction=nonstopmode",
                      "-output-directory", report_dir, # Ensure output goes here
                       latex_path],
-                    capture_output=True, text=False, check=False # text=False to handle potential encoding issues in log
+                    capture_output=True, text=False, check=False, # text=False to handle potential encoding issues in log
+                    cwd=report_dir # Image paths in the .tex are relative to the report directory
                 )
                 final_return_code = result.returncode # Store the code from the last run
                 if result.returncode != 0:
-                    print(f"Warning: pdflatex (attempt {i+1}) returned non-zero exit code: {result.returncode}")
+                    logger.warning(f"Warning: pdflatex (attempt {i+1}) returned non-zero exit code: {result.returncode}")
                     # Don't break, try second run for references
                 else:
-                    print(f"pdflatex attempt {i+1} successful.")
+                    logger.info(f"pdflatex attempt {i+1} successful.")
             
             # Check final status after potentially two runs
             if os.path.exists(pdf_path) and final_return_code == 0:
-                print(f"PDF successfully generated at {pdf_path}")
+                logger.info(f"PDF successfully generated at {pdf_path}")
                 pdf_generated_successfully = True
             else:
-                print(f"PDF generation failed or pdflatex reported errors (last exit code: {final_return_code}).")
+                logger.error(f"PDF generation failed or pdflatex reported errors (last exit code: {final_return_code}).")
                 # --- Read and print last part of log file on error --- START ---
                 if os.path.exists(log_path):
-                    print(f"--- Last lines of {os.path.basename(log_path)}: ---")
+                    logger.error(f"--- Last lines of {os.path.basename(log_path)}: ---")
                     try:
                         with open(log_path, 'r', encoding='utf-8', errors='ignore') as log_file:
                             lines = log_file.readlines()
@@ -975,15 +1024,15 @@ def generate_pdf(latex_path):
                                 sys.stderr.write(line)
                         sys.stderr.flush()
                     except Exception as log_e:
-                        print(f"Error reading log file {log_path}: {log_e}", file=sys.stderr)
+                        logger.error(f"Error reading log file {log_path}: {log_e}")
                 else:
-                     print(f"Log file {log_path} not found.", file=sys.stderr)
+                     logger.error(f"Log file {log_path} not found.")
                 # --- Read and print last part of log file on error --- END ---
 
         except Exception as e:
-            print(f"Error running pdflatex: {e}")
+            logger.error(f"Error running pdflatex: {e}")
     else:
-        print("pdflatex not found in system PATH or in /Library/TeX/texbin/.")
+        logger.error("pdflatex not found in system PATH or in /Library/TeX/texbin/.")
     
     # --- Cleanup Logic --- START ---
     # Clean up aux/log/toc/out files regardless of success
@@ -993,103 +1042,128 @@ def generate_pdf(latex_path):
                 os.remove(ext_path)
                 # print(f"Removed temporary file: {os.path.basename(ext_path)}")
             except OSError as e:
-                print(f"Warning: Could not remove temporary file {ext_path}: {e}")
+                logger.warning(f"Warning: Could not remove temporary file {ext_path}: {e}")
                 
     # Clean up image directory if it was created and is empty
     # Keep images if PDF generation failed for debugging
     if pdf_generated_successfully:
-        print(f"Cleaning up temporary images from {images_subdir}...")
+        logger.info(f"Cleaning up temporary images from {images_subdir}...")
         if os.path.exists(images_subdir) and os.path.isdir(images_subdir):
             try:
                 shutil.rmtree(images_subdir) # Remove directory and its contents
-                print(f"Removed temporary image directory: {images_subdir}")
+                logger.info(f"Removed temporary image directory: {images_subdir}")
             except OSError as e:
-                 print(f"Warning: Could not remove image directory {images_subdir}: {e}")
+                 logger.warning(f"Warning: Could not remove image directory {images_subdir}: {e}")
     else:
-         print(f"Skipping image cleanup as PDF generation failed ({images_subdir}).")
+         logger.warning(f"Skipping image cleanup as PDF generation failed ({images_subdir}).")
     # --- Cleanup Logic --- END ---
     
     return pdf_generated_successfully
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate LaTeX report from GPT analysis data")
-    parser.add_argument('--input', '-i', type=str, required=True, help="Path to JSON file with GPT analysis data")
-    parser.add_argument('--output', '-o', type=str, default="ui_analysis_report", help="Base output path for report files (e.g., /path/to/report_base)")
-    parser.add_argument('--pdf', '-p', action='store_true', help="Try to generate PDF after creating LaTeX file")
-    parser.add_argument('--gemini-data', '-g', type=str, help="Path to JSON file with Gemini coordinates data")
-    parser.add_argument('--image', '-img', type=str, help="Path to the analyzed image for illustrations")
-    parser.add_argument('--heatmap', type=str, help="Path to the heatmap image for report visualization")
-    args = parser.parse_args()
+def generate_report(input_path, output_base_path, image_path=None, gemini_data_path=None,
+                    heatmap_path=None, pdf=True, image=None):
+    """Generate the LaTeX (and optionally PDF) report in-process.
+
+    ``image`` is the pipeline run's ImageContext of ``image_path``, so the
+    screenshot decoded by earlier stages is reused.
 
+    Returns:
+        tuple: (str | None, str | None): (tex_path, pdf_path); either is None if it was not produced.
+    """
     # --- Determine full .tex path --- START ---    
-    output_base_path = args.output
     # Ensure the base path doesn't somehow end with .tex already
     if output_base_path.lower().endswith('.tex'):
         output_base_path = output_base_path[:-4]
         
     # Construct the explicit .tex file path
-    latex_output_path = f"{output_base_path}.tex"
+    latex_output_path = os.path.abspath(f"{output_base_path}.tex")
+    report_dir = os.path.dirname(latex_output_path)
     # --- Determine full .tex path --- END ---
     
-    print("--- Debug: Starting main function ---")
-    print(f"  Input GPT data: {args.input}")
-    print(f"  Output .tex file: {latex_output_path}")
-    print(f"  Generate PDF: {args.pdf}")
-    print(f"  Gemini data file: {args.gemini_data}")
-    print(f"  Image file: {args.image}")
-    print(f"  Heatmap file: {args.heatmap}")
+    logger.debug("--- Debug: Starting report generation ---")
+    logger.debug(f"Input GPT data: {input_path}")
+    logger.debug(f"Output .tex file: {latex_output_path}")
+    logger.debug(f"Generate PDF: {pdf}")
+    logger.debug(f"Gemini data file: {gemini_data_path}")
+    logger.debug(f"Image file: {image_path}")
+    logger.debug(f"Heatmap file: {heatmap_path}")
     
-    data = load_analysis_data(args.input)
+    data = load_analysis_data(input_path)
     if not data:
-        print("Failed to load analysis data. Exiting.")
-        return
-    print(f"  GPT data loaded successfully.")
+        logger.error("Failed to load analysis data. Exiting.")
+        return None, None
+    logger.debug("GPT data loaded successfully.")
     
-    if args.gemini_data and os.path.exists(args.gemini_data):
-        print(f"  Attempting to load Gemini data from {args.gemini_data}...")
+    if gemini_data_path and os.path.exists(gemini_data_path):
+        logger.debug(f"Attempting to load Gemini data from {gemini_data_path}...")
         try:
-            with open(args.gemini_data, 'r', encoding='utf-8') as f:
+            with open(gemini_data_path, 'r', encoding='utf-8') as f:
                 gemini_data = json.load(f)
                 if isinstance(gemini_data, dict) and "element_coordinates" in gemini_data:
                     data["coordinates"] = gemini_data
-                    print(f"  Loaded coordinates data from {args.gemini_data}. Found {len(gemini_data['element_coordinates'])} elements.")
+                    logger.debug(f"Loaded coordinates data from {gemini_data_path}. Found {len(gemini_data['element_coordinates'])} elements.")
                 else:
-                    print(f"  ERROR: Gemini data file {args.gemini_data} has unexpected structure. Expected a dict with 'element_coordinates'.")
+                    logger.error(f"Gemini data file {gemini_data_path} has unexpected structure. Expected a dict with 'element_coordinates'.")
         except Exception as e:
-            print(f"  ERROR: Error loading Gemini data: {e}")
-    elif args.gemini_data:
-        print(f"  WARNING: Gemini data file not found at {args.gemini_data}")
+            logger.error(f"Error loading Gemini data: {e}")
+    elif gemini_data_path:
+        logger.warning(f"Gemini data file not found at {gemini_data_path}")
     else:
-        print("  No Gemini data file provided.")
+        logger.debug("No Gemini data file provided.")
         
-    if args.image and os.path.exists(args.image):
-        print(f"  Image file found at {args.image}. Adding path to data.")
+    if image_path and os.path.exists(image_path):
+        logger.debug(f"Image file found at {image_path}. Adding path to data.")
         if "metaInfo" not in data: data["metaInfo"] = {}
-        data["metaInfo"]["imagePath"] = os.path.abspath(args.image)
-        print(f"  Added absolute image path to data: {data['metaInfo']['imagePath']}")
-    elif args.image:
-         print(f"  WARNING: Image file not found at {args.image}")
+        data["metaInfo"]["imagePath"] = os.path.abspath(image_path)
+        logger.debug(f"Added absolute image path to data: {data['metaInfo']['imagePath']}")
+    elif image_path:
+         logger.warning(f"Image file not found at {image_path}")
     else:
-        print("  No image file provided.")
+        logger.debug("No image file provided.")
         
     # Добавляем путь к тепловой карте в данные
-    if args.heatmap and os.path.exists(args.heatmap):
-        print(f"  Heatmap file found at {args.heatmap}. Adding path to data.")
+    if heatmap_path and os.path.exists(heatmap_path):
+        logger.debug(f"Heatmap file found at {heatmap_path}. Adding path to data.")
         if "metaInfo" not in data: data["metaInfo"] = {}
-        data["metaInfo"]["heatmapPath"] = os.path.abspath(args.heatmap)
-    elif args.heatmap:
-        print(f"  WARNING: Heatmap file not found at {args.heatmap}")
+        data["metaInfo"]["heatmapPath"] = os.path.abspath(heatmap_path)
+    elif heatmap_path:
+        logger.warning(f"Heatmap file not found at {heatmap_path}")
     
-    print("--- Debug: Proceeding to generate LaTeX document ---")
-    latex_content = generate_latex_document(data)
+    logger.debug("--- Debug: Proceeding to generate LaTeX document ---")
+    latex_content = generate_latex_document(data, report_dir, image)
     
-    if save_latex_to_file(latex_content, latex_output_path):
-        print(f"Report generation complete. LaTeX file saved to {latex_output_path}")
-        if args.pdf:
-            generate_pdf(latex_output_path)
-        else:
-            print(f"To convert to PDF, run: pdflatex {os.path.basename(latex_output_path)}")
-            print("Or run this script with --pdf flag.")
+    if not save_latex_to_file(latex_content, latex_output_path):
+        return None, None
+    logger.info(f"Report generation complete. LaTeX file saved to {latex_output_path}")
+    if not pdf:
+        logger.info(f"To convert to PDF, run: pdflatex {os.path.basename(latex_output_path)}")
+        logger.info("Or run this script with --pdf flag.")
+        return latex_output_path, None
+    if generate_pdf(latex_output_path):
+        return latex_output_path, latex_output_path[:-4] + ".pdf"
+    return latex_output_path, None
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate LaTeX report from GPT analysis data")
+    parser.add_argument('--input', '-i', type=str, required=True, help="Path to JSON file with GPT analysis data")
+    parser.add_argument('--output', '-o', type=str, default="ui_analysis_report", help="Base output path for report files (e.g., /path/to/report_base)")
+    parser.add_argument('--pdf', '-p', action='store_true', help="Try to generate PDF after creating LaTeX file")
+    parser.add_argument('--gemini-data', '-g', type=str, help="Path to JSON file with Gemini coordinates data")
+    parser.add_argument('--image', '-img', type=str, help="Path to the analyzed image for illustrations")
+    parser.add_argument('--heatmap', type=str, help="Path to the heatmap image for report visualization")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.INFO)
+
+    tex_path, _ = generate_report(
+        args.input,
+        args.output,
+        image_path=args.image,
+        gemini_data_path=args.gemini_data,
+        heatmap_path=args.heatmap,
+        pdf=args.pdf,
+    )
+    if not tex_path:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -9,26 +9,32 @@ to obtain insights and recommendations based on the analysis data.
 
 import os
 import json
+import asyncio
 import argparse
-from dotenv import load_dotenv
-# Assuming google.generativeai will be used for the API call
-import google.generativeai as genai
+import logging
+from api_clients import configure_gemini, get_gemini_model
+from llm_cache import llm_cache, LLMCache, LLMCacheMiss
+
+logger = logging.getLogger(__name__)
+
+# Use the exact model name provided
+GEMINI_MODEL = 'gemini-2.5-pro-preview-03-25'
 
 def load_gpt_analysis(json_file_path):
     """Load analysis data from the GPT-4.1 JSON file."""
     try:
         with open(json_file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-        print(f"Successfully loaded GPT analysis data from: {json_file_path}")
+        logger.debug(f"Successfully loaded GPT analysis data from: {json_file_path}")
         return data
     except FileNotFoundError:
-        print(f"Error: Input JSON file not found at {json_file_path}")
+        logger.error(f"Error: Input JSON file not found at {json_file_path}")
         return None
     except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {json_file_path}")
+        logger.error(f"Error: Could not decode JSON from {json_file_path}")
         return None
     except Exception as e:
-        print(f"An unexpected error occurred while loading JSON: {e}")
+        logger.error(f"An unexpected error occurred while loading JSON: {e}")
         return None
 
 def load_prompt(prompt_file_path):
@@ -40,29 +46,21 @@ def load_prompt(prompt_file_path):
             if prompt_content.startswith('<prompt>') and prompt_content.endswith('</prompt>'):
                  prompt_content = prompt_content[len('<prompt>'):-len('</prompt>')].strip()
             prompt = prompt_content
-        print(f"Successfully loaded prompt from: {prompt_file_path}")
+        logger.debug(f"Successfully loaded prompt from: {prompt_file_path}")
         return prompt
     except FileNotFoundError:
-        print(f"Error: Prompt file not found at {prompt_file_path}")
+        logger.error(f"Error: Prompt file not found at {prompt_file_path}")
         return None
     except Exception as e:
-        print(f"An unexpected error occurred while loading the prompt: {e}")
+        logger.error(f"An unexpected error occurred while loading the prompt: {e}")
         return None
 
-def query_gemini(prompt_template, analysis_data):
+async def query_gemini_async(prompt_template, analysis_data):
     """Query the Gemini API with the analysis data and prompt."""
-    print("\n--- Querying Gemini API ---")
+    logger.info("--- Querying Gemini API ---")
     
-    # 1. Configure the Gemini API client
-    load_dotenv()
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        print("Error: GEMINI_API_KEY not found in environment variables.")
-        return None
-    try:
-        genai.configure(api_key=api_key)
-    except Exception as e:
-        print(f"Error configuring Gemini API: {e}")
+    # 1. Configure the Gemini API client (no-op after the first call)
+    if not configure_gemini():
         return None
         
     # 2. Prepare the combined prompt
@@ -71,24 +69,23 @@ def query_gemini(prompt_template, analysis_data):
         # Use str.replace instead of format to avoid issues with {} in JSON
         full_prompt = prompt_template.replace("{analysis_json}", formatted_data)
     except Exception as e:
-        print(f"Error formatting prompt with analysis data: {e}")
+        logger.error(f"Error formatting prompt with analysis data: {e}")
         return None
         
     # 3. Select the Gemini model
-    # Use the exact model name provided
-    model_name = 'gemini-2.5-pro-preview-03-25'
+    model_name = GEMINI_MODEL
     try:
-        model = genai.GenerativeModel(model_name)
-        print(f"Using Gemini model: {model_name}")
+        model = get_gemini_model(model_name) # Shared per-process async client
+        logger.debug(f"Using Gemini model: {model_name}")
     except Exception as e:
-        print(f"Error creating Gemini model instance: {e}")
+        logger.error(f"Error creating Gemini model instance: {e}")
         return None
 
-    # 4. Make the API call
-    try:
-        print("Sending request to Gemini...")
+    # 4. Make the API call (through the LLM response cache)
+    async def request_response():
+        logger.debug("Sending request to Gemini...")
         # Add safety settings if needed, otherwise use defaults
-        response = model.generate_content(
+        response = await model.generate_content_async(
             full_prompt,
             # safety_settings=[
             #     { "category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE" },
@@ -97,7 +94,7 @@ def query_gemini(prompt_template, analysis_data):
             #     { "category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE" },
             # ]
         )
-        print("Received response from Gemini.")
+        logger.debug("Received response from Gemini.")
         
         # Basic check if response has text (might need more robust checks)
         if hasattr(response, 'text'):
@@ -109,17 +106,66 @@ def query_gemini(prompt_template, analysis_data):
                 cleaned_response = cleaned_response[:-len('```')].strip()
             return cleaned_response
         elif hasattr(response, 'prompt_feedback'):
-             print(f"Gemini request blocked. Feedback: {response.prompt_feedback}")
+             logger.error(f"Gemini request blocked. Feedback: {response.prompt_feedback}")
              return None
         else:
-             print("Gemini response structure unexpected or missing text.")
-             print(f"Full response object: {response}")
+             logger.error("Gemini response structure unexpected or missing text.")
+             logger.debug(f"Full response object: {response}")
              return None
-             
+
+    try:
+        cache_key = LLMCache.make_key(model_name, full_prompt)
+        return await llm_cache.fetch(cache_key, request_response, model=model_name)
+    except LLMCacheMiss:
+        raise
     except Exception as e:
-        print(f"Error during Gemini API call: {e}")
+        logger.error(f"Error during Gemini API call: {e}")
         return None
 
+def query_gemini(prompt_template, analysis_data):
+    """Synchronous wrapper around `query_gemini_async` (runs its own event loop)."""
+    return asyncio.run(query_gemini_async(prompt_template, analysis_data))
+
+async def generate_gemini_response_async(input_path, prompt_file_path, output_path=None):
+    """Load the GPT analysis and prompt, query Gemini and optionally save the response.
+
+    Returns:
+        bool: True if a response was received (and saved, when output_path is given).
+    """
+    # Load data and prompt
+    analysis_data = load_gpt_analysis(input_path)
+    if not analysis_data:
+        return False
+
+    prompt_template = load_prompt(prompt_file_path)
+    if not prompt_template:
+        return False
+
+    gemini_response_text = await query_gemini_async(prompt_template, analysis_data)
+
+    if not gemini_response_text:
+        logger.error("Failed to get a response from Gemini.")
+        return False
+
+    logger.debug(f"--- Gemini Response ---\n{gemini_response_text}")
+    
+    # Optionally save the response to a file
+    if output_path:
+        try:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                # Assuming the response is already a JSON string
+                # If not, you might need json.dump(json.loads(gemini_response_text), f, ...)
+                f.write(gemini_response_text)
+            logger.info(f"Successfully saved Gemini response to: {output_path}")
+        except Exception as e:
+            logger.error(f"Error saving Gemini response to file: {e}")
+            return False
+    return True
+
+def generate_gemini_response(input_path, prompt_file_path, output_path=None):
+    """Synchronous wrapper around `generate_gemini_response_async` (runs its own event loop)."""
+    return asyncio.run(generate_gemini_response_async(input_path, prompt_file_path, output_path))
+
 def main():
     parser = argparse.ArgumentParser(description="Generate recommendations using Gemini based on GPT analysis.")
     parser.add_argument('--input', '-i', type=str, required=True, 
@@ -131,35 +177,9 @@ def main():
                         help="Optional: Path to save the Gemini response JSON file.")
     
     args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.INFO)
 
-    # Load data and prompt
-    analysis_data = load_gpt_analysis(args.input)
-    if not analysis_data:
-        return
-
-    prompt_template = load_prompt(args.prompt_file)
-    if not prompt_template:
-        return
-
-    # Query Gemini (using placeholder function for now)
-    gemini_response_text = query_gemini(prompt_template, analysis_data)
-
-    if gemini_response_text:
-        print("\n--- Gemini Response ---")
-        print(gemini_response_text)
-        
-        # Optionally save the response to a file
-        if args.output:
-            try:
-                with open(args.output, 'w', encoding='utf-8') as f:
-                    # Assuming the response is already a JSON string
-                    # If not, you might need json.dump(json.loads(gemini_response_text), f, ...)
-                    f.write(gemini_response_text)
-                print(f"\nSuccessfully saved Gemini response to: {args.output}")
-            except Exception as e:
-                print(f"Error saving Gemini response to file: {e}")
-    else:
-        print("\nFailed to get a response from Gemini.")
+    generate_gemini_response(args.input, args.prompt_file, args.output)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,886 @@
+#!/usr/bin/env python3
+"""
+Heatmap accumulation and rendering for the problem areas found by GPT + Gemini.
+"""
+
+import os
+import math
+import zlib
+import struct
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import matplotlib
+from matplotlib import colormaps
+from PIL import Image, ImageDraw, ImageFont
+
+from image_context import flatten_rgb
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEVERITY = 50
+TRUNCATE_SIGMA = 4.0 # Gaussian window half-size in σ; at 3σ the cut edges showed as square steps
+MIN_SIGMA = 3.0 # px
+MIN_HEAT = 1e-9 # Pixels above this count as "hot" for the clip percentile
+CLIP_PERCENTILE = 98
+
+HEATMAP_ALPHA = 0.7
+COLORMAP_LUT = np.round(colormaps["viridis"](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+HEATMAP_TITLE = "Тепловая карта проблемных зон UI"
+LEGEND_LABEL = "Относительная критичность проблемы (Intensity)"
+LEGEND_TICKS = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+LEGEND_ASPECT = 20 # colorbar length / thickness, as matplotlib's default
+# zlib level of the heatmap PNG; 6 (PIL's default) is twice as slow for ~15% less size
+PNG_COMPRESS_LEVEL = 3
+HEATMAP_BAND_ROWS = int(os.getenv("HEATMAP_BAND_ROWS", "1024"))
+HISTOGRAM_BINS = 1 << 16 # log-spaced, from MIN_HEAT to the largest possible heat
+INTENSITY_DTYPE = np.float16 # [0, 1] intensity sidecar; ample for a 256-entry colormap
+HOTSPOT_CELL = 16 # px, grid resolution of the summed-area table
+REPORT_WIDTH = 1800 # px, heatmap width in the LaTeX report
+PREVIEW_MAX_WIDTH = 1280
+PREVIEW_MAX_DIMENSION_SUM = 10000 # Telegram rejects photos whose width + height is larger
+PREVIEW_JPEG_QUALITY = 85
+# (complexityScores key, GPT problemArea category) of each category layer
+HEATMAP_CATEGORIES = (
+    ("structuralVisualOrganization", "Structural Visual Organization"),
+    ("visualPerceptualComplexity", "Visual Perceptual Complexity"),
+    ("typographicComplexity", "Typographic Complexity"),
+    ("informationLoad", "Information Load"),
+    ("cognitiveLoad", "Cognitive Load"),
+    ("operationalComplexity", "Operational Complexity"),
+)
+CATEGORY_KEYS = tuple(key for key, _ in HEATMAP_CATEGORIES)
+CATEGORY_WINDOW_ROWS = 1500 # source rows of one window of a category figure
+CATEGORY_MAX_WINDOWS = 2
+CATEGORY_JPEG_QUALITY = 90
+FONT_PATH = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans.ttf")
+
+
+@dataclass(frozen=True)
+class HeatSource:
+    """One Gaussian of the heatmap, in pixels."""
+    center_x: int
+    center_y: int
+    sigma: float
+    weight: float
+    element_id: Optional[str] = None
+    category: Optional[str] = None # key from CATEGORY_KEYS
+
+    def scaled(self, scale):
+        """The same source in an image resized by `scale`."""
+        return HeatSource(round(self.center_x * scale), round(self.center_y * scale), self.sigma * scale,
+                          self.weight, self.element_id, self.category)
+
+    def window(self, radius, height, width):
+        """Clipped (y0, y1, x0, x1) of the square of the given radius around the center."""
+        r = int(math.ceil(radius))
+        return (max(0, self.center_y - r), min(height, self.center_y + r + 1),
+                max(0, self.center_x - r), min(width, self.center_x + r + 1))
+
+
+def category_key(category):
+    """CATEGORY_KEYS entry for a GPT category name (or key), case-insensitive; None if unknown."""
+    if not isinstance(category, str):
+        return None
+    category = category.strip().lower()
+    for key, name in HEATMAP_CATEGORIES:
+        if category in (key.lower(), name.lower()):
+            return key
+    return None
+
+
+def heat_sources(coordinates_data, gpt_result_data, width, height):
+    """Converts Gemini boxes (0-1000, [y_min, x_min, y_max, x_max]) into HeatSources.
+
+    Severity and category come from the GPT problem area with the same id
+    (default severity 50, no category). Boxes that are missing or empty
+    after clamping to the image are skipped.
+    """
+    severities, categories = {}, {}
+    if gpt_result_data and "problemAreas" in gpt_result_data:
+        for area in gpt_result_data["problemAreas"]:
+            severities[str(area["id"])] = area.get("severity", DEFAULT_SEVERITY)
+            categories[str(area["id"])] = category_key(area.get("category"))
+
+    sources = []
+    for element in (coordinates_data or {}).get("element_coordinates", []):
+        coords_norm = element.get("coordinates")
+        if coords_norm is None:
+            continue
+        element_id = str(element.get("id")) if element.get("id") is not None else None
+        severity = severities.get(element_id, DEFAULT_SEVERITY) if element_id else DEFAULT_SEVERITY
+        try:
+            y_min_norm, x_min_norm, y_max_norm, x_max_norm = coords_norm
+            x1 = max(0, min(int(x_min_norm / 1000 * width), width - 1))
+            y1 = max(0, min(int(y_min_norm / 1000 * height), height - 1))
+            x2 = max(0, min(int(x_max_norm / 1000 * width), width - 1))
+            y2 = max(0, min(int(y_max_norm / 1000 * height), height - 1))
+            weight = float(severity) ** 2
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ошибка обработки координат для элемента {element_id}: {coords_norm}. Ошибка: {e}. Пропуск.")
+            continue
+        if x1 >= x2 or y1 >= y2:
+            continue
+        size = max(x2 - x1, y2 - y1, 1)
+        sources.append(HeatSource(
+            center_x=(x1 + x2) // 2,
+            center_y=(y1 + y2) // 2,
+            sigma=max(size / 10, MIN_SIGMA),
+            weight=weight,
+            element_id=element_id,
+            category=categories.get(element_id),
+        ))
+    return sources
+
+
+def _kernel(start, stop, center, sigma):
+    offsets = np.arange(start - center, stop - center, dtype=np.float32)
+    return np.exp(offsets * offsets / np.float32(-2 * sigma * sigma))
+
+
+def accumulate_layers(sources, height, width, row_start=0, row_end=None, categories=CATEGORY_KEYS):
+    """Sums the windowed Gaussians of the sources into one float32 layer per category.
+
+    Returns an array of shape (len(categories) + 1, rows, width): layer i
+    holds the sources of categories[i], the last one the sources of any
+    other category or of none; the combined heatmap is the sum over the
+    first axis. Only rows [row_start, row_end) of the H×W map are computed
+    (the whole map by default), so the map can be built band by band.
+    """
+    row_end = height if row_end is None else min(row_end, height)
+    channels = {key: index for index, key in enumerate(categories)}
+    layers = np.zeros((len(categories) + 1, row_end - row_start, width), dtype=np.float32)
+    for source in sources:
+        y0, y1, x0, x1 = source.window(TRUNCATE_SIGMA * source.sigma, height, width)
+        y0, y1 = max(y0, row_start), min(y1, row_end)
+        if y0 >= y1 or x0 >= x1:
+            continue
+        column = _kernel(y0, y1, source.center_y, source.sigma) * np.float32(source.weight)
+        row = _kernel(x0, x1, source.center_x, source.sigma)
+        layer = layers[channels.get(source.category, len(categories))]
+        layer[y0 - row_start:y1 - row_start, x0:x1] += np.outer(column, row)
+    return layers
+
+
+def accumulate_heatmap(sources, height, width, row_start=0, row_end=None):
+    """The combined heatmap of all sources (rows [row_start, row_end)) as one float32 array."""
+    return accumulate_layers(sources, height, width, row_start, row_end, categories=())[0]
+
+
+def iter_bands(height, band_rows=HEATMAP_BAND_ROWS):
+    """Yields (row_start, row_end) of consecutive bands covering the height."""
+    band_rows = max(1, band_rows)
+    for row_start in range(0, height, band_rows):
+        yield row_start, min(height, row_start + band_rows)
+
+
+def intensity_path(heatmap_path):
+    """Path of the .npy intensity sidecar of a heatmap PNG."""
+    return os.path.splitext(heatmap_path)[0] + ".npy"
+
+
+def report_heatmap_path(heatmap_path):
+    """Path of the report-width heatmap body (no title or legend) rendered with a heatmap."""
+    return os.path.splitext(heatmap_path)[0] + "_report.png"
+
+
+def preview_heatmap_path(heatmap_path):
+    """Path of the Telegram preview (JPEG) rendered with a heatmap."""
+    return os.path.splitext(heatmap_path)[0] + "_preview.jpg"
+
+
+def category_heatmap_path(heatmap_path, category):
+    """Path of the report figure of one category layer (category key from CATEGORY_KEYS)."""
+    return f"{os.path.splitext(heatmap_path)[0]}_{category}.jpg"
+
+
+def hot_support_size(sources, height, width):
+    """Number of pixels where an untruncated Gaussian of any source exceeds MIN_HEAT.
+
+    Every source covers a disc; each disc row is an interval of pixels. The
+    rows are laid out on one line (row * stride + x) so the size of the
+    union is a 1-D interval union, without an H×W mask.
+    """
+    stride = width + 1
+    starts, ends = [], []
+    for source in sources:
+        if source.weight <= MIN_HEAT:
+            continue
+        radius = source.sigma * math.sqrt(2 * math.log(source.weight / MIN_HEAT))
+        y0, y1, _, _ = source.window(radius, height, width)
+        rows = np.arange(y0, y1, dtype=np.int64)
+        half_widths = np.floor(np.sqrt(np.maximum(radius * radius - (rows - source.center_y) ** 2, 0))).astype(np.int64)
+        x_start = np.maximum(source.center_x - half_widths, 0)
+        x_end = np.minimum(source.center_x + half_widths, width - 1) + 1
+        inside = x_start < x_end
+        starts.append(rows[inside] * stride + x_start[inside])
+        ends.append(rows[inside] * stride + x_end[inside])
+    if not starts:
+        return 0
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    covered_until = np.concatenate(([0], np.maximum.accumulate(ends)[:-1]))
+    return int(np.clip(ends - np.maximum(starts, covered_until), 0, None).sum())
+
+
+class _LevelHistogram:
+    """Log-spaced histogram (bin width 0.03%) of the hot values of one layer, band by band."""
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.max_heat = sum(source.weight for source in sources)
+        self.log_low = math.log(MIN_HEAT)
+        self.bins_per_log = 0.0
+        if self.max_heat > MIN_HEAT:
+            self.bins_per_log = HISTOGRAM_BINS / (math.log(self.max_heat * 1.001) - self.log_low)
+        self.counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        self.low = math.inf
+
+    def add(self, band):
+        self.low = min(self.low, float(band.min()))
+        hot = band[band > MIN_HEAT]
+        if hot.size:
+            bins = ((np.log(hot) - self.log_low) * self.bins_per_log).astype(np.intp)
+            self.counts += np.bincount(np.clip(bins, 0, HISTOGRAM_BINS - 1), minlength=HISTOGRAM_BINS)
+
+    def levels(self, height, width):
+        """(low, high) for normalize_band: the minimum heat and the 98th-percentile clip.
+
+        The percentile is taken over the hot pixels the untruncated Gaussians
+        would have produced: the tail pixels are all below the bound, so only
+        the rank changes.
+        """
+        hot_count = int(self.counts.sum())
+        if hot_count == 0:
+            return 0.0, 0.0
+        support = max(hot_support_size(self.sources, height, width), hot_count)
+        rank = max(0.0, 100 - (100 - CLIP_PERCENTILE) * support / hot_count)
+        position = rank / 100 * (hot_count - 1)
+        bin_index = int(np.searchsorted(np.cumsum(self.counts), position, side="right"))
+        high = math.exp(self.log_low + (min(bin_index, HISTOGRAM_BINS - 1) + 0.5) / self.bins_per_log)
+        return min(self.low, high), high
+
+
+@dataclass
+class HeatmapScan:
+    """Result of scan_heatmap, keyed by category key (None for the combined map).
+
+    levels: (low, high) for normalize_band.
+    grids: heat summed over cell×cell blocks (only if a cell was given).
+    """
+    levels: dict
+    grids: dict
+
+
+def scan_heatmap(sources, height, width, band_rows=HEATMAP_BAND_ROWS, categories=CATEGORY_KEYS, cell=None):
+    """First pass over the map: clip levels of the combined map and of every category layer.
+
+    Each band is accumulated once as category layers; the combined map
+    (their sum) and every layer feed their own histogram, so the full map
+    is never held in memory. With `cell`, the raw heat of each layer and
+    of the combined map is also summed into a coarse grid (for
+    densest_windows_in_grid). Categories without sources are left out.
+    """
+    present = [key for key in categories if any(source.category == key for source in sources)]
+    histograms = {None: _LevelHistogram(sources)}
+    for key in present:
+        histograms[key] = _LevelHistogram([source for source in sources if source.category == key])
+    if histograms[None].max_heat <= MIN_HEAT:
+        return HeatmapScan({None: (0.0, 0.0)}, {})
+
+    grids = {}
+    if cell:
+        shape = (math.ceil(height / cell), math.ceil(width / cell))
+        grids = {key: np.zeros(shape, dtype=np.float64) for key in histograms}
+        band_rows = max(cell, band_rows // cell * cell)
+    channels = {key: index for index, key in enumerate(categories)}
+    for row_start, row_end in iter_bands(height, band_rows):
+        layers = accumulate_layers(sources, height, width, row_start, row_end, categories)
+        for key, histogram in histograms.items():
+            band = layers.sum(axis=0) if key is None else layers[channels[key]]
+            histogram.add(band)
+            if cell:
+                blocks = _block_sums(band, cell)
+                grids[key][row_start // cell:row_start // cell + len(blocks)] = blocks
+
+    levels = {key: histogram.levels(height, width) for key, histogram in histograms.items()}
+    if levels[None] == (0.0, 0.0):
+        logger.debug("Тепловая карта пуста, нормализация пропущена.")
+    return HeatmapScan(levels, grids)
+
+
+def heatmap_levels(sources, height, width, band_rows=HEATMAP_BAND_ROWS):
+    """Returns (low, high) of the combined map for normalize_band (see scan_heatmap)."""
+    return scan_heatmap(sources, height, width, band_rows, categories=()).levels[None]
+
+
+def normalize_band(band, low, high):
+    """Clips heat at `high` and scales it to [0, 1] (in place); an empty map stays zero."""
+    if high <= 0:
+        return band
+    np.clip(band, 0, high, out=band)
+    band -= np.float32(low)
+    band /= np.float32(high - low + 1e-9)
+    return band
+
+
+def load_rgb(image):
+    """Opens an image (path or PIL image) as RGB; transparency is flattened onto white."""
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    return flatten_rgb(image)
+
+
+def colorize(heatmap_norm):
+    """Maps a [0, 1] heatmap to uint8 RGB through the colormap LUT (same binning as matplotlib)."""
+    indices = np.minimum(heatmap_norm * len(COLORMAP_LUT), len(COLORMAP_LUT) - 1).astype(np.uint8)
+    return np.take(COLORMAP_LUT, indices, axis=0)
+
+
+def blend_heatmap(image_rgb, heatmap_norm, alpha=HEATMAP_ALPHA):
+    """Alpha-blends the colorized heatmap over an RGB uint8 array, in 8-bit fixed point."""
+    weight = int(round(alpha * 256))
+    blended = image_rgb.astype(np.uint16) * (256 - weight)
+    blended += colorize(heatmap_norm).astype(np.uint16) * weight
+    blended += 128
+    return (blended >> 8).astype(np.uint8)
+
+
+def _font(size):
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def legend_font_size(image_width):
+    return max(12, round(image_width * 0.04))
+
+
+def draw_legend(height, image_width):
+    """Draws the colorbar legend (faded like the overlay) for an image of the given size.
+
+    Returns a white RGB panel with the bar, the tick labels and the rotated
+    label. The panel is at most `height` rows tall and is meant to be
+    vertically centered next to the image (see legend_offset).
+    """
+    font_size = legend_font_size(image_width)
+    font = _font(font_size)
+    bar_width = max(font_size, round(image_width * 0.12))
+    bar_height = max(1, min(bar_width * LEGEND_ASPECT, height - 2 * font_size))
+    tick_length = max(3, font_size // 3)
+    tick_labels = [f"{tick:.1f}" for tick in LEGEND_TICKS]
+    label_width = max(font.getbbox(text)[2] for text in tick_labels)
+    label_box = font.getbbox(LEGEND_LABEL)
+
+    margin = font_size
+    panel_width = margin + bar_width + tick_length + 4 + label_width + margin + (label_box[3] - label_box[1]) + margin
+    panel_height = min(height, bar_height + 2 * font_size)
+    panel = Image.new("RGB", (panel_width, panel_height), "white")
+    top = (panel_height - bar_height) // 2
+
+    # Bar: value 1.0 at the top, colors blended with white like the overlay
+    values = np.linspace(1.0, 0.0, bar_height, dtype=np.float32)[:, None].repeat(bar_width, axis=1)
+    white = np.full((bar_height, bar_width, 3), 255, dtype=np.uint8)
+    panel.paste(Image.fromarray(blend_heatmap(white, values)), (margin, top))
+
+    draw = ImageDraw.Draw(panel)
+    bar_right = margin + bar_width
+    draw.rectangle((margin - 1, top - 1, bar_right, top + bar_height), outline="black")
+    for tick, text in zip(LEGEND_TICKS, tick_labels):
+        y = top + round((1.0 - tick) * (bar_height - 1))
+        draw.line((bar_right, y, bar_right + tick_length, y), fill="black")
+        draw.text((bar_right + tick_length + 4, y), text, fill="black", font=font, anchor="lm")
+
+    # Rotated label, centered on the bar (cropped if the image is very short)
+    label = Image.new("RGB", (label_box[2] - label_box[0], label_box[3] - label_box[1]), "white")
+    ImageDraw.Draw(label).text((-label_box[0], -label_box[1]), LEGEND_LABEL, fill="black", font=font)
+    label = label.rotate(90, expand=True)
+    label_x = bar_right + tick_length + 4 + label_width + margin
+    panel.paste(label, (label_x, top + (bar_height - label.height) // 2))
+    return panel
+
+
+def legend_offset(height, legend):
+    return (height - legend.height) // 2
+
+
+def draw_title(width, image_width, text=HEATMAP_TITLE):
+    """Draws the heatmap title centered over the image area of a canvas of the given width."""
+    font = _font(round(legend_font_size(image_width) * 1.2))
+    box = font.getbbox(text)
+    padding = font.size // 2
+    strip = Image.new("RGB", (width, box[3] + 2 * padding), "white")
+    ImageDraw.Draw(strip).text((max(0, image_width // 2), padding), text, fill="black", font=font, anchor="ma")
+    return strip
+
+
+class PNGStreamWriter:
+    """Writes an 8-bit RGB PNG row band by row band, compressing as it goes.
+
+    Rows use the PNG "Up" filter, which is vectorizable and compresses
+    screenshots about as well as PIL's adaptive filtering.
+    """
+
+    def __init__(self, path, width, height, compress_level=PNG_COMPRESS_LEVEL):
+        self.width = width
+        self.height = height
+        self._rows_written = 0
+        self._previous_row = np.zeros(width * 3, dtype=np.uint8)
+        self._compressor = zlib.compressobj(compress_level)
+        self._file = open(path, "wb")
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, rows):
+        """Appends a (rows, width, 3) uint8 array."""
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape(len(rows), self.width * 3)
+        filtered = np.empty((len(rows), self.width * 3 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2 # Up
+        filtered[0, 1:] = rows[0] - self._previous_row
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self._previous_row = rows[-1].copy()
+        self._rows_written += len(rows)
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        if self._rows_written != self.height:
+            self.abort()
+            raise ValueError(f"PNG expects {self.height} rows, got {self._rows_written}")
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        self._file.close()
+
+    def abort(self):
+        """Closes and removes the incomplete file."""
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except OSError:
+            pass
+
+
+@dataclass(frozen=True)
+class HeatmapTarget:
+    """One output image of render_heatmap.
+
+    The image is scaled down to fit max_width and max_dimension_sum (width +
+    height, the Telegram photo limit; title and legend are included
+    approximately). A decorated target has the title and legend around the
+    blended screenshot (no title strip if title is None). PNG targets are
+    streamed band by band; JPEG targets (jpeg_quality set) are assembled in
+    memory and should be small.
+
+    A category target shows only that category's layer, normalized with
+    its own clip levels. With max_windows, only the densest windows of the
+    layer (window_rows source rows each) are rendered and stacked next to
+    the legend, as render_regions does for the combined map.
+    """
+    path: str
+    max_width: Optional[int] = None
+    max_dimension_sum: Optional[int] = None
+    decorated: bool = True
+    jpeg_quality: Optional[int] = None
+    title: Optional[str] = HEATMAP_TITLE
+    category: Optional[str] = None
+    max_windows: Optional[int] = None
+    window_rows: int = CATEGORY_WINDOW_ROWS
+
+    def scale(self, width, height):
+        scale = 1.0
+        if self.max_width:
+            scale = min(scale, self.max_width / width)
+        if self.max_dimension_sum:
+            decorated_width = width * 1.5 if self.decorated else width
+            scale = min(scale, self.max_dimension_sum / (decorated_width + height))
+        return scale
+
+
+def category_targets(heatmap_path, categories=CATEGORY_KEYS):
+    """Report figures of the category layers (category_heatmap_path), at report width."""
+    return [HeatmapTarget(category_heatmap_path(heatmap_path, key), max_width=REPORT_WIDTH, title=None,
+                          category=key, max_windows=CATEGORY_MAX_WINDOWS, jpeg_quality=CATEGORY_JPEG_QUALITY)
+            for key in categories]
+
+
+def default_targets(heatmap_path):
+    """Full-size heatmap, report-width body (report_heatmap_path), Telegram preview
+    (preview_heatmap_path) and the category figures (category_targets)."""
+    return [
+        HeatmapTarget(heatmap_path),
+        HeatmapTarget(report_heatmap_path(heatmap_path), max_width=REPORT_WIDTH, decorated=False),
+        HeatmapTarget(preview_heatmap_path(heatmap_path), max_width=PREVIEW_MAX_WIDTH,
+                      max_dimension_sum=PREVIEW_MAX_DIMENSION_SUM, jpeg_quality=PREVIEW_JPEG_QUALITY),
+        *category_targets(heatmap_path),
+    ]
+
+
+@dataclass(frozen=True)
+class _Grid:
+    """A resolution the layers are accumulated at: the image scaled by `scale`."""
+    scale: float
+    width: int
+    height: int
+    sources: tuple
+
+    @classmethod
+    def of(cls, image_size, sources, scale):
+        width, height = image_size
+        if scale != 1.0:
+            sources = [source.scaled(scale) for source in sources]
+        return cls(scale, max(1, round(width * scale)), max(1, round(height * scale)), tuple(sources))
+
+
+class _Band:
+    """Source rows [row_start, row_end) of the image, rendered on demand at every resolution.
+
+    The category layers, normalized heat, resampled screenshot and blended
+    rows are computed at most once per resolution and shared by all the
+    targets that use it.
+    """
+
+    def __init__(self, image, row_start, row_end, categories, levels):
+        self.image = image
+        self.row_start, self.row_end = row_start, row_end
+        self.categories = categories
+        self.levels = levels
+        self._layers, self._heat, self._screenshots, self._bodies = {}, {}, {}, {}
+
+    def rows(self, grid):
+        """(t0, t1): the rows of the grid that correspond to this band."""
+        if grid.scale == 1.0:
+            return self.row_start, self.row_end
+        t0 = 0 if self.row_start == 0 else min(grid.height, round(self.row_start * grid.scale))
+        t1 = grid.height if self.row_end >= self.image.size[1] else min(grid.height, round(self.row_end * grid.scale))
+        return t0, t1
+
+    def heat(self, grid, category=None):
+        """Normalized heat of the combined map (or of one category layer) in this band."""
+        key = (grid.scale, category)
+        if key not in self._heat:
+            self._heat[key] = self._normalized(grid, category, 0, None)
+        return self._heat[key]
+
+    def body(self, grid, category=None):
+        """Heat blended over the screenshot, (rows, grid.width, 3) uint8."""
+        key = (grid.scale, category)
+        if key not in self._bodies:
+            self._bodies[key] = blend_heatmap(self._screenshot(grid), self.heat(grid, category))
+        return self._bodies[key]
+
+    def body_rows(self, grid, category, top, bottom):
+        """Rows [top, bottom) of body(); only these rows are blended unless the whole band already is."""
+        key = (grid.scale, category)
+        if key in self._bodies:
+            return self._bodies[key][top:bottom]
+        heat = self._heat[key][top:bottom] if key in self._heat else self._normalized(grid, category, top, bottom)
+        return blend_heatmap(self._screenshot(grid)[top:bottom], heat)
+
+    def _normalized(self, grid, category, top, bottom):
+        if grid.scale not in self._layers:
+            t0, t1 = self.rows(grid)
+            self._layers[grid.scale] = accumulate_layers(grid.sources, grid.height, grid.width, t0, t1,
+                                                         self.categories)
+        layers = self._layers[grid.scale][:, top:bottom]
+        heat = layers.sum(axis=0) if category is None else layers[self.categories.index(category)].copy()
+        return normalize_band(heat, *self.levels[category])
+
+    def _screenshot(self, grid):
+        if grid.scale not in self._screenshots:
+            source_width, source_height = self.image.size
+            if grid.scale == 1.0:
+                screenshot = self.image.crop((0, self.row_start, source_width, self.row_end))
+            else:
+                # Crop the band plus the LANCZOS support (3 output pixels) on both sides, then resize
+                # the exact box inside it, so bands join without seams and only the band is converted
+                t0, t1 = self.rows(grid)
+                top, bottom = t0 / grid.scale, min(source_height, t1 / grid.scale)
+                margin = math.ceil(3 / grid.scale) + 1
+                crop_top = max(0, math.floor(top) - margin)
+                crop_bottom = min(source_height, math.ceil(bottom) + margin)
+                region = self.image.crop((0, crop_top, source_width, crop_bottom))
+                screenshot = region.resize((grid.width, t1 - t0), Image.LANCZOS,
+                                           box=(0, top - crop_top, source_width, bottom - crop_top))
+            self._screenshots[grid.scale] = np.asarray(load_rgb(screenshot))
+        return self._screenshots[grid.scale]
+
+
+class _TargetWriter:
+    """Renders one full-page HeatmapTarget band by band."""
+
+    def __init__(self, target, grid):
+        self.target = target
+        self.grid = grid
+        self.width, self.height = grid.width, grid.height
+
+        self.legend_rows, self.legend_top, title = None, 0, None
+        canvas_width = self.width
+        if target.decorated:
+            legend = draw_legend(self.height, self.width)
+            self.legend_rows, self.legend_top = np.asarray(legend), legend_offset(self.height, legend)
+            canvas_width += legend.width
+            if target.title:
+                title = draw_title(canvas_width, self.width, target.title)
+        self.canvas_width = canvas_width
+        total_height = self.height + (title.height if title else 0)
+
+        self._writer, self._canvas, self._canvas_row = None, None, 0
+        if target.jpeg_quality:
+            self._canvas = np.empty((total_height, canvas_width, 3), dtype=np.uint8)
+        else:
+            self._writer = PNGStreamWriter(target.path, canvas_width, total_height)
+        if title:
+            self._emit(np.asarray(title))
+
+    def _emit(self, rows):
+        if self._writer is not None:
+            self._writer.write(rows)
+        else:
+            self._canvas[self._canvas_row:self._canvas_row + len(rows)] = rows
+            self._canvas_row += len(rows)
+
+    def write_band(self, band):
+        t0, t1 = band.rows(self.grid)
+        if t1 <= t0:
+            return
+        rows = np.full((t1 - t0, self.canvas_width, 3), 255, dtype=np.uint8)
+        rows[:, :self.width] = band.body(self.grid, self.target.category)
+        if self.legend_rows is not None:
+            # Part of the legend that falls into this band
+            top, bottom = max(t0, self.legend_top), min(t1, self.legend_top + len(self.legend_rows))
+            if top < bottom:
+                rows[top - t0:bottom - t0, self.width:] = self.legend_rows[top - self.legend_top:bottom - self.legend_top]
+        self._emit(rows)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            Image.fromarray(self._canvas).save(self.target.path, format="JPEG", quality=self.target.jpeg_quality)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+
+
+class _RegionWriter:
+    """Renders only some row regions of a HeatmapTarget and stacks them (compose_regions)."""
+
+    def __init__(self, target, grid, regions):
+        self.target = target
+        self.grid = grid
+        self.regions = []
+        for row_start, row_end in regions:
+            top = min(grid.height - 1, round(row_start * grid.scale))
+            self.regions.append((top, max(top + 1, min(grid.height, round(row_end * grid.scale)))))
+        self.parts = [[] for _ in self.regions]
+
+    def write_band(self, band):
+        t0, t1 = band.rows(self.grid)
+        for part, (top, bottom) in zip(self.parts, self.regions):
+            top, bottom = max(top, t0), min(bottom, t1)
+            if top < bottom:
+                part.append(band.body_rows(self.grid, self.target.category, top - t0, bottom - t0))
+
+    def close(self):
+        parts = [Image.fromarray(np.concatenate(part)) for part in self.parts if part]
+        figure = compose_regions(parts, title=self.target.title if self.target.decorated else None)
+        if self.target.jpeg_quality:
+            figure.save(self.target.path, format="JPEG", quality=self.target.jpeg_quality)
+        else:
+            figure.save(self.target.path, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+    def abort(self):
+        pass
+
+
+def render_heatmap(image, sources, targets, band_rows=HEATMAP_BAND_ROWS, intensity_output=None):
+    """Renders the heatmap of `sources` over the image into every target in one pass.
+
+    The clip levels (and, for windowed targets, the coarse grids) come from
+    one scan at full resolution; every target then takes its layer from
+    the category layers accumulated at its own scale, band by band, and
+    blends it with the screenshot resampled to that scale. Category targets
+    whose category has no sources are skipped (and their old file removed).
+
+    Args:
+        image: PIL image of the screenshot (any mode).
+        sources: HeatSources in image pixels (heat_sources).
+        targets: HeatmapTargets to write (default_targets).
+        band_rows: source rows processed at once.
+        intensity_output: optional .npy path for the normalized full-size
+            intensity (written band by band through a memory map).
+    """
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA") # LANCZOS resampling needs a true-color or gray mode
+    width, height = image.size
+    categories = tuple(key for key in CATEGORY_KEYS if any(target.category == key for target in targets))
+    windowed = any(target.max_windows for target in targets)
+    scan = scan_heatmap(sources, height, width, band_rows, categories, HOTSPOT_CELL if windowed else None)
+
+    grids = {1.0: _Grid.of(image.size, sources, 1.0)}
+    writers, intensity = [], None
+    try:
+        for target in targets:
+            if target.category is not None and target.category not in scan.levels:
+                logger.debug(f"Нет проблем категории {target.category}, {target.path} не создается")
+                if os.path.exists(target.path):
+                    os.remove(target.path) # Left from an earlier run of the same page
+                continue
+            scale = target.scale(width, height)
+            if scale not in grids:
+                grids[scale] = _Grid.of(image.size, sources, scale)
+            if target.max_windows:
+                regions = densest_windows_in_grid(scan.grids.get(target.category), height, target.window_rows,
+                                                  target.max_windows)
+                writers.append(_RegionWriter(target, grids[scale], regions))
+            else:
+                writers.append(_TargetWriter(target, grids[scale]))
+        if intensity_output:
+            intensity = np.lib.format.open_memmap(intensity_output, mode="w+", dtype=INTENSITY_DTYPE,
+                                                  shape=(height, width))
+        for row_start, row_end in iter_bands(height, band_rows):
+            band = _Band(image, row_start, row_end, categories, scan.levels)
+            if intensity is not None:
+                intensity[row_start:row_end] = band.heat(grids[1.0])
+            for writer in writers:
+                writer.write_band(band)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        if intensity is not None:
+            del intensity
+            os.remove(intensity_output)
+        raise
+    for writer in writers:
+        writer.close()
+    if intensity is not None:
+        intensity.flush()
+        del intensity
+
+
+def load_intensity(path):
+    """Memory-maps an intensity sidecar; returns None if it is missing or unreadable."""
+    try:
+        intensity = np.load(path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать {path}: {e}")
+        return None
+    return intensity if intensity.ndim == 2 else None
+
+
+def summed_area_table(grid):
+    """Summed-area table with a zero first row and column: sat[y, x] = grid[:y, :x].sum()."""
+    sat = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(grid, axis=0, dtype=np.float64), axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def _block_sums(band, cell):
+    """Sums a band (rows, width) over cell×cell blocks; the last row and column of blocks may be partial."""
+    height, width = band.shape
+    full = height // cell * cell
+    rows = band[:full].reshape(-1, cell, width).sum(axis=1)
+    if full < height:
+        rows = np.concatenate((rows, band[full:].sum(axis=0, keepdims=True)))
+    return np.add.reduceat(rows, np.arange(0, width, cell), axis=1)
+
+
+def coarse_grid(intensity, cell=HOTSPOT_CELL, band_rows=HEATMAP_BAND_ROWS):
+    """Sums the intensity over cell×cell blocks, reading the (memory-mapped) array band by band."""
+    height, width = intensity.shape
+    rows, cols = math.ceil(height / cell), math.ceil(width / cell)
+    grid = np.zeros((rows, cols), dtype=np.float64)
+    band_rows = max(cell, band_rows // cell * cell)
+    for row_start, row_end in iter_bands(height, band_rows):
+        blocks = _block_sums(np.asarray(intensity[row_start:row_end], dtype=np.float32), cell)
+        grid[row_start // cell:row_start // cell + len(blocks)] = blocks
+    return grid
+
+
+def densest_windows(intensity, window_rows, max_windows, min_share=0.1, cell=HOTSPOT_CELL):
+    """Picks up to `max_windows` non-overlapping full-width windows with the most heat.
+
+    Windows are `window_rows` tall; the rectangle sums come from a
+    summed-area table of a coarse grid. Windows are chosen greedily and
+    dropped once they hold less than `min_share` of the heat of the best
+    one. Returns [(row_start, row_end)] in pixels, top to bottom.
+    """
+    height = intensity.shape[0]
+    if height <= window_rows * max_windows:
+        return [(0, height)]
+    return densest_windows_in_grid(coarse_grid(intensity, cell), height, window_rows, max_windows, min_share, cell)
+
+
+def densest_windows_in_grid(grid, height, window_rows, max_windows, min_share=0.1, cell=HOTSPOT_CELL):
+    """densest_windows over a coarse grid that is already summed (coarse_grid, scan_heatmap)."""
+    if grid is None or height <= window_rows * max_windows:
+        return [(0, height)]
+    sat = summed_area_table(grid)
+    window_cells = max(1, math.ceil(window_rows / cell))
+    last_start = sat.shape[0] - 1 - window_cells
+    starts = np.arange(last_start + 1)
+    # Full-width rectangles: the two right-hand corners of the table minus the left ones (zero column)
+    sums = sat[starts + window_cells, -1] - sat[starts, -1]
+    available = np.ones(len(sums), dtype=bool)
+
+    windows, best = [], None
+    while len(windows) < max_windows and available.any():
+        start = int(np.argmax(np.where(available, sums, -1.0)))
+        if best is None:
+            best = sums[start]
+        if sums[start] <= 0 or sums[start] < best * min_share:
+            break
+        windows.append((start * cell, min(height, start * cell + window_rows)))
+        available[max(0, start - window_cells + 1):start + window_cells] = False
+    return sorted(windows) or [(0, min(height, window_rows))]
+
+
+def compose_regions(parts, gap=None, title=HEATMAP_TITLE):
+    """Stacks images of the same width under the title (if any), next to a legend."""
+    width = parts[0].width
+    gap = gap if gap is not None else max(8, width // 100)
+    body_height = sum(part.height for part in parts) + gap * (len(parts) - 1)
+    legend = draw_legend(body_height, width)
+    canvas_width = width + legend.width
+    title_strip = draw_title(canvas_width, width, title) if title else None
+    title_height = title_strip.height if title_strip else 0
+    canvas = Image.new("RGB", (canvas_width, title_height + body_height), "white")
+    if title_strip:
+        canvas.paste(title_strip, (0, 0))
+    y = title_height
+    for part in parts:
+        canvas.paste(part, (0, y))
+        y += part.height + gap
+    canvas.paste(legend, (width, title_height + legend_offset(body_height, legend)))
+    return canvas
+
+
+def render_regions(body, regions, source_height, output_path, gap=None):
+    """Stacks row regions of a rendered heatmap body under the title, next to a legend, as PNG.
+
+    Args:
+        body: PIL image of an undecorated target (e.g. report_heatmap_path).
+        regions: [(row_start, row_end)] in source (screenshot) rows.
+        source_height: height of the screenshot, to map regions onto the body.
+        output_path: where to write the PNG.
+    """
+    scale = body.size[1] / source_height
+    parts = []
+    for row_start, row_end in regions:
+        top = min(body.size[1] - 1, round(row_start * scale))
+        bottom = max(top + 1, min(body.size[1], round(row_end * scale)))
+        parts.append(body.crop((0, top, body.size[0], bottom)))
+    compose_regions(parts, gap).save(output_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
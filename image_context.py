@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Decoded screenshot shared by the stages of one pipeline run, and its uploads.
+The cached images are shared and must not be modified in place.
+"""
+
+import io
+import os
+import base64
+import logging
+import threading
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import numpy as np
+from PIL import Image, ImageFile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JPEG_QUALITY = 85
+# 0 sends every model the original file, as before the upload profiles
+IMAGE_PREPROCESSING = os.getenv("IMAGE_PREPROCESSING", "1").lower() not in ("0", "false", "no")
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+
+
+@dataclass(frozen=True)
+class UploadProfile:
+    """How an image is prepared for one model.
+
+    The image is scaled down to fit max_side (longest side), then
+    max_short_side (shortest side), and encoded as `format` ("JPEG",
+    "PNG", "WEBP"). format None sends the original file if the model
+    accepts its format, a PNG otherwise.
+    """
+    max_side: Optional[int] = None
+    max_short_side: Optional[int] = None
+    format: Optional[str] = "JPEG"
+    quality: int = 90
+
+    def scale(self, width, height):
+        scale = 1.0
+        if self.max_side:
+            scale = min(scale, self.max_side / max(width, height))
+        if self.max_short_side:
+            scale = min(scale, self.max_short_side / min(width, height))
+        return scale
+
+
+ORIGINAL_UPLOAD = UploadProfile(format=None)
+# Model name prefix -> profile; the longest matching prefix wins
+UPLOAD_PROFILES = {
+    # High-detail vision input is fitted into 2048×2048, then the short side into 768 px
+    "gpt-4": UploadProfile(max_side=2048, max_short_side=768, format="JPEG", quality=90),
+    # Larger images are scaled down to fit 3072×3072; JPEG keeps the payload small at that size
+    "gemini-": UploadProfile(max_side=3072, format="JPEG", quality=92),
+}
+
+
+def upload_profile(model):
+    """UploadProfile for a model name (ORIGINAL_UPLOAD if unknown or IMAGE_PREPROCESSING is off)."""
+    if not IMAGE_PREPROCESSING:
+        return ORIGINAL_UPLOAD
+    matches = [prefix for prefix in UPLOAD_PROFILES if model.startswith(prefix)]
+    return UPLOAD_PROFILES[max(matches, key=len)] if matches else ORIGINAL_UPLOAD
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """An image as sent to a model, with the size it was resized from."""
+    data: bytes
+    mime_type: str
+    size: tuple # (width, height) sent
+    original_size: tuple
+
+    @property
+    def scale_x(self):
+        return self.size[0] / self.original_size[0]
+
+    @property
+    def scale_y(self):
+        return self.size[1] / self.original_size[1]
+
+    def base64(self):
+        return base64.b64encode(self.data).decode("utf-8")
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+    def to_original(self, box):
+        """Maps a pixel box [y_min, x_min, y_max, x_max] of the sent image to the original image."""
+        y_min, x_min, y_max, x_max = box
+        return [y_min / self.scale_y, x_min / self.scale_x, y_max / self.scale_y, x_max / self.scale_x]
+
+    def describe(self):
+        """JSON-friendly summary (no data) for logs and run metadata."""
+        info = asdict(self)
+        del info["data"]
+        info.update(bytes=len(self.data), scale_x=self.scale_x, scale_y=self.scale_y)
+        return info
+
+
+def encode_image(image, profile):
+    """EncodedImage of a PIL image prepared according to an UploadProfile (format None: PNG)."""
+    width, height = image.size
+    scale = profile.scale(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale))) if scale < 1.0 else image.size
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    image_format = profile.format or "PNG"
+    buffer = io.BytesIO()
+    options = {"quality": profile.quality} if image_format in ("JPEG", "WEBP") else {}
+    image.save(buffer, format=image_format, **options)
+    return EncodedImage(buffer.getvalue(), MIME_TYPES[image_format], size, (width, height))
+
+
+def flatten_rgb(image):
+    """Converts a PIL image to RGB; transparency is flattened onto white."""
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+_truncated_lock = threading.Lock()
+
+
+def load_truncated(data):
+    """Decodes image bytes with ImageFile.LOAD_TRUNCATED_IMAGES set for this decode only."""
+    with _truncated_lock:
+        previous = ImageFile.LOAD_TRUNCATED_IMAGES
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        finally:
+            ImageFile.LOAD_TRUNCATED_IMAGES = previous
+    return image
+
+
+class ImageContext:
+    """One screenshot and the forms derived from it, each computed on first use.
+
+    Args:
+        path: the image file. It is read at most once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._values = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def _cached(self, key, compute):
+        if key in self._values:
+            return self._values[key]
+        with self._guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._values:
+                self._values[key] = compute()
+            return self._values[key]
+
+    def file_bytes(self):
+        """Contents of the image file."""
+        def read():
+            with open(self.path, "rb") as f:
+                return f.read()
+        return self._cached("file", read)
+
+    def _header(self):
+        # Format, size and mode without decoding the pixels
+        def read_header():
+            with Image.open(io.BytesIO(self.file_bytes())) as image:
+                return image.format, image.size, image.mode
+        return self._cached("header", read_header)
+
+    @property
+    def format(self):
+        """PIL format name of the file ("PNG", "JPEG", ...)."""
+        return self._header()[0]
+
+    @property
+    def size(self):
+        """(width, height) in pixels."""
+        return self._header()[1]
+
+    @property
+    def mode(self):
+        return self._header()[2]
+
+    def image(self):
+        """The decoded image, in the mode of the file."""
+        def decode():
+            image = Image.open(io.BytesIO(self.file_bytes()))
+            try:
+                image.load()
+            except OSError as e:
+                # A truncated file still has the pixels before the cut; the rest stays blank
+                logger.warning(f"Изображение {self.path} повреждено ({e}), используется читаемая часть")
+                image = load_truncated(self.file_bytes())
+            logger.debug(f"Изображение декодировано: {self.path} ({image.width}x{image.height}, {image.mode})")
+            return image
+        return self._cached("image", decode)
+
+    def rgb(self):
+        """The image as RGB, transparency flattened onto white."""
+        return self._cached("rgb", lambda: flatten_rgb(self.image()))
+
+    def pixels(self):
+        """Read-only (height, width, 3) uint8 array of rgb()."""
+        def to_array():
+            pixels = np.asarray(self.rgb())
+            pixels.flags.writeable = False
+            return pixels
+        return self._cached("pixels", to_array)
+
+    def png_bytes(self):
+        """The image as PNG; a PNG file is used as is, without decoding and re-encoding it."""
+        def encode():
+            if self.format == "PNG":
+                return self.file_bytes()
+            buffer = io.BytesIO()
+            self.image().save(buffer, format="PNG")
+            return buffer.getvalue()
+        return self._cached("png", encode)
+
+    def jpeg_bytes(self, quality=DEFAULT_JPEG_QUALITY):
+        """rgb() encoded as JPEG."""
+        def encode():
+            buffer = io.BytesIO()
+            self.rgb().save(buffer, format="JPEG", quality=quality)
+            return buffer.getvalue()
+        return self._cached(("jpeg", quality), encode)
+
+    def base64(self):
+        """Base64 (str) of the file contents, for data: URLs."""
+        return self._cached("base64", lambda: base64.b64encode(self.file_bytes()).decode("utf-8"))
+
+    def resized(self, size):
+        """rgb() resized (LANCZOS) to (width, height); rgb() itself if that is its size."""
+        size = tuple(size)
+        if size == self.size:
+            return self.rgb()
+        return self._cached(("resized", size), lambda: self.rgb().resize(size, Image.LANCZOS, reducing_gap=3.0))
+
+    def downscaled(self, max_width=None, max_height=None):
+        """rgb() resized to fit max_width × max_height; returns (image, scale).
+
+        The image is returned as is (scale 1.0) if it already fits.
+        """
+        width, height = self.size
+        scale = 1.0
+        if max_width:
+            scale = min(scale, max_width / width)
+        if max_height:
+            scale = min(scale, max_height / height)
+        if scale >= 1.0:
+            return self.rgb(), 1.0
+        return self.resized((max(1, round(width * scale)), max(1, round(height * scale)))), scale
+
+    def region(self, box):
+        """rgb() cropped to box = (left, top, right, bottom); rgb() itself for the whole image."""
+        box = tuple(box)
+        if box == (0, 0) + tuple(self.size):
+            return self.rgb()
+        return self._cached(("region", box), lambda: self.rgb().crop(box))
+
+    def encoded(self, profile=ORIGINAL_UPLOAD, box=None):
+        """EncodedImage of the image prepared according to an UploadProfile.
+
+        With box = (left, top, right, bottom) only that region is prepared;
+        original_size of the result is then the size of the region.
+        """
+        if box is not None and tuple(box) != (0, 0) + tuple(self.size):
+            box = tuple(box)
+            return self._cached(("encoded", profile, box), lambda: encode_image(self.region(box), profile))
+
+        def encode():
+            width, height = self.size
+            if profile.format is None:
+                if self.format in MIME_TYPES:
+                    return EncodedImage(self.file_bytes(), MIME_TYPES[self.format], self.size, self.size)
+                return EncodedImage(self.png_bytes(), MIME_TYPES["PNG"], self.size, self.size)
+            scale = profile.scale(width, height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale))) if scale < 1.0 else self.size
+            if profile.format == "PNG" and size == self.size:
+                data = self.png_bytes()
+            else:
+                buffer = io.BytesIO()
+                options = {"quality": profile.quality} if profile.format in ("JPEG", "WEBP") else {}
+                self.resized(size).save(buffer, format=profile.format, **options)
+                data = buffer.getvalue()
+            return EncodedImage(data, MIME_TYPES[profile.format], size, self.size)
+        return self._cached(("encoded", profile), encode)
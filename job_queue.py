@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Bounded job queue for screenshot analysis jobs.
+
+A fixed pool of worker tasks pulls jobs from a FIFO queue, so a burst of
+uploads is processed at most `max_concurrent_jobs` at a time instead of
+starting one pipeline per message. Every chat can have at most
+`max_jobs_per_chat` jobs waiting or running, and the queue itself holds at
+most `max_queue_size` waiting jobs.
+"""
+
+import os
+import asyncio
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+DEFAULT_MAX_JOBS_PER_CHAT = int(os.getenv("MAX_JOBS_PER_CHAT", "2"))
+DEFAULT_MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "50"))
+
+
+class QueueFullError(Exception):
+    """Raised when the global queue has no free slots."""
+
+
+class ChatJobLimitError(Exception):
+    """Raised when a chat already has the maximum number of jobs queued or running."""
+
+
+class AnalysisJobQueue:
+    """FIFO job queue with a global concurrency limit and a per-chat limit.
+
+    Jobs are coroutine functions without arguments. `submit` returns the
+    number of jobs waiting ahead of the new one (0 means it starts as soon as
+    a worker is free).
+    """
+
+    def __init__(self, max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS,
+                 max_jobs_per_chat=DEFAULT_MAX_JOBS_PER_CHAT,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE):
+        self.max_concurrent_jobs = max(1, max_concurrent_jobs)
+        self.max_jobs_per_chat = max(1, max_jobs_per_chat)
+        self.max_queue_size = max(1, max_queue_size)
+        self._queue = asyncio.Queue()
+        self._pending_ids = [] # Job ids in queue order, used for positions
+        self._jobs_per_chat = {}
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._workers = []
+
+    @property
+    def pending_count(self):
+        return len(self._pending_ids)
+
+    @property
+    def running_count(self):
+        return self._running
+
+    def start(self):
+        """Starts the worker tasks. Must be called from a running event loop."""
+        if self._workers:
+            return
+        for i in range(self.max_concurrent_jobs):
+            self._workers.append(asyncio.create_task(self._worker(i), name=f"analysis-worker-{i}"))
+        logger.info(f"Очередь задач запущена: {self.max_concurrent_jobs} воркеров, "
+                    f"до {self.max_jobs_per_chat} задач на чат, до {self.max_queue_size} задач в очереди")
+
+    async def stop(self):
+        """Cancels the workers; queued jobs that have not started are dropped."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, chat_id, job, on_start=None):
+        """Enqueues a job for a chat.
+
+        Args:
+            chat_id: Telegram chat the job belongs to (used for the per-chat limit).
+            job: coroutine function to run.
+            on_start: optional coroutine function awaited right before the job runs.
+
+        Returns:
+            int: number of jobs ahead of this one in the queue.
+
+        Raises:
+            ChatJobLimitError: the chat already has `max_jobs_per_chat` jobs.
+            QueueFullError: `max_queue_size` jobs are already waiting.
+        """
+        if self._jobs_per_chat.get(chat_id, 0) >= self.max_jobs_per_chat:
+            raise ChatJobLimitError(f"Chat {chat_id} already has {self.max_jobs_per_chat} jobs")
+        if len(self._pending_ids) >= self.max_queue_size:
+            raise QueueFullError(f"Queue is full ({self.max_queue_size} jobs)")
+
+        job_id = next(self._ids)
+        # Waiting jobs that idle workers are about to take are not ahead of this one; it needs a free worker too
+        jobs_ahead = max(0, len(self._pending_ids) + 1 - (self.max_concurrent_jobs - self._running))
+        self._pending_ids.append(job_id)
+        self._jobs_per_chat[chat_id] = self._jobs_per_chat.get(chat_id, 0) + 1
+        self._queue.put_nowait((job_id, chat_id, job, on_start))
+        logger.info(f"Задача {job_id} (чат {chat_id}) добавлена в очередь, впереди: {jobs_ahead}")
+        return jobs_ahead
+
+    async def _worker(self, worker_index):
+        while True:
+            job_id, chat_id, job, on_start = await self._queue.get()
+            self._pending_ids.remove(job_id)
+            self._running += 1
+            try:
+                logger.info(f"Воркер {worker_index} начал задачу {job_id} (чат {chat_id})")
+                if on_start is not None:
+                    try:
+                        await on_start()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        # A failed notification must not drop the job itself
+                        logger.warning(f"Не удалось уведомить о начале задачи {job_id} (чат {chat_id}): {e}")
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Задача {job_id} (чат {chat_id}) завершилась с ошибкой")
+            finally:
+                self._running -= 1
+                remaining = self._jobs_per_chat.get(chat_id, 1) - 1
+                if remaining > 0:
+                    self._jobs_per_chat[chat_id] = remaining
+                else:
+                    self._jobs_per_chat.pop(chat_id, None)
+                self._queue.task_done()
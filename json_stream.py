@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Incremental scanning of a JSON object that arrives in pieces.
+
+A streamed tool call delivers its arguments as a JSON text split at
+arbitrary points. JsonArrayItems follows the text as it grows, tracking
+only nesting depth and string/escape state, and returns every item of one
+top-level array (e.g. "problemAreas") as soon as its closing bracket has
+arrived, parsed with json.loads. Each piece is scanned once and only the
+open item is kept; the caller joins the pieces and json.loads the whole
+text at the end.
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JsonArrayItems:
+    """Items of the array under `key` of the top-level object, as they complete.
+
+    Usage:
+        items = JsonArrayItems("problemAreas")
+        for piece in stream:
+            for item in items.feed(piece):
+                ...
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_parts = None # Pieces of a string at depth 1 while it is open
+        self._last_key = None # Last string completed at depth 1 (an object key, mostly)
+        self._in_array = False
+        self._item_parts = None # Pieces of the open array item
+        self.count = 0
+
+    def feed(self, piece):
+        """Adds the next piece of the text; returns the array items completed by it.
+
+        Only the new piece is scanned; of the text before it just the open
+        item (and key) is kept.
+        """
+        items = []
+        item_start = 0 if self._item_parts is not None else None
+        key_start = 0 if self._key_parts is not None else None
+        for i, char in enumerate(piece):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_parts is not None:
+                        self._last_key = "".join(self._key_parts) + piece[key_start:i]
+                        self._key_parts = None
+                continue
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._key_parts, key_start = [], i + 1
+            elif char in "{[":
+                if char == "[" and self._depth == 1 and self._last_key == self.key:
+                    self._in_array = True
+                elif char == "{" and self._in_array and self._depth == 2:
+                    self._item_parts, item_start = [], i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._in_array and self._depth == 2 and char == "}" and self._item_parts is not None:
+                    items.append(self._parse_item("".join(self._item_parts) + piece[item_start:i + 1]))
+                    self._item_parts = None
+                elif self._in_array and self._depth == 1:
+                    self._in_array = False
+                    self._last_key = None
+        if self._item_parts is not None:
+            self._item_parts.append(piece[item_start:])
+        if self._key_parts is not None:
+            self._key_parts.append(piece[key_start:])
+        return [item for item in items if item is not None]
+
+    def _parse_item(self, item_text):
+        try:
+            item = json.loads(item_text)
+        except json.JSONDecodeError as e:
+            logger.debug(f"Элемент {self.key} не разобран: {e}")
+            return None
+        self.count += 1
+        return item
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of raw LLM responses (GPT tool-call arguments, Gemini text).
+
+Sits below run_gpt_analysis, run_gemini_coordinates and query_gemini, so
+reruns that only change the report or heatmap do not call the APIs again,
+and downstream stages can be benchmarked offline and deterministically.
+
+Entries are keyed by the model name, a hash of the whitespace-normalized
+prompt, a hash of the image bytes sent with it and the request parameters.
+
+Modes (LLM_CACHE_MODE or `--llm-cache`):
+    off        never read or write the cache (default)
+    readwrite  return cached responses, call the API and store on a miss
+    record     always call the API and store (refresh) the response
+    replay     only return cached responses; a miss raises LLMCacheMiss
+
+The cache is capped at LLM_CACHE_MAX_MB; the least recently used entries
+are evicted first. The size is counted once per process and then tracked
+as entries are written, so the directory is only scanned again when the
+estimate exceeds the cap. File access runs in worker threads, off the
+event loop of the concurrent API calls.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODE_OFF = "off"
+MODE_READWRITE = "readwrite"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+CACHE_MODES = (MODE_OFF, MODE_READWRITE, MODE_RECORD, MODE_REPLAY)
+
+DEFAULT_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(SCRIPT_DIR, "llm_cache"))
+DEFAULT_MODE = os.getenv("LLM_CACHE_MODE", MODE_OFF).lower()
+DEFAULT_MAX_BYTES = int(float(os.getenv("LLM_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+
+class LLMCacheMiss(Exception):
+    """Raised in replay mode when a request has no cached response."""
+
+
+def normalize_prompt(prompt):
+    """Collapses whitespace so indentation or trailing-space edits do not change the key."""
+    return " ".join(prompt.split())
+
+
+class LLMCache:
+    """On-disk response cache with record/replay modes and size-capped LRU eviction."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, mode=DEFAULT_MODE, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self._size = None # Estimated bytes on disk; None until the first write scans the directory
+        self._size_lock = threading.Lock()
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, value):
+        if value not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode '{value}', expected one of {', '.join(CACHE_MODES)}")
+        self._mode = value
+
+    @staticmethod
+    def make_key(model, prompt, image_data=None, params=None):
+        """Builds the cache key of a request.
+
+        Args:
+            model: model name.
+            prompt: full prompt text (normalized before hashing).
+            image_data: bytes or str of the image sent with the request, if any.
+            params: dict of other request parameters that change the response
+                (generation config, tool schema).
+        """
+        image_hash = ""
+        if image_data is not None:
+            if isinstance(image_data, str):
+                image_data = image_data.encode("utf-8")
+            image_hash = hashlib.sha256(image_data).hexdigest()
+        payload = json.dumps({
+            "model": model,
+            "prompt": hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest(),
+            "image": image_hash,
+            "params": params or {},
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Returns the cached response for key, or None."""
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # mtime is used as the last access time for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("response")
+
+    def put(self, key, response, model=None):
+        path = self._entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(path))
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"model": model, "created_at": time.time(), "response": response}, f, ensure_ascii=False)
+            written = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить ответ LLM в кэш: {e}")
+            return
+        with self._size_lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += written - replaced
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits into max_bytes."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    async def fetch(self, key, request, model=None):
+        """Returns the response for key according to the cache mode.
+
+        Args:
+            key: result of `make_key`.
+            request: coroutine function performing the API call; its result
+                (a JSON-serializable value, None on failure) is cached.
+            model: model name, stored with the entry for inspection.
+
+        Raises:
+            LLMCacheMiss: in replay mode when the key is not cached.
+        """
+        if self.mode in (MODE_READWRITE, MODE_REPLAY):
+            cached = await asyncio.to_thread(self.get, key)
+            if cached is not None:
+                logger.debug(f"Ответ LLM взят из кэша ({model}, {key[:12]})")
+                return cached
+            if self.mode == MODE_REPLAY:
+                raise LLMCacheMiss(f"LLM cache miss in replay mode ({model}, key {key[:12]})")
+        response = await request()
+        if response is not None and self.mode in (MODE_READWRITE, MODE_RECORD):
+            await asyncio.to_thread(self.put, key, response, model)
+        return response
+
+
+# Shared by every API call in the process
+llm_cache = LLMCache()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Typed, machine-readable result of a pipeline run.
+
+`run_analysis_pipeline.run_pipeline_async` returns a `PipelineResult`; the
+same data is written as JSON to `manifest.json` in the run directory and,
+from the command line, to `--manifest` / `--manifest-fd`. Consumers (bot.py,
+batch jobs) read artifact paths and per-stage status from here instead of
+parsing log output.
+"""
+
+import json
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Stage statuses
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+STATUS_CACHED = "cached"
+STATUS_REUSED = "reused" # Completed in an earlier run of the same run directory (--resume)
+
+# Artifact kinds
+ARTIFACT_GPT_ANALYSIS = "gpt_analysis"
+ARTIFACT_COORDS = "coords"
+ARTIFACT_HEATMAP = "heatmap"
+ARTIFACT_HEATMAP_PREVIEW = "heatmap_preview"
+ARTIFACT_INTERPRETATION = "interpretation"
+ARTIFACT_RECOMMENDATIONS = "recommendations"
+ARTIFACT_REPORT_PDF = "report_pdf"
+ARTIFACT_REPORT_TEX = "report_tex"
+
+
+@dataclass
+class StageResult:
+    """Outcome of one pipeline stage."""
+    name: str
+    status: str
+    duration_s: float = 0.0
+    error: Optional[str] = None
+
+
+@dataclass
+class PipelineResult:
+    """Outcome of a pipeline run: artifacts, per-stage status and timings."""
+    image_path: str
+    run_dir: Optional[str] = None
+    success: bool = False
+    cached: bool = False
+    duration_s: float = 0.0
+    artifacts: Dict[str, str] = field(default_factory=dict)
+    stages: List[StageResult] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+    def artifact(self, kind):
+        """Returns the path of an artifact, or None if it was not produced."""
+        return self.artifacts.get(kind)
+
+    def stage(self, name):
+        """Returns the StageResult with the given name, or None."""
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    @property
+    def error_text(self):
+        return "\n".join(self.errors)
+
+    def to_dict(self):
+        data = asdict(self)
+        data["manifest_version"] = MANIFEST_VERSION
+        return data
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent, ensure_ascii=False)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data.pop("manifest_version", None)
+        data["stages"] = [StageResult(**stage) for stage in data.get("stages", [])]
+        return cls(**data)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Persistent on-disk cache of final pipeline artifacts.
+
+Entries are keyed by a hash of the decoded image pixels together with the
+prompt and model versions, so re-sending the same screenshot (as a photo
+re-upload of the same file, as a document, after a failed delivery) returns
+the stored GPT analysis, coordinates, heatmap, interpretation,
+recommendations and report without any API calls.
+
+Layout: <cache_dir>/<key>/entry.json plus one file per artifact. Entries
+expire after a TTL and the least recently used ones are evicted when the
+cache grows beyond its size limit.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bump when the layout of cached entries or the set of artifacts changes
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(SCRIPT_DIR, "analysis_cache"))
+DEFAULT_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_HOURS", "168")) * 3600
+DEFAULT_MAX_BYTES = int(float(os.getenv("RESULT_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+
+ENTRY_FILE = "entry.json"
+
+
+def image_pixel_hash(image):
+    """Returns a sha256 of the decoded pixels (independent of the file container).
+
+    `image` is a path or an already decoded PIL image.
+    """
+    if not isinstance(image, Image.Image):
+        with Image.open(image) as img:
+            img.load()
+            return image_pixel_hash(img)
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    digest = hashlib.sha256()
+    digest.update(f"{image.width}x{image.height}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def file_hash(path):
+    """Returns the sha256 of a file's contents (empty string if it does not exist)."""
+    if not path or not os.path.exists(path):
+        return ""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed cache of pipeline artifacts with TTL and size-based eviction."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def compute_key(image, versions):
+        """Builds the cache key from the image pixels (path or PIL image) and a dict of prompt/model versions."""
+        payload = json.dumps(
+            {"format": CACHE_FORMAT_VERSION, "image": image_pixel_hash(image), "versions": versions},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_entry(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, ENTRY_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        """Returns {artifact_kind: path} for a fresh entry, or None on a miss."""
+        entry_dir = self._entry_dir(key)
+        entry = self._load_entry(entry_dir)
+        if entry is None:
+            return None
+        if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            logger.info(f"Запись кэша {key[:12]} устарела, удаляю")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        artifacts = {kind: os.path.join(entry_dir, name) for kind, name in entry.get("artifacts", {}).items()}
+        if not all(os.path.exists(path) for path in artifacts.values()):
+            logger.warning(f"Запись кэша {key[:12]} неполная, удаляю")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        # entry.json mtime is used as the last access time for LRU eviction
+        try:
+            os.utime(os.path.join(entry_dir, ENTRY_FILE))
+        except OSError:
+            pass
+        return artifacts
+
+    def put(self, key, artifacts):
+        """Stores {artifact_kind: path} under key. Missing paths are skipped."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        staging_dir = tempfile.mkdtemp(prefix=".staging_", dir=self.cache_dir)
+        try:
+            stored = {}
+            size = 0
+            for kind, path in artifacts.items():
+                if not path or not os.path.exists(path):
+                    continue
+                name = f"{kind}{os.path.splitext(path)[1]}"
+                shutil.copy2(path, os.path.join(staging_dir, name))
+                stored[kind] = name
+                size += os.path.getsize(path)
+            with open(os.path.join(staging_dir, ENTRY_FILE), "w", encoding="utf-8") as f:
+                json.dump({"created_at": time.time(), "size_bytes": size, "artifacts": stored}, f, indent=2)
+            # Publish atomically; a concurrent run may have stored the same key first
+            os.rename(staging_dir, entry_dir)
+            logger.info(f"Результаты сохранены в кэш: {key[:12]} ({size / 1024:.0f} KB)")
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить результаты в кэш {key[:12]}: {e}")
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes expired entries, then least recently used ones until under max_bytes."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry_dir):
+                continue
+            if name.startswith("."):
+                # Leftover staging directory of an interrupted put()
+                if now - os.path.getmtime(entry_dir) > 3600:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            entry = self._load_entry(entry_dir)
+            if entry is None or now - entry.get("created_at", 0) > self.ttl_seconds:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            try:
+                last_access = os.path.getmtime(os.path.join(entry_dir, ENTRY_FILE))
+            except OSError:
+                last_access = 0
+            entries.append((last_access, entry.get("size_bytes", 0), entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logger.info(f"Запись кэша удалена по размеру: {os.path.basename(entry_dir)[:12]}")
+
+    def restore(self, artifacts, destinations):
+        """Places cached artifacts at the given destination paths (hard link, copy as fallback).
+
+        Args:
+            artifacts: {artifact_kind: cached_path} as returned by `get`.
+            destinations: {artifact_kind: destination_path}.
+        """
+        for kind, cached_path in artifacts.items():
+            dest = destinations.get(kind)
+            if not dest:
+                continue
+            try:
+                os.link(cached_path, dest)
+            except OSError:
+                shutil.copy2(cached_path, dest)
@@ -2,384 +2,687 @@
 # Redeploy trigger: bump version to force Railway deploy
 """
 Main pipeline script to run the full visual interface analysis.
+
+The pipeline runs in-process: `run_pipeline_async` can be awaited directly
+(e.g. from bot.py), so the heavy modules (openai, google.generativeai,
+numpy, PIL) and the API clients are loaded once and shared between jobs.
+The command line entry point is a thin wrapper around it.
 """
 
 import os
 import sys
 import json
-import subprocess
+import time
+import asyncio
+import logging
+import shutil
 import argparse
+import tempfile
 from datetime import datetime
-import shutil
-import traceback # Added import
+
+import get_gemini_recommendations
+import generate_report_v2
+import heatmap_engine
+import gemini_localization
+from dataclasses import asdict
+from image_context import ImageContext, upload_profile
+from result_cache import ResultCache, CACHE_ENABLED, file_hash
+from llm_cache import llm_cache, LLMCacheMiss, CACHE_MODES
+from stage_graph import Stage, StageGraph, RESOURCE_LLM, RESOURCE_CPU
+from stage_checkpoint import StageCheckpoints, fingerprint
+from pipeline_manifest import (
+    PipelineResult, StageResult, MANIFEST_FILENAME,
+    STATUS_OK, STATUS_FAILED, STATUS_SKIPPED, STATUS_CACHED, STATUS_REUSED,
+    ARTIFACT_GPT_ANALYSIS, ARTIFACT_COORDS, ARTIFACT_HEATMAP, ARTIFACT_HEATMAP_PREVIEW, ARTIFACT_INTERPRETATION,
+    ARTIFACT_RECOMMENDATIONS, ARTIFACT_REPORT_PDF, ARTIFACT_REPORT_TEX,
+)
+
+logger = logging.getLogger(__name__)
 
 # --- Configuration ---
-# Определяем абсолютные пути к скриптам относительно текущего файла
+# Определяем абсолютные пути относительно текущего файла
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-GET_GEMINI_REC_SCRIPT = os.path.join(SCRIPT_DIR, 'get_gemini_recommendations.py')
-GENERATE_REPORT_SCRIPT = os.path.join(SCRIPT_DIR, 'generate_report_v2.py')
-
-# Check if scripts exist
-if not os.path.exists(GET_GEMINI_REC_SCRIPT):
-    print(f"!!! Ошибка: Скрипт {GET_GEMINI_REC_SCRIPT} не найден !!!")
-    # sys.exit(1) # Or handle differently
-if not os.path.exists(GENERATE_REPORT_SCRIPT):
-    print(f"!!! Ошибка: Скрипт {GENERATE_REPORT_SCRIPT} не найден !!!")
-    # sys.exit(1)
+OUTPUTS_ROOT = os.path.join(SCRIPT_DIR, "analysis_outputs")
 
 # Default paths for prompts (relative to SCRIPT_DIR)
 # Make sure these paths are correct within your project structure
 DEFAULT_GPT_PROMPT = os.path.join(SCRIPT_DIR, 'tests', 'gpt_full_prompt.txt') # Corrected path to tests/
 DEFAULT_INTERPRETATION_PROMPT = os.path.join(SCRIPT_DIR, 'gemini_interpretation_prompt.md')
 DEFAULT_RECOMMENDATIONS_PROMPT = os.path.join(SCRIPT_DIR, 'gemini_recommendations_only_prompt.md')
-DEFAULT_COORDS_PROMPT = os.path.join(SCRIPT_DIR, 'gemini_simple_prompt.md') # Assuming this is the coords prompt
+
+# Analysis context passed to GPT (no interactive input)
+DEFAULT_INTERFACE_TYPE = "Анализируемый интерфейс"
+DEFAULT_USER_SCENARIO = "Общий анализ"
+
+# Verbosity of the pipeline's debug output (stage details, API chatter)
+PIPELINE_LOG_LEVEL = os.getenv("PIPELINE_LOG_LEVEL", "INFO").upper()
+# Loggers of the modules that make up the pipeline
+PIPELINE_LOGGERS = [__name__, "api_test", "get_gemini_recommendations", "generate_report_v2", "result_cache",
+                    "stage_checkpoint", "api_clients", "llm_cache", "heatmap_engine", "image_context",
+                    "gemini_localization", "json_stream"]
+
+# Describes a run directory so it can be resumed later (input image copy, timestamp)
+RUN_INFO_FILENAME = "run.json"
+INPUT_IMAGE_BASENAME = "input_image"
+
+# Shared cache of final artifacts, keyed by image pixels + prompt/model versions
+result_cache = ResultCache()
 
 # --- Helper Functions ---
 
-def run_command(command, description):
-    """Runs a command and prints status."""
-    print(f"--- Запуск: {description} ---")
-    print(f"Команда: {' '.join(command)}")
+def configure_pipeline_logging(level=PIPELINE_LOG_LEVEL):
+    """Sets the log level of every pipeline module (independent of the root logger)."""
+    for name in PIPELINE_LOGGERS:
+        logging.getLogger(name).setLevel(level)
+
+class StageError(Exception):
+    """Raised by a stage to mark it as failed; the message ends up in the manifest."""
+
+def load_api_module():
+    """Imports tests/api_test.py once per process and returns the module.
+
+    api_test creates the OpenAI client and configures Gemini at import time,
+    so every pipeline run in this process shares the same clients.
+    """
+    tests_dir = os.path.join(SCRIPT_DIR, 'tests')
+    if tests_dir not in sys.path:
+        sys.path.insert(0, tests_dir) # Add tests dir to path for import
+    import api_test
+    return api_test
+
+def create_run_dir(output_root=None):
+    """Creates a unique run directory and returns (run_timestamp, output_dir)."""
+    output_root = output_root or OUTPUTS_ROOT
+    os.makedirs(output_root, exist_ok=True)
+    run_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # mkdtemp guarantees uniqueness when several jobs start within the same second
+    output_dir = tempfile.mkdtemp(prefix=f"run_{run_timestamp}_", dir=output_root)
+    return run_timestamp, output_dir
+
+def upload_profiles(api_test):
+    """Returns {model: UploadProfile as dict} for the models that receive the screenshot."""
+    return {model: asdict(upload_profile(model)) for model in (api_test.GPT_MODEL, api_test.GEMINI_MODEL)}
+
+def pipeline_versions(api_test):
+    """Returns the prompt and model versions that determine the pipeline output."""
+    return {
+        "gpt_model": api_test.GPT_MODEL,
+        "gemini_model": api_test.GEMINI_MODEL,
+        "uploads": upload_profiles(api_test),
+        "coords": gemini_localization.settings(),
+        "interface_type": DEFAULT_INTERFACE_TYPE,
+        "user_scenario": DEFAULT_USER_SCENARIO,
+        "gpt_prompt": file_hash(DEFAULT_GPT_PROMPT),
+        "interpretation_prompt": file_hash(DEFAULT_INTERPRETATION_PROMPT),
+        "recommendations_prompt": file_hash(DEFAULT_RECOMMENDATIONS_PROMPT),
+    }
+
+def lookup_cache_key(image):
+    """Computes the result cache key for an ImageContext; returns None if it cannot be computed."""
+    try:
+        return ResultCache.compute_key(image.image(), pipeline_versions(load_api_module()))
+    except Exception as e:
+        logger.warning(f"Не удалось вычислить ключ кэша: {e}")
+        return None
+
+# --- Pipeline Stages ---
+
+class PipelineRun:
+    """State shared by the stages of one pipeline run: input, output paths and intermediate data.
+
+    `image` (ImageContext) holds the decoded screenshot and its encodings
+    for all stages; it may be created from another copy of the same file.
+    """
+
+    def __init__(self, image_path, run_timestamp, output_dir, image=None):
+        self.image_path = image_path
+        self.image = image or ImageContext(image_path)
+        self.run_timestamp = run_timestamp
+        self.output_dir = output_dir
+        self.checkpoints = StageCheckpoints(output_dir)
+        # --- Define output file paths ---
+        self.uploads_output = os.path.join(output_dir, f"uploads_{run_timestamp}.json")
+        self.detections_output = os.path.join(output_dir, f"gemini_detections_{run_timestamp}.json")
+        self.gpt_analysis_output = os.path.join(output_dir, f"gpt_analysis_{run_timestamp}.json")
+        self.gemini_coords_raw_output = os.path.join(output_dir, f"gemini_coords_raw_{run_timestamp}.json")
+        self.gemini_coords_parsed_output = os.path.join(output_dir, f"gemini_coords_parsed_{run_timestamp}.json")
+        self.heatmap_output = os.path.join(output_dir, f"heatmap_{run_timestamp}.png")
+        self.heatmap_intensity_output = heatmap_engine.intensity_path(self.heatmap_output)
+        self.heatmap_report_output = heatmap_engine.report_heatmap_path(self.heatmap_output)
+        self.heatmap_preview_output = heatmap_engine.preview_heatmap_path(self.heatmap_output)
+        # Only categories that have problem areas get a figure
+        self.heatmap_category_outputs = [heatmap_engine.category_heatmap_path(self.heatmap_output, key)
+                                         for key in heatmap_engine.CATEGORY_KEYS]
+        self.interpretation_output = os.path.join(output_dir, f"interpretation_{run_timestamp}.json")
+        self.recommendations_output = os.path.join(output_dir, f"recommendations_{run_timestamp}.json")
+        self.report_base_output = os.path.join(output_dir, f"report_{run_timestamp}") # Base name for .tex and .pdf
+        self.gpt_result_data = None
+        self.coords_result_data = None
+        self.coords_prefetch = None # gemini_localization.CoordinatePrefetch of a streamed GPT analysis
+        self._gemini_semaphore = None
+
+    @property
+    def artifact_paths(self):
+        """Expected location of every final artifact of the run."""
+        return {
+            ARTIFACT_GPT_ANALYSIS: self.gpt_analysis_output,
+            ARTIFACT_COORDS: self.gemini_coords_parsed_output,
+            ARTIFACT_HEATMAP: self.heatmap_output,
+            ARTIFACT_HEATMAP_PREVIEW: self.heatmap_preview_output,
+            ARTIFACT_INTERPRETATION: self.interpretation_output,
+            ARTIFACT_RECOMMENDATIONS: self.recommendations_output,
+            ARTIFACT_REPORT_PDF: f"{self.report_base_output}.pdf",
+            ARTIFACT_REPORT_TEX: f"{self.report_base_output}.tex",
+        }
+
+    @property
+    def gemini_semaphore(self):
+        """Limit of the run's concurrent Gemini box requests: detection, prefetch and coordinates share it."""
+        if self._gemini_semaphore is None:
+            self._gemini_semaphore = gemini_localization.request_semaphore()
+        return self._gemini_semaphore
+
+    def cancel_coords_prefetch(self):
+        """Stops the prefetched coordinate requests still running and drops the prefetch."""
+        if self.coords_prefetch is not None:
+            self.coords_prefetch.cancel()
+            self.coords_prefetch = None
+
+    @classmethod
+    def create(cls, image_path, run_timestamp, output_dir, image=None):
+        """Starts a new run: keeps a copy of the input image and writes run.json for --resume."""
+        input_image = os.path.join(output_dir, INPUT_IMAGE_BASENAME + os.path.splitext(image_path)[1].lower())
+        shutil.copy2(image_path, input_image)
+        with open(os.path.join(output_dir, RUN_INFO_FILENAME), "w", encoding="utf-8") as f:
+            json.dump({
+                "image_path": os.path.abspath(image_path),
+                "input_image": os.path.basename(input_image),
+                "run_timestamp": run_timestamp,
+            }, f, indent=2, ensure_ascii=False)
+        return cls(input_image, run_timestamp, output_dir, image)
+
+    @classmethod
+    def load(cls, run_dir):
+        """Reopens an existing run directory. Returns (run, original image path)."""
+        with open(os.path.join(run_dir, RUN_INFO_FILENAME), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        run = cls(os.path.join(run_dir, info["input_image"]), info["run_timestamp"], run_dir)
+        return run, info.get("image_path", run.image_path)
+
+    def stage_io(self, name):
+        """Returns (input files, parameters, output files) of a stage, used for its checkpoint."""
+        api_test = load_api_module()
+        if name == STAGE_PREPROCESS:
+            return [self.image_path], {"uploads": upload_profiles(api_test)}, [self.uploads_output]
+        if name == STAGE_GPT:
+            return ([self.image_path, DEFAULT_GPT_PROMPT],
+                    {"model": api_test.GPT_MODEL, "interface_type": DEFAULT_INTERFACE_TYPE,
+                     "user_scenario": DEFAULT_USER_SCENARIO, "upload": asdict(upload_profile(api_test.GPT_MODEL))},
+                    [self.gpt_analysis_output])
+        if name == STAGE_DETECT:
+            return ([self.image_path],
+                    {"model": api_test.GEMINI_MODEL, "upload": asdict(upload_profile(api_test.GEMINI_MODEL)),
+                     "detection": gemini_localization.detection_settings()},
+                    [self.detections_output] if gemini_localization.COORDS_SPECULATIVE_DETECTION else [])
+        if name == STAGE_COORDS:
+            # The detected elements are an optional input: a missing file hashes as ""
+            return ([self.image_path, self.gpt_analysis_output, self.detections_output],
+                    {"model": api_test.GEMINI_MODEL, "upload": asdict(upload_profile(api_test.GEMINI_MODEL)),
+                     "localization": gemini_localization.settings()},
+                    [self.gemini_coords_raw_output, self.gemini_coords_parsed_output])
+        if name == STAGE_HEATMAP:
+            return ([self.image_path, self.gpt_analysis_output, self.gemini_coords_parsed_output], {},
+                    [self.heatmap_output, self.heatmap_report_output, self.heatmap_preview_output,
+                     self.heatmap_intensity_output])
+        if name == STAGE_INTERPRETATION:
+            return ([self.gpt_analysis_output, DEFAULT_INTERPRETATION_PROMPT],
+                    {"model": get_gemini_recommendations.GEMINI_MODEL}, [self.interpretation_output])
+        if name == STAGE_RECOMMENDATIONS:
+            return ([self.gpt_analysis_output, DEFAULT_RECOMMENDATIONS_PROMPT],
+                    {"model": get_gemini_recommendations.GEMINI_MODEL}, [self.recommendations_output])
+        if name == STAGE_REPORT:
+            # Coordinates and heatmap are optional inputs: a missing file hashes as ""
+            return ([self.image_path, self.gpt_analysis_output, self.gemini_coords_parsed_output, self.heatmap_output,
+                     self.heatmap_report_output, self.heatmap_intensity_output, *self.heatmap_category_outputs], {},
+                    [f"{self.report_base_output}.tex", f"{self.report_base_output}.pdf"])
+        raise KeyError(name)
+
+    def load_stage_data(self, name):
+        """Loads the in-memory results of a stage reused from an earlier run."""
+        if name == STAGE_GPT:
+            with open(self.gpt_analysis_output, "r", encoding="utf-8") as f:
+                self.gpt_result_data = json.load(f)
+        elif name == STAGE_COORDS:
+            with open(self.gemini_coords_parsed_output, "r", encoding="utf-8") as f:
+                self.coords_result_data = load_api_module().coordinates_for_heatmap(json.load(f))
+
+async def stage_preprocess(run):
+    """Screenshot resized and encoded for each model (image_context.upload_profile).
+
+    The uploads stay in run.image for the API stages; uploads.json records
+    the sizes sent and the scale factors back to the original pixels.
+    """
+    api_test = load_api_module()
+    models = (api_test.GPT_MODEL, api_test.GEMINI_MODEL)
+    uploads = await asyncio.gather(*(asyncio.to_thread(run.image.encoded, upload_profile(model)) for model in models))
+    info = {model: upload.describe() for model, upload in zip(models, uploads)}
+    for model, upload in info.items():
+        logger.debug(f"Загрузка для {model}: {upload['size']} из {upload['original_size']}, {upload['bytes']} байт")
+    with open(run.uploads_output, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2, ensure_ascii=False)
+
+async def stage_gpt_analysis(run):
+    """GPT-4.1 analysis of the screenshot (api_test.run_gpt_analysis).
+
+    With GPT_STREAMING the coordinate requests for the first problem areas
+    start while GPT is still writing the others (run.coords_prefetch). The
+    run owns the prefetch: the coordinates stage or the end of the run
+    cancels what is left of it.
+    """
+    # Check if the prompt file exists
+    if not os.path.exists(DEFAULT_GPT_PROMPT):
+        raise StageError(f"Prompt file not found: {DEFAULT_GPT_PROMPT}")
+    try:
+        api_test = load_api_module()
+    except ImportError as e:
+        raise StageError(f"Failed to import from api_test.py: {e}")
+    logger.debug(f"Тип интерфейса: {DEFAULT_INTERFACE_TYPE}; Сценарий: {DEFAULT_USER_SCENARIO}")
+    run.cancel_coords_prefetch()
+    if api_test.GPT_STREAMING:
+        run.coords_prefetch = gemini_localization.CoordinatePrefetch(
+            run.image, api_test.GEMINI_MODEL, upload_profile(api_test.GEMINI_MODEL), run.gemini_semaphore)
+    try:
+        success, run.gpt_result_data = await api_test.run_gpt_analysis_async(
+            image_path=run.image_path,
+            output_json_path=run.gpt_analysis_output,
+            interface_type=DEFAULT_INTERFACE_TYPE,
+            user_scenario=DEFAULT_USER_SCENARIO,
+            image=run.image,
+            on_problem_area=run.coords_prefetch.add if run.coords_prefetch else None,
+        )
+    except BaseException:
+        run.cancel_coords_prefetch()
+        raise
+    if not success:
+        run.cancel_coords_prefetch()
+        raise StageError("GPT-4 Analysis failed.")
+    if run.coords_prefetch and not run.coords_prefetch.started:
+        run.coords_prefetch = None
+
+async def stage_element_detection(run):
+    """Gemini boxes of all UI elements, requested while GPT is still running (api_test.run_gemini_detection).
+
+    Only with COORDS_SPECULATIVE_DETECTION; the coordinates stage matches
+    the problem areas to these elements and requests only the rest.
+    """
+    if not gemini_localization.COORDS_SPECULATIVE_DETECTION:
+        logger.debug("Обнаружение элементов выключено (COORDS_SPECULATIVE_DETECTION)")
+        return
+    api_test = load_api_module()
+    detections = await api_test.run_gemini_detection_async(
+        image_path=run.image_path,
+        output_json_path=run.detections_output,
+        image=run.image,
+        semaphore=run.gemini_semaphore,
+    )
+    if detections is None:
+        raise StageError("Gemini element detection failed; all problem areas will be requested.")
+
+def load_detections(run):
+    """Elements found by the element_detection stage, or None."""
+    if not gemini_localization.COORDS_SPECULATIVE_DETECTION or not os.path.exists(run.detections_output):
+        return None
+    try:
+        with open(run.detections_output, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать обнаруженные элементы {run.detections_output}: {e}")
+        return None
+
+async def stage_gemini_coordinates(run):
+    """Gemini bounding boxes for the GPT problem areas (api_test.run_gemini_coordinates)."""
+    try:
+        api_test = load_api_module()
+        run.coords_result_data = await api_test.run_gemini_coordinates_async(
+            image_path=run.image_path,
+            gpt_result_data=run.gpt_result_data,
+            output_raw_json_path=run.gemini_coords_raw_output,
+            output_parsed_json_path=run.gemini_coords_parsed_output,
+            image=run.image,
+            detections=await asyncio.to_thread(load_detections, run),
+            prefetch=run.coords_prefetch,
+            semaphore=run.gemini_semaphore,
+        )
+    finally:
+        # Nothing is left running whether the prefetch was used or the stage failed first
+        run.cancel_coords_prefetch()
+    if not run.coords_result_data:
+        raise StageError("Gemini Coordinates failed; continuing without coordinates.")
+
+async def stage_heatmap(run):
+    """Heatmap of the problem areas (api_test.generate_heatmap)."""
+    api_test = load_api_module()
+    success = await asyncio.to_thread(
+        api_test.generate_heatmap,
+        image_path=run.image_path,
+        coordinates_data=run.coords_result_data, # Pass the loaded coords dictionary
+        gpt_result_data=run.gpt_result_data, # Pass the loaded gpt dictionary
+        output_heatmap_path=run.heatmap_output,
+        image=run.image,
+    )
+    if not success:
+        raise StageError("Heatmap Generation failed.")
+
+async def _gemini_text_stage(run, stage_name, prompt_path, output_path):
+    if not os.path.exists(prompt_path):
+        raise StageError(f"{stage_name} prompt file not found: {prompt_path}")
+    success = await get_gemini_recommendations.generate_gemini_response_async(
+        run.gpt_analysis_output,
+        prompt_path,
+        output_path,
+    )
+    if not success:
+        raise StageError(f"Gemini {stage_name} failed.")
+
+async def stage_interpretation(run):
+    """Gemini interpretation of the GPT analysis (get_gemini_recommendations.py)."""
+    await _gemini_text_stage(run, "Interpretation", DEFAULT_INTERPRETATION_PROMPT, run.interpretation_output)
+
+async def stage_recommendations(run):
+    """Gemini recommendations based on the GPT analysis (get_gemini_recommendations.py)."""
+    await _gemini_text_stage(run, "Recommendations", DEFAULT_RECOMMENDATIONS_PROMPT, run.recommendations_output)
+
+async def stage_report(run):
+    """LaTeX + PDF report (generate_report_v2.generate_report)."""
+    tex_path, _ = await asyncio.to_thread(
+        generate_report_v2.generate_report,
+        run.gpt_analysis_output,
+        run.report_base_output,
+        image_path=run.image_path,
+        # Add optional files if they exist
+        gemini_data_path=run.gemini_coords_parsed_output if os.path.exists(run.gemini_coords_parsed_output) else None,
+        heatmap_path=run.heatmap_output if os.path.exists(run.heatmap_output) else None,
+        pdf=True, # Always generate PDF
+        image=run.image,
+    )
+    if not tex_path:
+        raise StageError("Report Generation failed.")
+
+async def run_stage(result, name, stage_func, run):
+    """Runs one stage, records its status and timing in the result. Returns True on success.
+
+    A stage whose checkpoint in the run directory matches its current inputs
+    is not executed again; its outputs are reused.
+    """
+    started = time.perf_counter()
+    stage_fingerprint = None
+    try:
+        input_paths, params, output_paths = run.stage_io(name)
+        stage_fingerprint = await asyncio.to_thread(fingerprint, input_paths, params)
+        if run.checkpoints.is_fresh(name, stage_fingerprint):
+            run.load_stage_data(name)
+            logger.info(f"--- Использован готовый результат: {name} ---")
+            result.stages.append(StageResult(name=name, status=STATUS_REUSED))
+            return True
+    except Exception as e:
+        # A broken checkpoint only means the stage runs again
+        logger.warning(f"Не удалось проверить контрольную точку этапа {name}: {e}")
+
+    logger.info(f"--- Запуск: {name} ---")
+    run.checkpoints.invalidate(name)
     try:
-        # Changed to run without shell=True for better security and argument handling
-        result = subprocess.run(command, capture_output=True, text=True, check=False, encoding='utf-8') # check=False to handle errors manually
-        print("Вывод:")
-        print(result.stdout)
-        if result.stderr:
-            print("Ошибки (stderr):") # Clarify this is stderr
-            print(result.stderr)
-        
-        if result.returncode != 0:
-            print(f"!!! Ошибка выполнения {description}: Команда завершилась с кодом {result.returncode}")
-            print(f"--- Ошибка: {description} ---")
-            return False, result.stderr or result.stdout # Return stderr if available, otherwise stdout
-        
-        print(f"--- Успешно: {description} ---")
-        return True, result.stdout
-    except FileNotFoundError as e:
-        print(f"!!! Ошибка: Команда или скрипт не найден: {e}")
-        print(f"--- Ошибка: {description} ---")
-        return False, str(e)
+        await stage_func(run)
+        status, error = STATUS_OK, None
+        logger.info(f"--- Успешно: {name} ---")
+        if stage_fingerprint:
+            run.checkpoints.mark_done(name, stage_fingerprint, output_paths)
+    except (StageError, LLMCacheMiss) as e:
+        status, error = STATUS_FAILED, str(e)
+        logger.error(f"Ошибка этапа {name}: {e}")
     except Exception as e:
-        print(f"!!! Неожиданная ошибка при выполнении {description}: {e}")
-        traceback.print_exc() # Print traceback for unexpected errors
-        print(f"--- Ошибка: {description} ---")
-        return False, str(e)
+        status, error = STATUS_FAILED, f"Unexpected error in {name}: {e}"
+        logger.exception(f"Неожиданная ошибка этапа {name}: {e}")
+    stage = StageResult(name=name, status=status, duration_s=round(time.perf_counter() - started, 3), error=error)
+    result.stages.append(stage)
+    if error:
+        result.errors.append(error)
+    return status == STATUS_OK
+
+def skip_stage(result, name, reason):
+    logger.info(f"--- Пропуск: {name} ({reason}) ---")
+    result.stages.append(StageResult(name=name, status=STATUS_SKIPPED, error=reason))
+
+# Stage names as they appear in the manifest
+STAGE_PREPROCESS = "preprocess"
+STAGE_GPT = "gpt_analysis"
+STAGE_DETECT = "element_detection"
+STAGE_COORDS = "gemini_coordinates"
+STAGE_HEATMAP = "heatmap"
+STAGE_INTERPRETATION = "interpretation"
+STAGE_RECOMMENDATIONS = "recommendations"
+STAGE_REPORT = "report"
+
+# Interpretation and recommendations only need the GPT analysis, so they run
+# alongside coordinates + heatmap; the report waits for the heatmap (optional).
+# The element detection (optional) runs alongside the GPT analysis; the
+# coordinates use it if it succeeded
+PIPELINE_GRAPH = StageGraph([
+    # Short and on the critical path: not queued behind the heatmaps and reports of other jobs
+    Stage(STAGE_PREPROCESS, stage_preprocess),
+    Stage(STAGE_GPT, stage_gpt_analysis, requires=(STAGE_PREPROCESS,), resource=RESOURCE_LLM),
+    Stage(STAGE_DETECT, stage_element_detection, requires=(STAGE_PREPROCESS,), resource=RESOURCE_LLM),
+    Stage(STAGE_COORDS, stage_gemini_coordinates, requires=(STAGE_GPT,), after=(STAGE_DETECT,), resource=RESOURCE_LLM),
+    Stage(STAGE_HEATMAP, stage_heatmap, requires=(STAGE_COORDS,), resource=RESOURCE_CPU),
+    Stage(STAGE_INTERPRETATION, stage_interpretation, requires=(STAGE_GPT,), resource=RESOURCE_LLM),
+    Stage(STAGE_RECOMMENDATIONS, stage_recommendations, requires=(STAGE_GPT,), resource=RESOURCE_LLM),
+    Stage(STAGE_REPORT, stage_report, requires=(STAGE_GPT,), after=(STAGE_HEATMAP,), resource=RESOURCE_CPU),
+])
 
 # --- Main Pipeline Logic ---
-def run_pipeline(image_path):
-    """Runs the entire analysis pipeline."""
+async def run_pipeline_async(image_path, output_root=None, use_cache=CACHE_ENABLED, limits=None):
+    """Runs the entire analysis pipeline in the current process.
+
+    Stages run concurrently as far as PIPELINE_GRAPH allows. API calls use
+    the shared async clients (api_clients.py); blocking work (heatmap
+    rendering, pdflatex) is run in worker threads so the event loop of the
+    caller stays responsive. With
+    ``use_cache`` a previously analyzed image (same pixels, same prompts and
+    models) is served from the result cache without any API calls.
+    ``limits`` ({"llm": Semaphore, "cpu": Semaphore}) caps API-bound and
+    CPU-bound stages when several pipelines share one event loop.
+
+    Returns:
+        PipelineResult: artifact paths, per-stage status and timings. The same
+        data is saved as manifest.json in the run directory.
+    """
+    started = time.perf_counter()
+    result = PipelineResult(image_path=image_path)
+
     if not os.path.exists(image_path):
-        print(f"!!! Ошибка: Файл изображения не найден по пути {image_path} !!!")
-        return
+        logger.error(f"Файл изображения не найден по пути {image_path}")
+        result.errors.append(f"Image file not found: {image_path}")
+        return result
+
+    # Decoded at most once for the whole run (cache key and every stage)
+    image = ImageContext(image_path)
+    cache_key = None
+    cached_artifacts = None
+    if use_cache:
+        cache_key = await asyncio.to_thread(lookup_cache_key, image)
+        if cache_key:
+            cached_artifacts = await asyncio.to_thread(result_cache.get, cache_key)
 
-    # Generate a unique run ID based on timestamp
-    run_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join(SCRIPT_DIR, f"analysis_outputs/run_{run_timestamp}")
     try:
-        os.makedirs(output_dir, exist_ok=True)
-        print(f"--- Результаты будут сохранены в: {output_dir.replace(SCRIPT_DIR, '.') } --- \n")
+        run_timestamp, output_dir = create_run_dir(output_root)
     except OSError as e:
-         print(f"!!! Ошибка создания директории {output_dir}: {e} !!!")
-         return
-
-    # --- Define output file paths ---
-    gpt_analysis_output = os.path.join(output_dir, f"gpt_analysis_{run_timestamp}.json")
-    gemini_coords_raw_output = os.path.join(output_dir, f"gemini_coords_raw_{run_timestamp}.json")
-    gemini_coords_parsed_output = os.path.join(output_dir, f"gemini_coords_parsed_{run_timestamp}.json")
-    heatmap_output = os.path.join(output_dir, f"heatmap_{run_timestamp}.png")
-    interpretation_output = os.path.join(output_dir, f"interpretation_{run_timestamp}.json")
-    recommendations_output = os.path.join(output_dir, f"recommendations_{run_timestamp}.json")
-    report_base_output = os.path.join(output_dir, f"report_{run_timestamp}") # Base name for .tex and .pdf
-    report_pdf_output = f"{report_base_output}.pdf"
-
-    pipeline_success = True
-    pipeline_error_details = ""
+        logger.error(f"Ошибка создания директории для результатов: {e}")
+        result.errors.append(f"Failed to create output directory: {e}")
+        return result
+    result.run_dir = output_dir
+    logger.info(f"--- Результаты будут сохранены в: {output_dir} ---")
+
+    if cached_artifacts is not None:
+        run = PipelineRun(image_path, run_timestamp, output_dir)
+        logger.info(f"--- Найден результат в кэше ({cache_key[:12]}), анализ не требуется ---")
+        await asyncio.to_thread(result_cache.restore, cached_artifacts, run.artifact_paths)
+        result.cached = True
+        result.stages.append(StageResult(name="result_cache", status=STATUS_CACHED))
+        return finish_result(result, run, started)
 
     try:
-        # --- 1. Set Context (No interactive input) ---
-        # Using default values instead of input()
-        interface_type = "Анализируемый интерфейс" 
-        user_scenario = "Общий анализ"
-        print("--- Контекст анализа (задан по умолчанию) ---")
-        print(f"    Тип интерфейса: {interface_type}")
-        print(f"    Сценарий: {user_scenario}")
-
-        # --- 2. Run GPT-4 Analysis (Using api_test.py function) ---
-        print(f"--- Запуск GPT-4.1 Анализа для: {image_path} ---")
-        try:
-            # Dynamically import api_test.py or ensure it's in PYTHONPATH
-            # Assuming api_test is in the 'tests' subdirectory relative to SCRIPT_DIR
-            tests_dir = os.path.join(SCRIPT_DIR, 'tests')
-            if tests_dir not in sys.path:
-                sys.path.insert(0, tests_dir) # Add tests dir to path for import
-                
-            # Check if the prompt file exists
-            if not os.path.exists(DEFAULT_GPT_PROMPT):
-                 print(f"!!! Ошибка: Файл GPT промпта не найден: {DEFAULT_GPT_PROMPT} !!!")
-                 raise FileNotFoundError(f"Prompt file not found: {DEFAULT_GPT_PROMPT}")
-            
-            from api_test import run_gpt_analysis # Corrected function name
-
-            success, gpt_result_data = run_gpt_analysis( # Corrected function call
-                image_path=image_path,
-                output_json_path=gpt_analysis_output,
-                interface_type=interface_type,
-                user_scenario=user_scenario,
-                # Pass the correct gpt_prompt_path here if run_gpt_analysis needs it
-                # gpt_prompt_path=DEFAULT_GPT_PROMPT # This might be handled inside run_gpt_analysis now
-            )
-            if not success:
-                print("!!! Ошибка выполнения GPT-4.1 Анализа через api_test.py !!!")
-                pipeline_success = False
-                pipeline_error_details += "GPT-4 Analysis failed.\n"
-            else:
-                print(f"    Результат GPT анализа сохранен в: {gpt_analysis_output}")
-                print("--- Успешно: GPT-4.1 Анализ ---")
-
-        except ImportError as e:
-            print(f"!!! Ошибка импорта функций из tests/api_test.py: {e} !!!")
-            print("Убедитесь, что файл tests/api_test.py существует и python может его найти.")
-            pipeline_success = False
-            pipeline_error_details += "Failed to import from api_test.py.\n"
-        except FileNotFoundError as e:
-            print(f"!!! Ошибка: {e} !!!") # Print file not found error from above check
-            pipeline_success = False
-            pipeline_error_details += str(e)
-        except Exception as e:
-            print(f"!!! Ошибка при вызове функции из api_test.py: {e} !!!")
-            traceback.print_exc()
-            pipeline_success = False
-            pipeline_error_details += f"Error during api_test.py execution: {e}\n"
-
-        # --- 3. Run Gemini Coordinates (Using api_test.py function) ---
-        if pipeline_success: 
-            print(f"--- Запуск Gemini Координат для: {image_path} ---")
-            try:
-                # Ensure tests dir is still in path if needed
-                tests_dir = os.path.join(SCRIPT_DIR, 'tests')
-                if tests_dir not in sys.path:
-                     sys.path.insert(0, tests_dir)
-                
-                if not os.path.exists(DEFAULT_COORDS_PROMPT):
-                     print(f"!!! Ошибка: Файл Gemini координат промпта не найден: {DEFAULT_COORDS_PROMPT} !!!")
-                     raise FileNotFoundError(f"Coords prompt file not found: {DEFAULT_COORDS_PROMPT}")
-                     
-                # Загружаем шаблон промпта для координат и заменяем переменные
-                try:
-                    with open(DEFAULT_COORDS_PROMPT, 'r', encoding='utf-8') as f:
-                        coordinates_prompt_template = f.read()
-                    
-                    # Подготовка списка проблемных областей для Gemini
-                    problem_areas = gpt_result_data.get("problemAreas", [])
-                    if not problem_areas:
-                        print("!!! Предупреждение: В данных GPT анализа нет проблемных областей !!!")
-                    
-                    # Преобразуем данные анализа в JSON строку для вставки в промпт
-                    analysis_json = json.dumps(gpt_result_data, indent=2, ensure_ascii=False)
-                    # Заменяем плейсхолдер в шаблоне на реальные данные
-                    gemini_coords_prompt = coordinates_prompt_template.replace("{analysis_json}", analysis_json)
-                except Exception as e:
-                    print(f"!!! Ошибка при подготовке промпта координат: {e} !!!")
-                    raise ValueError(f"Error preparing coordinates prompt: {e}")
-                     
-                from api_test import run_gemini_coordinates # Corrected function name
-                
-                # Check if gpt_result_data exists from previous step
-                if 'gpt_result_data' not in locals() or gpt_result_data is None:
-                    print("!!! Ошибка: Данные GPT анализа отсутствуют, невозможно запустить Gemini Координаты !!!")
-                    raise ValueError("Missing GPT analysis data for Gemini Coordinates")
-                    
-                coords_result_data = run_gemini_coordinates(
-                    image_path=image_path,
-                    gpt_result_data=gpt_result_data,
-                    output_raw_json_path=gemini_coords_raw_output,
-                    output_parsed_json_path=gemini_coords_parsed_output,
-                    formatted_prompt=gemini_coords_prompt
-                )
-                if not coords_result_data:
-                    print("!!! Предупреждение: Gemini Координаты не были получены; продолжаю без координат и тепловой карты !!!")
-                    pipeline_error_details += "Gemini Coordinates failed; continuing without coordinates.\n"
-                else:
-                    print(f"    Raw Gemini ответ сохранен в: {gemini_coords_raw_output}")
-                    print(f"    Распарсенный Gemini ответ сохранен в: {gemini_coords_parsed_output}")
-                    print("--- Успешно: Gemini Координаты ---")
-
-            except ImportError as e:
-                print(f"!!! Ошибка импорта функций из tests/api_test.py (для Координат): {e} !!!")
-                pipeline_error_details += "Failed to import from api_test.py (for Coords).\n"
-            except FileNotFoundError as e:
-                print(f"!!! Ошибка: {e} !!!") 
-                pipeline_error_details += str(e) + "\n"
-            except Exception as e:
-                print(f"!!! Ошибка при вызове функции из api_test.py (для Координат): {e} !!!")
-                traceback.print_exc()
-                pipeline_error_details += f"Error during api_test.py execution (for Coords): {e}\n"
-
-        # --- 4. Generate Heatmap (Using api_test.py function) ---
-        if pipeline_success and os.path.exists(gemini_coords_parsed_output):
-            print(f"--- Запуск Генерации Тепловой Карты для: {image_path} ---")
-            print(f"    Сохранение в: {heatmap_output}")
-            try:
-                # Ensure tests dir is still in path if needed
-                tests_dir = os.path.join(SCRIPT_DIR, 'tests')
-                if tests_dir not in sys.path:
-                     sys.path.insert(0, tests_dir)
-                     
-                from api_test import generate_heatmap # Corrected function name
-
-                # Check if needed data exists
-                if 'gpt_result_data' not in locals() or gpt_result_data is None:
-                    print("!!! Ошибка: Данные GPT анализа отсутствуют, невозможно запустить Генерацию Тепловой Карты !!!")
-                    raise ValueError("Missing GPT analysis data for Heatmap Generation")
-                if 'coords_result_data' not in locals() or coords_result_data is None:
-                     print("!!! Ошибка: Данные координат отсутствуют, невозможно запустить Генерацию Тепловой Карты !!!")
-                     raise ValueError("Missing Coordinates data for Heatmap Generation")
-
-                # Pass the loaded dictionary for gpt_result_data
-                # Pass the dictionary returned by run_gemini_coordinates for coordinates_data
-                success = generate_heatmap( # Corrected function call
-                    image_path=image_path,
-                    coordinates_data=coords_result_data, # Pass the loaded coords dictionary
-                    gpt_result_data=gpt_result_data, # Pass the loaded gpt dictionary
-                    output_heatmap_path=heatmap_output
-                )
-                if not success:
-                    print("!!! Ошибка Генерации Тепловой Карты через api_test.py !!!")
-                    # pipeline_success = False # Maybe not critical
-                    pipeline_error_details += "Heatmap Generation failed.\n"
-                else:
-                    print(f"    Тепловая карта успешно сгенерирована и сохранена в: {heatmap_output}")
-                    print("--- Успешно: Генерация Тепловой Карты ---")
-
-            except ImportError as e:
-                print(f"!!! Ошибка импорта функций из tests/api_test.py (для Тепловой Карты): {e} !!!")
-                pipeline_error_details += "Failed to import from api_test.py (for Heatmap).\n"
-            except Exception as e:
-                print(f"!!! Ошибка при вызове функции из api_test.py (для Тепловой Карты): {e} !!!")
-                traceback.print_exc()
-                pipeline_error_details += f"Error during api_test.py execution (for Heatmap): {e}\n"
-        elif pipeline_success: # Only print skip message if coords step was attempted but failed/skipped
-            print("--- Пропуск Генерации Тепловой Карты (нет файла координат) --- ")
-
-        # --- 5. Run Gemini Interpretation --- (Uses get_gemini_recommendations.py script)
-        if pipeline_success and os.path.exists(gpt_analysis_output):
-             if not os.path.exists(DEFAULT_INTERPRETATION_PROMPT):
-                  print(f"!!! Ошибка: Файл промпта Интерпретации не найден: {DEFAULT_INTERPRETATION_PROMPT} !!!")
-                  pipeline_success = False
-                  pipeline_error_details += f"Interpretation prompt file not found: {DEFAULT_INTERPRETATION_PROMPT}\n"
-             else:
-                 command = [
-                     sys.executable, GET_GEMINI_REC_SCRIPT,
-                     '--input', gpt_analysis_output,
-                     '--prompt-file', DEFAULT_INTERPRETATION_PROMPT,
-                     '--output', interpretation_output
-                 ]
-                 success, stderr_out = run_command(command, "Gemini Интерпретация")
-                 if not success:
-                     pipeline_success = False
-                     pipeline_error_details += f"Gemini Interpretation failed. Details: {stderr_out}\n"
-        elif pipeline_success:
-            print("--- Пропуск Gemini Интерпретации (нет файла GPT анализа) --- ")
-
-        # --- 6. Run Gemini Recommendations --- (Uses get_gemini_recommendations.py script)
-        if pipeline_success and os.path.exists(gpt_analysis_output):
-            if not os.path.exists(DEFAULT_RECOMMENDATIONS_PROMPT):
-                 print(f"!!! Ошибка: Файл промпта Рекомендаций не найден: {DEFAULT_RECOMMENDATIONS_PROMPT} !!!")
-                 pipeline_success = False
-                 pipeline_error_details += f"Recommendations prompt file not found: {DEFAULT_RECOMMENDATIONS_PROMPT}\n"
-            else:
-                command = [
-                    sys.executable, GET_GEMINI_REC_SCRIPT,
-                    '--input', gpt_analysis_output,
-                    '--prompt-file', DEFAULT_RECOMMENDATIONS_PROMPT,
-                    '--output', recommendations_output
-                ]
-                success, stderr_out = run_command(command, "Gemini Рекомендации")
-                if not success:
-                     pipeline_success = False
-                     pipeline_error_details += f"Gemini Recommendations failed. Details: {stderr_out}\n"
-        elif pipeline_success:
-            print("--- Пропуск Gemini Рекомендаций (нет файла GPT анализа) --- ")
-
-        # --- 7. Generate Report --- (Uses generate_report_v2.py script)
-        if pipeline_success and os.path.exists(gpt_analysis_output):
-            command = [
-                sys.executable, GENERATE_REPORT_SCRIPT,
-                '--input', gpt_analysis_output,
-                '--output', report_base_output, # Pass base path
-                '--image', image_path,
-                '--pdf' # Always generate PDF
-            ]
-            # Add optional files if they exist
-            if os.path.exists(gemini_coords_parsed_output):
-                command.extend(['--gemini-data', gemini_coords_parsed_output])
-            if os.path.exists(heatmap_output):
-                command.extend(['--heatmap', heatmap_output])
-
-            success, report_stderr_out = run_command(command, "Генерация Отчета (LaTeX + PDF)")
-            if not success:
-                 pipeline_success = False # Report generation failed
-                 pipeline_error_details += f"Report Generation failed. Details: {report_stderr_out}\n"
-        elif pipeline_success:
-             print("--- Пропуск Генерации Отчета (нет файла GPT анализа) --- ")
-
+        run = await asyncio.to_thread(PipelineRun.create, image_path, run_timestamp, output_dir, image)
+    except OSError as e:
+        logger.error(f"Не удалось подготовить директорию запуска: {e}")
+        result.errors.append(f"Failed to prepare run directory: {e}")
+        return result
+
+    await execute_stages(run, result, limits)
+    finish_result(result, run, started)
+    # Only complete runs are cached, so a transient failure is not replayed later
+    if cache_key and result.success and not result.errors:
+        await asyncio.to_thread(result_cache.put, cache_key, run.artifact_paths)
+    return result
+
+async def resume_pipeline_async(run_dir, limits=None):
+    """Continues an earlier run in `run_dir`, executing only missing or stale stages.
+
+    Stages whose checkpoint matches their inputs are reused, so e.g. a failed
+    report or Gemini call is retried without repeating the GPT analysis.
+
+    Returns:
+        PipelineResult, as for `run_pipeline_async`; manifest.json is rewritten.
+    """
+    started = time.perf_counter()
+    run_dir = os.path.abspath(run_dir)
+    try:
+        run, original_image_path = PipelineRun.load(run_dir)
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Не удалось открыть директорию запуска {run_dir}: {e}")
+        result = PipelineResult(image_path="", run_dir=run_dir)
+        result.errors.append(f"Not a resumable run directory ({RUN_INFO_FILENAME} missing or invalid): {run_dir}")
+        return result
+    result = PipelineResult(image_path=original_image_path, run_dir=run_dir)
+    if not os.path.exists(run.image_path):
+        result.errors.append(f"Input image copy not found: {run.image_path}")
+        return result
+    logger.info(f"--- Продолжение запуска: {run_dir} ---")
+    await execute_stages(run, result, limits)
+    return finish_result(result, run, started)
+
+async def execute_stages(run, result, limits=None):
+    """Runs PIPELINE_GRAPH for a prepared run, recording stage results."""
+    try:
+        await PIPELINE_GRAPH.run(
+            lambda stage: run_stage(result, stage.name, stage.func, run),
+            lambda stage, reason: skip_stage(result, stage.name, reason),
+            limits=limits,
+        )
     except Exception as e:
-        print(f"!!! Неожиданная ошибка в главном пайплайне: {e} !!!")
-        traceback.print_exc() # Now traceback is imported
-        pipeline_success = False
-        pipeline_error_details += f"Unexpected pipeline error: {e}\n"
-
-    # --- Final Summary ---
-    print("\n============================== ИТОГОВЫЕ РЕЗУЛЬТАТЫ ==============================\n")
-    # Check existence of final outputs
-    final_tex_exists = os.path.exists(f"{report_base_output}.tex")
-    final_pdf_exists = os.path.exists(report_pdf_output)
-    final_heatmap_exists = os.path.exists(heatmap_output)
-    final_interpretation_exists = os.path.exists(interpretation_output)
-    final_recommendations_exists = os.path.exists(recommendations_output)
-
-    if final_pdf_exists:
-        print(f"✅ PDF Отчет: {report_pdf_output}")
-    elif final_tex_exists:
-        print(f"✅ LaTeX Отчет (.tex): {report_base_output}.tex")
-        print("⚠️ PDF генерация пропущена (pdflatex не доступен). Вы можете скомпилировать .tex вручную.")
-    else:
-        print("❌ Отчет не был сгенерирован.")
-
-    if final_heatmap_exists:
-        print(f"✅ Тепловая карта: {heatmap_output}")
-    else:
-        print("❌ Тепловая карта не была сгенерирована.")
-
-    if final_interpretation_exists:
-        print(f"✅ Файл интерпретации: {interpretation_output}")
+        logger.exception(f"Неожиданная ошибка в главном пайплайне: {e}")
+        result.errors.append(f"Unexpected pipeline error: {e}")
+    finally:
+        # E.g. the coordinates stage was reused from a checkpoint or the run was cancelled
+        run.cancel_coords_prefetch()
+    # Stages finish in any order; keep the manifest in graph order
+    result.stages.sort(key=lambda stage: PIPELINE_GRAPH.order.index(stage.name))
+
+def finish_result(result, run, started):
+    """Records the artifacts that exist on disk, the timing, and saves manifest.json."""
+    result.artifacts = {kind: path for kind, path in run.artifact_paths.items() if os.path.exists(path)}
+    # The run counts as successful if at least the report Tex or PDF exists
+    result.success = bool(result.artifact(ARTIFACT_REPORT_PDF) or result.artifact(ARTIFACT_REPORT_TEX))
+    result.duration_s = round(time.perf_counter() - started, 3)
+    try:
+        result.save(os.path.join(run.output_dir, MANIFEST_FILENAME))
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить {MANIFEST_FILENAME}: {e}")
+    return result
+
+def run_pipeline(image_path, output_root=None, use_cache=CACHE_ENABLED):
+    """Synchronous wrapper around `run_pipeline_async`."""
+    return asyncio.run(run_pipeline_async(image_path, output_root=output_root, use_cache=use_cache))
+
+def resume_pipeline(run_dir):
+    """Synchronous wrapper around `resume_pipeline_async`."""
+    return asyncio.run(resume_pipeline_async(run_dir))
+
+def format_summary(result):
+    """Returns the human readable summary of a pipeline run."""
+    lines = ["", "============================== ИТОГОВЫЕ РЕЗУЛЬТАТЫ ==============================", ""]
+    if result.cached:
+        lines.append("♻️ Результат взят из кэша (повторная загрузка того же изображения)")
+    if result.artifact(ARTIFACT_REPORT_PDF):
+        lines.append(f"✅ PDF Отчет: {result.artifact(ARTIFACT_REPORT_PDF)}")
+    elif result.artifact(ARTIFACT_REPORT_TEX):
+        lines.append(f"✅ LaTeX Отчет (.tex): {result.artifact(ARTIFACT_REPORT_TEX)}")
+        lines.append("⚠️ PDF генерация пропущена (pdflatex не доступен). Вы можете скомпилировать .tex вручную.")
     else:
-        print("❌ Файл интерпретации не был сгенерирован.")
+        lines.append("❌ Отчет не был сгенерирован.")
+
+    for kind, found_text, missing_text in (
+        (ARTIFACT_HEATMAP, "✅ Тепловая карта", "❌ Тепловая карта не была сгенерирована."),
+        (ARTIFACT_INTERPRETATION, "✅ Файл интерпретации", "❌ Файл интерпретации не был сгенерирован."),
+        (ARTIFACT_RECOMMENDATIONS, "✅ Файл рекомендаций", "❌ Файл рекомендаций не был сгенерирован."),
+    ):
+        path = result.artifact(kind)
+        lines.append(f"{found_text}: {path}" if path else missing_text)
+
+    lines.append("")
+    for stage in result.stages:
+        lines.append(f"    {stage.name}: {stage.status} ({stage.duration_s:.1f} с)")
+
+    if result.errors:
+        lines.append("")
+        lines.append("--- ❗️ Ошибки во время выполнения пайплайна --- ")
+        lines.extend(result.errors)
+        lines.append("--- Конец ошибок ---")
+
+    lines.extend(["", "============================== ЗАВЕРШЕНИЕ ПАЙПЛАЙНА ==============================", ""])
+    return "\n".join(lines)
+
+def write_manifest_to_fd(result, fd):
+    """Writes the manifest JSON to an already open file descriptor (e.g. a pipe from the caller)."""
+    with os.fdopen(fd, "w", encoding="utf-8", closefd=False) as f:
+        f.write(result.to_json())
+        f.write("\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the full UI analysis pipeline.")
+    parser.add_argument("image_path", nargs="?", help="Path to the input screenshot image.")
+    parser.add_argument("--resume", metavar="RUN_DIR",
+                        help="Continue an earlier run directory, re-running only missing or stale stages.")
+    # Add optional args for prompts if needed later
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the result cache.")
+    parser.add_argument("--llm-cache", choices=CACHE_MODES, default=llm_cache.mode,
+                        help="LLM response cache mode (off, readwrite, record, replay). Default: $LLM_CACHE_MODE or off.")
+    parser.add_argument("--manifest", help="Also write the JSON result manifest to this path.")
+    parser.add_argument("--manifest-fd", type=int, help="Write the JSON result manifest to this open file descriptor.")
+    parser.add_argument("--log-level", default=PIPELINE_LOG_LEVEL,
+                        help="Log level of the pipeline output (DEBUG, INFO, WARNING, ERROR). Default: $PIPELINE_LOG_LEVEL or INFO.")
+    parser.add_argument("--log-file", help="Write the log to this file instead of stderr.")
+    args = parser.parse_args()
 
-    if final_recommendations_exists:
-        print(f"✅ Файл рекомендаций: {recommendations_output}")
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=args.log_level.upper(),
+        filename=args.log_file,
+    )
+    configure_pipeline_logging(args.log_level.upper())
+    llm_cache.mode = args.llm_cache
+
+    if args.resume:
+        result = resume_pipeline(args.resume)
+    elif args.image_path:
+        result = run_pipeline(args.image_path, use_cache=not args.no_cache)
     else:
-        print("❌ Файл рекомендаций не был сгенерирован.")
-
-    if not pipeline_success:
-        print("\n--- ❗️ Ошибки во время выполнения пайплайна --- ")
-        # Print only the accumulated error details
-        print(pipeline_error_details.strip())
-        print("--- Конец ошибок ---")
-
-    print("\n============================== ЗАВЕРШЕНИЕ ПАЙПЛАЙНА ==============================\n")
-
+        parser.error("either image_path or --resume RUN_DIR is required")
+    print(format_summary(result))
+    if args.manifest:
+        result.save(args.manifest)
+    if args.manifest_fd is not None:
+        write_manifest_to_fd(result, args.manifest_fd)
     # Exit with success if at least report Tex or PDF exists
-    if final_pdf_exists or final_tex_exists:
-        sys.exit(0)
-    else:
-        sys.exit(1)
+    sys.exit(0 if result.success else 1)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run the full UI analysis pipeline.")
-    parser.add_argument("image_path", help="Path to the input screenshot image.")
-    # Add optional args for prompts if needed later
-    args = parser.parse_args()
-
-    run_pipeline(args.image_path) 
\ No newline at end of file
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Batch entry point: runs the analysis pipeline over many screenshots at once.
+
+Inputs can be directories, glob patterns or single files. All images share
+one event loop; API-bound stages (GPT, Gemini) and CPU-bound stages
+(heatmap, report) are limited by separate semaphores, so a large batch
+keeps many requests in flight without oversubscribing the CPU.
+
+Every image gets its own run directory under the batch directory; an
+index.json with the outcome of every run and the batch throughput
+(images/minute) is written next to them.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import logging
+import argparse
+from datetime import datetime
+
+from run_analysis_pipeline import (
+    run_pipeline_async, configure_pipeline_logging, OUTPUTS_ROOT, PIPELINE_LOG_LEVEL,
+)
+from result_cache import CACHE_ENABLED
+from llm_cache import llm_cache, CACHE_MODES
+from pipeline_manifest import MANIFEST_FILENAME
+from stage_graph import RESOURCE_LLM, RESOURCE_CPU
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+INDEX_FILENAME = "index.json"
+
+DEFAULT_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+DEFAULT_CPU_CONCURRENCY = int(os.getenv("BATCH_CPU_CONCURRENCY", str(os.cpu_count() or 2)))
+# Images that have started but not finished; bounds memory and open run directories
+DEFAULT_MAX_ACTIVE_IMAGES = int(os.getenv("BATCH_MAX_ACTIVE_IMAGES", "16"))
+
+
+def collect_images(inputs):
+    """Expands directories, glob patterns and file paths into a sorted list of image files."""
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        elif os.path.isfile(item):
+            candidates = [item]
+        else:
+            candidates = glob.glob(item, recursive=True)
+            if not candidates:
+                logger.warning(f"Ничего не найдено по шаблону: {item}")
+        found.extend(
+            os.path.abspath(path) for path in candidates
+            if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    # A file can match several inputs; deduplicate and keep a stable order
+    return sorted(set(found))
+
+
+def create_batch_dir(output_root=None):
+    batch_dir = os.path.join(output_root or OUTPUTS_ROOT, f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(batch_dir, exist_ok=True)
+    return batch_dir
+
+
+async def run_batch_async(image_paths, batch_dir, llm_concurrency=DEFAULT_LLM_CONCURRENCY,
+                          cpu_concurrency=DEFAULT_CPU_CONCURRENCY,
+                          max_active_images=DEFAULT_MAX_ACTIVE_IMAGES, use_cache=CACHE_ENABLED):
+    """Analyzes all images concurrently and returns the batch index (also saved as index.json)."""
+    limits = {
+        RESOURCE_LLM: asyncio.Semaphore(max(1, llm_concurrency)),
+        RESOURCE_CPU: asyncio.Semaphore(max(1, cpu_concurrency)),
+    }
+    active = asyncio.Semaphore(max(1, max_active_images))
+    started = time.perf_counter()
+    done_count = 0
+
+    async def analyze(image_path):
+        nonlocal done_count
+        async with active:
+            try:
+                result = await run_pipeline_async(image_path, output_root=batch_dir,
+                                                  use_cache=use_cache, limits=limits)
+                entry = {
+                    "image_path": image_path,
+                    "run_dir": result.run_dir,
+                    "manifest": os.path.join(result.run_dir, MANIFEST_FILENAME) if result.run_dir else None,
+                    "success": result.success,
+                    "cached": result.cached,
+                    "duration_s": result.duration_s,
+                    "errors": result.errors,
+                }
+            except Exception as e:
+                logger.exception(f"Ошибка обработки {image_path}: {e}")
+                entry = {"image_path": image_path, "run_dir": None, "manifest": None, "success": False,
+                         "cached": False, "duration_s": 0.0, "errors": [f"Unexpected error: {e}"]}
+        done_count += 1
+        logger.info(f"[{done_count}/{len(image_paths)}] {'OK' if entry['success'] else 'FAILED'}: {image_path}")
+        return entry
+
+    runs = await asyncio.gather(*(analyze(path) for path in image_paths))
+    wall_s = time.perf_counter() - started
+
+    succeeded = sum(1 for run in runs if run["success"])
+    index = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "batch_dir": batch_dir,
+        "limits": {"llm": llm_concurrency, "cpu": cpu_concurrency, "active_images": max_active_images},
+        "images": len(runs),
+        "succeeded": succeeded,
+        "failed": len(runs) - succeeded,
+        "cached": sum(1 for run in runs if run["cached"]),
+        "wall_time_s": round(wall_s, 3),
+        "images_per_minute": round(len(runs) / wall_s * 60, 2) if wall_s > 0 else 0.0,
+        "runs": runs,
+    }
+    with open(os.path.join(batch_dir, INDEX_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the UI analysis pipeline over a batch of screenshots.")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns (quote globs).")
+    parser.add_argument("--output-root", help=f"Where to create the batch directory. Default: {OUTPUTS_ROOT}")
+    parser.add_argument("--llm-concurrency", type=int, default=DEFAULT_LLM_CONCURRENCY,
+                        help="Max API-bound stages (GPT/Gemini calls) running at once. Default: $BATCH_LLM_CONCURRENCY or 8.")
+    parser.add_argument("--cpu-concurrency", type=int, default=DEFAULT_CPU_CONCURRENCY,
+                        help="Max CPU-bound stages (heatmap/report) running at once. Default: $BATCH_CPU_CONCURRENCY or CPU count.")
+    parser.add_argument("--max-active-images", type=int, default=DEFAULT_MAX_ACTIVE_IMAGES,
+                        help="Max images in progress at once. Default: $BATCH_MAX_ACTIVE_IMAGES or 16.")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the result cache.")
+    parser.add_argument("--llm-cache", choices=CACHE_MODES, default=llm_cache.mode,
+                        help="LLM response cache mode (off, readwrite, record, replay). Default: $LLM_CACHE_MODE or off.")
+    parser.add_argument("--log-level", default=PIPELINE_LOG_LEVEL,
+                        help="Log level of the pipeline output. Default: $PIPELINE_LOG_LEVEL or INFO.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=args.log_level.upper())
+    configure_pipeline_logging(args.log_level.upper())
+    llm_cache.mode = args.llm_cache
+    logger.setLevel(logging.INFO) # Progress lines are shown even when the pipeline is quiet
+
+    image_paths = collect_images(args.inputs)
+    if not image_paths:
+        logger.error("Не найдено ни одного изображения")
+        sys.exit(1)
+
+    batch_dir = create_batch_dir(args.output_root)
+    logger.info(f"Найдено изображений: {len(image_paths)}; результаты: {batch_dir}")
+    index = asyncio.run(run_batch_async(
+        image_paths, batch_dir,
+        llm_concurrency=args.llm_concurrency,
+        cpu_concurrency=args.cpu_concurrency,
+        max_active_images=args.max_active_images,
+        use_cache=not args.no_cache,
+    ))
+
+    print(f"\nГотово: {index['succeeded']}/{index['images']} успешно, {index['failed']} с ошибками "
+          f"({index['cached']} из кэша)")
+    print(f"Время: {index['wall_time_s']:.1f} с, скорость: {index['images_per_minute']:.2f} изображений/мин")
+    print(f"Индекс: {os.path.join(batch_dir, INDEX_FILENAME)}")
+    sys.exit(0 if index["failed"] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Per-stage completion markers inside a run directory.
+
+After a stage succeeds, a marker <run_dir>/.stages/<stage>.json records a
+fingerprint of everything the stage read (input files, prompts, models) and
+the files it produced. A later run over the same directory (`--resume`)
+reuses the stage if the fingerprint still matches and its outputs still
+exist, so only missing or stale stages are executed again.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+from result_cache import file_hash
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = ".stages"
+
+
+def fingerprint(input_paths=(), params=None):
+    """Returns a sha256 over the contents of the input files and a dict of parameters."""
+    payload = {
+        "inputs": [[os.path.basename(path), file_hash(path)] for path in input_paths if path],
+        "params": params or {},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class StageCheckpoints:
+    """Reads and writes the completion markers of one run directory."""
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.checkpoint_dir = os.path.join(run_dir, CHECKPOINT_DIR)
+
+    def _marker_path(self, stage_name):
+        return os.path.join(self.checkpoint_dir, f"{stage_name}.json")
+
+    def is_fresh(self, stage_name, stage_fingerprint):
+        """True if the stage completed with the same fingerprint and its outputs still exist."""
+        try:
+            with open(self._marker_path(stage_name), "r", encoding="utf-8") as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if marker.get("fingerprint") != stage_fingerprint:
+            logger.info(f"Этап {stage_name} устарел: входные данные изменились")
+            return False
+        # Outputs are stored relative to the run directory, so it can be moved
+        if not all(os.path.exists(os.path.join(self.run_dir, path)) for path in marker.get("outputs", [])):
+            logger.info(f"Этап {stage_name} устарел: нет части результатов")
+            return False
+        return True
+
+    def mark_done(self, stage_name, stage_fingerprint, outputs):
+        """Records a successful stage together with the files it produced."""
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        marker = {
+            "stage": stage_name,
+            "completed_at": time.time(),
+            "fingerprint": stage_fingerprint,
+            "outputs": [os.path.relpath(path, self.run_dir) for path in outputs if path and os.path.exists(path)],
+        }
+        tmp_path = self._marker_path(stage_name) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(marker, f, indent=2)
+        os.replace(tmp_path, self._marker_path(stage_name))
+
+    def invalidate(self, stage_name):
+        try:
+            os.remove(self._marker_path(stage_name))
+        except FileNotFoundError:
+            pass
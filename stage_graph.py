@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Dependency graph of pipeline stages and a concurrent scheduler for it.
+
+Every stage starts as soon as the stages it depends on have finished, so
+independent stages (e.g. the Gemini interpretation and the coordinates +
+heatmap branch) overlap instead of running one after another.
+
+Two kinds of dependencies:
+    requires: the stage needs the output of these stages; if any of them
+              fails or is skipped, the stage is skipped as well.
+    after:    the stage only has to wait for these stages to finish and
+              uses their outputs if they exist (e.g. the report and the
+              optional heatmap).
+
+A stage can also name the resource it is bound by ("llm" for API calls,
+"cpu" for rendering); callers pass one semaphore per resource to cap how
+many such stages run at once, e.g. across all images of a batch.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Tuple
+
+RESOURCE_LLM = "llm"
+RESOURCE_CPU = "cpu"
+
+
+@dataclass(frozen=True)
+class Stage:
+    """One node of the graph: `func(run)` is awaited by the executor."""
+    name: str
+    func: Callable[..., Awaitable[None]]
+    requires: Tuple[str, ...] = ()
+    after: Tuple[str, ...] = ()
+    resource: Optional[str] = None
+
+    @property
+    def dependencies(self):
+        return self.requires + self.after
+
+
+class StageGraph:
+    """A validated set of stages executed concurrently in dependency order."""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._by_name = {stage.name: stage for stage in self.stages}
+        if len(self._by_name) != len(self.stages):
+            raise ValueError("Duplicate stage names in graph")
+        for stage in self.stages:
+            for dep in stage.dependencies:
+                if dep not in self._by_name:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dep}'")
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle through stage '{name}'")
+            visiting.add(name)
+            for dep in self._by_name[name].dependencies:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for stage in self.stages:
+            visit(stage.name)
+        return order
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    async def run(self, execute, skip, limits=None):
+        """Runs every stage once its dependencies have finished.
+
+        Args:
+            execute: coroutine function `execute(stage) -> bool` that runs a
+                stage and returns whether it succeeded.
+            skip: function `skip(stage, reason)` called for a stage whose
+                required dependency did not succeed.
+            limits: optional {resource: asyncio.Semaphore}; a stage with that
+                resource holds the semaphore while it executes.
+
+        Returns:
+            dict: {stage_name: True if the stage succeeded}.
+        """
+        outcomes = {name: asyncio.get_running_loop().create_future() for name in self.order}
+
+        async def run_one(stage):
+            try:
+                results = {dep: await outcomes[dep] for dep in stage.dependencies}
+                failed = [dep for dep in stage.requires if not results[dep]]
+                if failed:
+                    skip(stage, f"requires {', '.join(failed)}")
+                    ok = False
+                elif limits and stage.resource in limits:
+                    async with limits[stage.resource]:
+                        ok = await execute(stage)
+                else:
+                    ok = await execute(stage)
+            except Exception:
+                # Dependants are not left waiting forever
+                outcomes[stage.name].set_result(False)
+                raise
+            outcomes[stage.name].set_result(ok)
+
+        tasks = [asyncio.create_task(run_one(self._by_name[name]), name=f"stage-{name}") for name in self.order]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return {name: future.result() for name, future in outcomes.items() if future.done()}
@@ -7,65 +7,67 @@ designed to be called by an external orchestration script.
 """
 
 import os
-import base64
 import json
 import sys
-from pathlib import Path
-from PIL import Image
-import matplotlib.pyplot as plt
 import numpy as np
 import requests # Keep requests if it's used elsewhere, otherwise remove
 from dotenv import load_dotenv
-import openai
-import google.generativeai as genai
-import traceback
-import io
+import asyncio
+import logging
 # import google.api_core.retry as retry # Not used currently
 # from google.api_core import timeout # Not used currently
 import datetime
 import shutil # Needed for heatmap saving
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Project root
+from api_clients import get_openai_client, configure_gemini
+from llm_cache import llm_cache, LLMCache, LLMCacheMiss
+from image_context import ImageContext, upload_profile
+import heatmap_engine
+import gemini_localization
+from json_stream import JsonArrayItems
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
 # Define Model constants
 GPT_MODEL = "gpt-4.1"
 GEMINI_MODEL = "gemini-2.5-pro-preview-03-25" # Ensure correct model
+# Stream the GPT tool call and hand out each problem area as soon as it is complete
+GPT_STREAMING = os.getenv("GPT_STREAMING", "0").lower() in ("1", "true", "yes")
 
-# API Keys - Initialize clients immediately
+# API Keys - checked at import; the clients themselves are shared (api_clients.py)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 if not OPENAI_API_KEY or not GEMINI_API_KEY:
-    print("Error: API keys not found in environment variables.")
-    print("Please set OPENAI_API_KEY and GEMINI_API_KEY in your .env file.")
+    logger.error("API keys not found in environment variables.")
+    logger.error("Please set OPENAI_API_KEY and GEMINI_API_KEY in your .env file.")
     # Raise an error instead of exiting, allows calling script to handle
     raise EnvironmentError("Missing API Keys in .env file")
 
-# Initialize API clients
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-except Exception as e:
-    print(f"Error configuring Gemini API: {e}")
-    raise
-
-def encode_image(image_path):
-    """Encode an image to base64 for API submission."""
-    if not Path(image_path).exists():
-        raise FileNotFoundError(f"Image file not found: {image_path}")
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+if not configure_gemini():
+    raise EnvironmentError("Failed to configure Gemini API")
 
 # --- Refactored GPT Analysis Function ---
-def run_gpt_analysis(image_path, interface_type, user_scenario, output_json_path):
+async def run_gpt_analysis_async(image_path, interface_type, user_scenario, output_json_path, image=None,
+                                 on_problem_area=None):
     """Runs GPT-4.1 UI analysis and saves the result to a JSON file.
+
+    The screenshot is sent as prepared by the GPT upload profile
+    (image_context.upload_profile). `image` is the run's ImageContext for
+    `image_path` (one is created if omitted). With GPT_STREAMING the tool
+    call is streamed and `on_problem_area(area)` is called for every
+    problem area as soon as it is complete, while GPT is still generating
+    the rest (not for a response served from the LLM cache).
     Returns:
         tuple: (bool, dict | None): (success_status, analysis_data) or (False, None) on error.
     """
-    print(f"--- Запуск GPT-4.1 Анализа для: {image_path} ---")
-    print(f"    Тип интерфейса: {interface_type}")
-    print(f"    Сценарий: {user_scenario}")
+    logger.info(f"--- Запуск GPT-4.1 Анализа для: {image_path} ---")
+    logger.debug(f"Тип интерфейса: {interface_type}")
+    logger.debug(f"Сценарий: {user_scenario}")
 
     # --- Schema Definition (keep as is) ---
     analysis_schema = {
@@ -192,16 +194,19 @@ def run_gpt_analysis(image_path, interface_type, user_scenario, output_json_path
     # --- End Schema/Tool Definition ---
 
     try:
-        base64_image = encode_image(image_path)
+        image = image or ImageContext(image_path)
+        upload = await asyncio.to_thread(image.encoded, upload_profile(GPT_MODEL))
+        logger.debug(f"Изображение для {GPT_MODEL}: {upload.describe()}")
+        base64_image = upload.base64()
         
         # Load system prompt from file
         prompt_file_path = os.path.join(os.path.dirname(__file__), "gpt_full_prompt.txt")
         try:
             with open(prompt_file_path, "r", encoding="utf-8") as prompt_file:
                 system_prompt = prompt_file.read()
-                print(f"    Загружен GPT промпт из: {prompt_file_path}")
+                logger.debug(f"Загружен GPT промпт из: {prompt_file_path}")
         except Exception as e:
-            print(f"    !!! Ошибка загрузки GPT промпта ({prompt_file_path}): {e} !!!")
+            logger.error(f"Ошибка загрузки GPT промпта ({prompt_file_path}): {e}")
             return False, None # Return error status
 
         # Construct user message
@@ -213,32 +218,75 @@ def run_gpt_analysis(image_path, interface_type, user_scenario, output_json_path
         Perform a detailed analysis based on the system prompt and return the results using the 'record_ui_analysis' tool.
         """
 
-        # Make API call
-        response = openai_client.chat.completions.create(
+        request_options = dict(
             model=GPT_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": [
                     {"type": "text", "text": user_message_text},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}}
+                    {"type": "image_url", "image_url": {"url": f"data:{upload.mime_type};base64,{base64_image}"}}
                 ]}
             ],
             tools=tools_definition,
             tool_choice=tool_choice_definition
         )
 
+        # Make API call; returns the tool call arguments (JSON string) or None
+        async def request_analysis():
+            response = await get_openai_client().chat.completions.create(**request_options)
+            message = response.choices[0].message
+            if message.tool_calls and message.tool_calls[0].function.name == "record_ui_analysis":
+                return message.tool_calls[0].function.arguments
+            return None
+
+        # Same, streamed: problem areas are handed to on_problem_area as they close
+        async def request_analysis_streamed():
+            stream = await get_openai_client().chat.completions.create(**request_options, stream=True)
+            problem_areas = JsonArrayItems("problemAreas")
+            function_name, arguments = None, []
+            # Closes the response (and frees its pooled connection) also when the loop is abandoned
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    for tool_call in chunk.choices[0].delta.tool_calls or []:
+                        if tool_call.index != 0 or tool_call.function is None:
+                            continue
+                        function_name = tool_call.function.name or function_name
+                        if not tool_call.function.arguments:
+                            continue
+                        arguments.append(tool_call.function.arguments)
+                        for area in problem_areas.feed(tool_call.function.arguments):
+                            if on_problem_area is None:
+                                continue
+                            try:
+                                on_problem_area(area)
+                            except Exception as e:
+                                logger.warning(f"Ошибка обработки проблемной зоны из потока: {e}")
+            logger.debug(f"Потоковый ответ GPT завершен: {problem_areas.count} проблемных зон получено по ходу")
+            if function_name == "record_ui_analysis":
+                return "".join(arguments)
+            return None
+
+        cache_key = LLMCache.make_key(
+            GPT_MODEL, system_prompt + user_message_text, image_data=base64_image,
+            params={"tools": tools_definition, "tool_choice": tool_choice_definition},
+        )
+        tool_arguments = await llm_cache.fetch(
+            cache_key, request_analysis_streamed if GPT_STREAMING else request_analysis, model=GPT_MODEL,
+        )
+
         # Parse response
-        message = response.choices[0].message
         analysis_result = None
-        if message.tool_calls and message.tool_calls[0].function.name == "record_ui_analysis":
+        if tool_arguments is not None:
             try:
-                analysis_result = json.loads(message.tool_calls[0].function.arguments)
+                analysis_result = json.loads(tool_arguments)
             except json.JSONDecodeError as e:
-                print(f"    !!! Ошибка декодирования JSON из GPT ответа: {e} !!!")
-                print(f"    Raw arguments: {message.tool_calls[0].function.arguments}")
+                logger.error(f"Ошибка декодирования JSON из GPT ответа: {e}")
+                logger.debug(f"Raw arguments: {tool_arguments}")
                 return False, None # Return error status
         else:
-            print("    !!! Ошибка: GPT не вернул ожидаемый tool_call 'record_ui_analysis'. !!!")
+            logger.error("GPT не вернул ожидаемый tool_call 'record_ui_analysis'.")
             return False, None # Return error status
 
         if analysis_result is None:
@@ -253,333 +301,203 @@ def run_gpt_analysis(image_path, interface_type, user_scenario, output_json_path
         try:
             with open(output_json_path, 'w', encoding='utf-8') as f:
                 json.dump(analysis_result, f, indent=2, ensure_ascii=False)
-            print(f"    Результат GPT анализа сохранен в: {output_json_path}")
+            logger.debug(f"Результат GPT анализа сохранен в: {output_json_path}")
             return True, analysis_result # Return success and the data
         except Exception as e:
-            print(f"    !!! Ошибка сохранения GPT результата в {output_json_path}: {e} !!!")
+            logger.error(f"Ошибка сохранения GPT результата в {output_json_path}: {e}")
             return False, None # Return error status
 
     except FileNotFoundError as e:
-        print(f"    !!! Ошибка: Файл не найден (вероятно, изображение): {e} !!!")
+        logger.error(f"Файл не найден (вероятно, изображение): {e}")
         return False, None
+    except LLMCacheMiss:
+        raise
     except Exception as e:
-        print(f"    !!! Неожиданная ошибка в GPT анализе: {e} !!!")
-        traceback.print_exc()
+        logger.error(f"Неожиданная ошибка в GPT анализе: {e}", exc_info=True)
         return False, None
 
+def run_gpt_analysis(image_path, interface_type, user_scenario, output_json_path):
+    """Synchronous wrapper around `run_gpt_analysis_async` (runs its own event loop)."""
+    return asyncio.run(run_gpt_analysis_async(image_path, interface_type, user_scenario, output_json_path))
+
 # --- Refactored Gemini Coordinates Function ---
-def run_gemini_coordinates(image_path, gpt_result_data, output_raw_json_path, output_parsed_json_path, formatted_prompt=None):
-    """Runs Gemini coordinate extraction and saves raw/parsed results."""
-    print(f"--- Запуск Gemini Координат для: {image_path} ---")
+def coordinates_for_heatmap(coordinates_data):
+    """Converts a parsed Gemini coordinates response into the structure generate_heatmap expects."""
+    # Prepare data structure for heatmap function
+    valid_elements = [
+        {
+            "id": elem["id"],
+            "type": "problem_area", # Consistent type
+            "name": elem["element"],
+            "coordinates": elem["coordinates"] # Keep normalized coords
+        } for elem in coordinates_data["element_coordinates"]
+          if elem.get("coordinates") is not None # Filter nulls here
+    ]
+    return { "element_coordinates": valid_elements }
+
+async def run_gemini_detection_async(image_path, output_json_path, image=None, semaphore=None):
+    """Runs Gemini detection of all salient UI elements (speculative, alongside GPT) and saves them.
+
+    The problem areas are matched to these elements later
+    (gemini_localization.match_detections), so most of them need no
+    coordinate request after the GPT analysis. `semaphore` limits the
+    Gemini requests of the run (gemini_localization.request_semaphore).
+    Returns:
+        dict | None: {"element_coordinates": [...]} in normalized page coordinates, or None on error.
+    """
+    logger.info(f"--- Запуск Gemini Обнаружения элементов для: {image_path} ---")
+    try:
+        image = image or ImageContext(image_path)
+        detection = await gemini_localization.detect_elements(image, GEMINI_MODEL, upload_profile(GEMINI_MODEL),
+                                                              semaphore)
+        if detection.coordinates_data is None:
+            logger.error("Не получены элементы интерфейса от Gemini API.")
+            return None
+        os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
+        with open(output_json_path, "w", encoding="utf-8") as f:
+            json.dump(detection.coordinates_data, f, indent=2, ensure_ascii=False)
+        logger.debug(f"Обнаруженные элементы сохранены в: {output_json_path}")
+        logger.info(f"--- Успешно: Gemini Обнаружение ({len(detection.coordinates_data['element_coordinates'])} элементов) ---")
+        return detection.coordinates_data
+    except LLMCacheMiss:
+        raise
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка в run_gemini_detection: {e}", exc_info=True)
+        return None
+
+async def run_gemini_coordinates_async(image_path, gpt_result_data, output_raw_json_path, output_parsed_json_path, image=None, detections=None, prefetch=None, semaphore=None):
+    """Runs Gemini coordinate extraction and saves raw/parsed results.
+
+    The requests are made by gemini_localization.localize: one per tile
+    (tall pages) and chunk of problem areas, concurrently, each sent as
+    prepared by the Gemini upload profile (image_context.upload_profile).
+    Missing, degenerate and low-confidence boxes are requested again on
+    crops (marked "refined"). The parsed result holds normalized
+    coordinates of the whole page and records what was sent ("upload", or
+    "requests", and "refine_requests"). The prompt is
+    gemini_localization.COORDS_PROMPT_TEMPLATE for every request. Areas matched to
+    `detections` (elements from run_gemini_detection_async) are not
+    requested, nor are those already requested by `prefetch`
+    (gemini_localization.CoordinatePrefetch, fed by a streamed GPT
+    analysis), which shares `semaphore` with these requests. `image` is
+    the run's ImageContext for `image_path` (one is created if omitted).
+    """
+    logger.info(f"--- Запуск Gemini Координат для: {image_path} ---")
 
     if not gpt_result_data or "problemAreas" not in gpt_result_data or not gpt_result_data["problemAreas"]:
-        print("    !!! Ошибка: Отсутствуют 'problemAreas' в данных GPT анализа. Невозможно запросить координаты. !!!")
+        logger.error("Отсутствуют 'problemAreas' в данных GPT анализа. Невозможно запросить координаты.")
         return None
 
     try:
-        # Load image
-        image = Image.open(image_path)
-        original_width, original_height = image.size
-        print(f"    Размер изображения: {original_width}x{original_height}")
-
-        # Convert image to bytes
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        image_bytes = buffer.getvalue()
-
-        # Format problematic elements for prompt
-        elements_text = ""
-        MAX_AREAS_FOR_GEMINI = 30
+        image = image or ImageContext(image_path)
         problem_areas = gpt_result_data["problemAreas"]
-        try:
-            sorted_areas = sorted(problem_areas, key=lambda x: x.get('severity', 0), reverse=True)
-            top_areas = sorted_areas[:MAX_AREAS_FOR_GEMINI]
-            print(f"    Обработка топ-{len(top_areas)} проблемных зон для Gemini (из {len(problem_areas)}).")
-        except Exception as e:
-            print(f"    !!! Ошибка сортировки проблемных зон: {e}. Используются все найденные. !!!")
-            top_areas = problem_areas
-
-        for i, area in enumerate(top_areas):
-            desc = area.get('description', 'N/A')
-            loc = area.get('location', 'N/A')
-            sev = area.get('severity', 'N/A')
-            area_id = area.get('id', f'unknown_{i}')
-            elements_text += f"- ID: {area_id}, Severity: {sev}, Description: {desc}, Location Hint: {loc}\n"
-
-        # --- Используем переданный промпт или стандартный ---
-        if formatted_prompt:
-            prompt_simplified = formatted_prompt
-            print("    Используется форматированный промпт из основного скрипта.")
-        else:
-            # --- Simplified Prompt (keep as is) ---
-            prompt_simplified = f"""
-            You are a specialized visual analysis system designed to extract precise coordinates for identified UI usability issues in images. Your task is to locate specific problematic elements and provide their bounding box coordinates using a normalized coordinate system.
-
-
-            These are the problematic elements you need to locate:
-
-            <problematic_elements>
-            {elements_text}
-            </problematic_elements>
-
-            Instructions:
-
-            1. Coordinate System:
-               - Use a normalized coordinate system between 0-1000 for both X and Y axes.
-               - The origin (0,0) is at the TOP LEFT of the image.
-               - For each element, return coordinates as [y_min, x_min, y_max, x_max].
-               - y_min = top edge, y_max = bottom edge, x_min = left edge, x_max = right edge.
-
-            2. Element Location Process:
-               - Carefully examine the provided image.
-               - For each element ID listed in the problematic_elements, find the described element.
-               - Create the MOST PRECISE, TIGHTEST possible bounding box around ONLY the specific visual element mentioned in the description. Use the 'Location Hint' to help pinpoint it.
-               - **CRITICAL: AVOID creating bounding boxes that span nearly the entire width of the image content area unless the described element itself is explicitly that wide (e.g., a full-width header background). Focus on the specific, local element.**
-               - **Example: If a problem description is 'misaligned button within a panel', the bounding box MUST encompass ONLY the button, NOT the entire panel or the row it sits in.**
-               - If multiple instances exist, choose the one most relevant to the description.
-               - If an element cannot be located, set its coordinates to null.
-
-            3. Coordinate Validation:
-               - Ensure that x_min < x_max and y_min < y_max for all bounding boxes.
-               - If this condition is not met, do not include the coordinates in the final output JSON's element_coordinates list for that element.
-
-            4. Confidence Assessment:
-               - Assign a confidence score (0.0-1.0) to each element based on how certain you are of its location and bounding box accuracy.
-
-            Output Format:
-            Provide your response ONLY as valid JSON with the following structure (no other text before or after the JSON block):
-
-            {{
-              "element_coordinates": [
-                {{
-                  "id": "problem_area_id from input",
-                  "element": "brief description of the identified element",
-                  "coordinates": [y_min, x_min, y_max, x_max], // Normalized 0-1000 or null
-                  "confidence": 0.0-1.0
-                }}
-                // ... (repeat for each element where valid coordinates were found)
-              ]
-            }}
-
-            Remember:
-            - Strictly adhere to the JSON format as the ONLY output.
-            - Only include valid coordinates (y_min < y_max, x_min < x_max) or null in the 'coordinates' field.
-            - Ensure that all coordinate values are between 0 and 1000.
-
-            Begin your coordinate extraction now.
-            """
-            print("    Используется стандартный встроенный промпт.")
-        # --- End Prompt ---
-
-        # Make API Call
-        try:
-            print("    Отправка запроса в Gemini API (Координаты)...")
-            model = genai.GenerativeModel(GEMINI_MODEL) # Use configured client
-            response = model.generate_content(
-                contents=[
-                    prompt_simplified,
-                    {"mime_type": "image/png", "data": image_bytes},
-                ],
-                generation_config={
-                    "temperature": 0.1,
-                    "max_output_tokens": 8192,
-                }
-            )
-            print("    Ответ от Gemini API получен.")
-            # (Handle feedback/safety ratings as before if needed)
-
-        except Exception as e:
-            print(f"    !!! Ошибка при вызове Gemini API: {e} !!!")
-            traceback.print_exc()
-            return None
+        top_areas = gemini_localization.top_problem_areas(problem_areas)
+        logger.debug(f"Обработка топ-{len(top_areas)} проблемных зон для Gemini (из {len(problem_areas)}).")
+
+        localization = await gemini_localization.localize(
+            image, top_areas, GEMINI_MODEL, upload_profile(GEMINI_MODEL),
+            detections=(detections or {}).get("element_coordinates"),
+            prefetch=prefetch,
+            semaphore=semaphore,
+        )
 
-        # Process response
-        if hasattr(response, 'text'):
-            response_text = response.text
-        elif hasattr(response, 'candidates') and len(response.candidates) > 0 and response.candidates[0].content.parts:
-             response_text = response.candidates[0].content.parts[0].text
-        else:
-            print("    !!! Ошибка: Не получен текст ответа от Gemini API. !!!")
-            # print(f"Response: {response}")
+        # Save raw response(s)
+        raw = localization.raw()
+        if raw is not None:
+            try:
+                os.makedirs(os.path.dirname(output_raw_json_path), exist_ok=True)
+                with open(output_raw_json_path, "w", encoding="utf-8") as f:
+                     f.write(raw)
+                logger.debug(f"Raw Gemini ответ сохранен в: {output_raw_json_path}")
+            except Exception as e:
+                logger.error(f"Ошибка сохранения raw Gemini JSON в {output_raw_json_path}: {e}")
+
+        coordinates_data = localization.coordinates_data
+        if coordinates_data is None:
+            logger.error("Не получены координаты от Gemini API.")
             return None
 
-        # Save raw response
         try:
-            os.makedirs(os.path.dirname(output_raw_json_path), exist_ok=True)
-            with open(output_raw_json_path, "w", encoding="utf-8") as f:
-                 f.write(response_text)
-            print(f"    Raw Gemini ответ сохранен в: {output_raw_json_path}")
-        except Exception as e:
-            print(f"    !!! Ошибка сохранения raw Gemini JSON в {output_raw_json_path}: {e} !!!")
-
-        # Parse JSON response
-        try:
-            # Clean potential markdown fences
-            if "```json" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text and response_text.strip().startswith("```"):
-                 json_str = response_text.split("```")[1].split("```")[0].strip()
-            else:
-                 json_str = response_text.strip() # Assume it's just JSON
-
-            coordinates_data = json.loads(json_str)
-            assert "element_coordinates" in coordinates_data, "Отсутствует ключ 'element_coordinates' в ответе Gemini"
-
             # Save parsed response
             os.makedirs(os.path.dirname(output_parsed_json_path), exist_ok=True)
             with open(output_parsed_json_path, "w", encoding="utf-8") as f:
                 json.dump(coordinates_data, f, indent=2, ensure_ascii=False)
-            print(f"    Распарсенный Gemini ответ сохранен в: {output_parsed_json_path}")
-
-            # Prepare data structure for heatmap function
-            valid_elements = [
-                {
-                    "id": elem["id"],
-                    "type": "problem_area", # Consistent type
-                    "name": elem["element"],
-                    "coordinates": elem["coordinates"] # Keep normalized coords
-                } for elem in coordinates_data["element_coordinates"]
-                  if elem.get("coordinates") is not None # Filter nulls here
-            ]
-            element_coordinates_for_heatmap = { "element_coordinates": valid_elements }
-
-            print(f"    Успешно обработан ответ Gemini. Найдено {len(valid_elements)} валидных координат.")
-            print(f"--- Успешно: Gemini Координаты ---")
-            return element_coordinates_for_heatmap
-
-        except json.JSONDecodeError:
-            print("    !!! Ошибка парсинга JSON ответа от Gemini. !!!")
-            print("    Raw response text:")
-            print(response_text[:1000] + "...") # Print first 1000 chars
-            return None
-        except AssertionError as e:
-             print(f"    !!! Ошибка валидации JSON ответа Gemini: {e} !!!")
-             return None
+            logger.debug(f"Распарсенный Gemini ответ сохранен в: {output_parsed_json_path}")
         except Exception as e:
-             print(f"    !!! Ошибка сохранения распарсенного Gemini JSON в {output_parsed_json_path}: {e} !!!")
-             # Decide if this is fatal, maybe return the data anyway?
+             logger.error(f"Ошибка сохранения распарсенного Gemini JSON в {output_parsed_json_path}: {e}")
              return None # Treat as fatal for now
 
+        element_coordinates_for_heatmap = coordinates_for_heatmap(coordinates_data)
+        logger.debug(f"Успешно обработан ответ Gemini. Найдено {len(element_coordinates_for_heatmap['element_coordinates'])} валидных координат.")
+        logger.info("--- Успешно: Gemini Координаты ---")
+        return element_coordinates_for_heatmap
+
     except FileNotFoundError as e:
-        print(f"    !!! Ошибка: Файл изображения не найден: {e} !!!")
+        logger.error(f"Файл изображения не найден: {e}")
         return None
+    except LLMCacheMiss:
+        raise
     except Exception as e:
-        print(f"    !!! Неожиданная ошибка в run_gemini_coordinates: {e} !!!")
-        traceback.print_exc()
+        logger.error(f"Неожиданная ошибка в run_gemini_coordinates: {e}", exc_info=True)
         return None
 
+def run_gemini_coordinates(image_path, gpt_result_data, output_raw_json_path, output_parsed_json_path):
+    """Synchronous wrapper around `run_gemini_coordinates_async` (runs its own event loop)."""
+    return asyncio.run(run_gemini_coordinates_async(
+        image_path, gpt_result_data, output_raw_json_path, output_parsed_json_path))
+
 # --- Refactored Heatmap Generation Function ---
-def generate_heatmap(image_path, coordinates_data, gpt_result_data, output_heatmap_path):
-    """Generates a heatmap visualization and saves it."""
-    print(f"--- Запуск Генерации Тепловой Карты для: {image_path} ---")
-    print(f"    Сохранение в: {output_heatmap_path}")
+def generate_heatmap(image_path, coordinates_data, gpt_result_data, output_heatmap_path, image=None):
+    """Generates a heatmap visualization and saves it.
+
+    Next to `output_heatmap_path` it also writes the report-width version,
+    the Telegram preview, the per-category report figures and the intensity
+    sidecar (see heatmap_engine.default_targets). `image` is the run's
+    ImageContext for `image_path` (one is created if omitted).
+    """
+    logger.info(f"--- Запуск Генерации Тепловой Карты для: {image_path} ---")
+    logger.debug(f"Сохранение в: {output_heatmap_path}")
 
     # Check prerequisites
     if not coordinates_data or "element_coordinates" not in coordinates_data or not coordinates_data["element_coordinates"]:
-        print("    Предупреждение: Нет данных координат для генерации тепловой карты.")
+        logger.warning("Нет данных координат для генерации тепловой карты.")
         return False # Cannot generate heatmap without coordinates
 
     if not gpt_result_data or "problemAreas" not in gpt_result_data:
-        print("    Предупреждение: Нет данных GPT анализа ('problemAreas') для определения severity. Будет использовано значение по умолчанию (50).")
-        problem_areas_map = {} # Empty map, will use default severity
-    else:
-        problem_areas_map = {str(area["id"]): area.get("severity", 50)
-                             for area in gpt_result_data["problemAreas"]}
+        logger.warning("Нет данных GPT анализа ('problemAreas') для определения severity. Будет использовано значение по умолчанию (50).")
 
     try:
-        # Load image
-        original_img = Image.open(image_path)
-        img_array = np.array(original_img)
-        height, width = img_array.shape[:2]
-        print(f"    Изображение загружено: {width}x{height}")
-
-        # Create heatmap array
-        heatmap = np.zeros((height, width), dtype=np.float64) # Use float64 for accumulation
+        # Decoded once per run and shared with the other stages; only band-sized copies are made from it
+        original_img = (image or ImageContext(image_path)).image()
+        width, height = original_img.size
+        logger.debug(f"Изображение загружено: {width}x{height}")
 
         element_count = len(coordinates_data["element_coordinates"])
-        print(f"    Обработка {element_count} элементов для тепловой карты...")
+        logger.debug(f"Обработка {element_count} элементов для тепловой карты...")
 
-        processed_count = 0
-        # Add gaussian for each coordinate set
-        for element in coordinates_data["element_coordinates"]:
-            coords_norm = element.get("coordinates")
-            if coords_norm is None: continue # Should already be filtered, but check
+        # Gaussians weighted by severity squared, each evaluated only inside its ±4σ window
+        sources = heatmap_engine.heat_sources(coordinates_data, gpt_result_data, width, height)
+        logger.debug(f"Добавлено {len(sources)} гауссиан в тепловую карту.")
 
-            element_id_str = str(element.get("id")) if element.get("id") is not None else None
-            severity = problem_areas_map.get(element_id_str, 50) if element_id_str else 50
-
-            try:
-                # Denormalize coordinates (0-1000 -> pixels)
-                y_min_norm, x_min_norm, y_max_norm, x_max_norm = coords_norm
-                x1 = int(x_min_norm / 1000 * width)
-                y1 = int(y_min_norm / 1000 * height)
-                x2 = int(x_max_norm / 1000 * width)
-                y2 = int(y_max_norm / 1000 * height)
-
-                # Clamp to bounds and validate
-                x1 = max(0, min(x1, width - 1))
-                y1 = max(0, min(y1, height - 1))
-                x2 = max(0, min(x2, width - 1))
-                y2 = max(0, min(y2, height - 1))
-                if x1 >= x2 or y1 >= y2: continue # Skip invalid box
-
-                # Calculate center and sigma
-                center_x = (x1 + x2) // 2
-                center_y = (y1 + y2) // 2
-                size = max(x2 - x1, y2 - y1, 1) # Avoid size 0
-                sigma = max(size / 10, 3) # Minimum sigma 3px
-                sigma_sq = sigma ** 2
-
-                # Add gaussian influence weighted by severity squared
-                y, x = np.ogrid[:height, :width]
-                # Optimized calculation? Maybe not necessary unless very slow.
-                gaussian = np.exp(-(((x - center_x)**2 + (y - center_y)**2) / (2 * sigma_sq)))
-                heatmap += gaussian * (float(severity) ** 2) # Ensure severity is float
-                processed_count += 1
-
-            except (ValueError, TypeError) as e:
-                print(f"    Предупреждение: Ошибка обработки координат для элемента {element_id_str}: {coords_norm}. Ошибка: {e}. Пропуск.")
-                continue
-
-        print(f"    Добавлено {processed_count} гауссиан в тепловую карту.")
-
-        # Normalize heatmap only if it has values
-        if heatmap.max() > 1e-9: # Use a small threshold instead of == 0
-            # Clip extreme peaks for better visualization (e.g., 98th percentile)
-            upper_bound = np.percentile(heatmap[heatmap > 1e-9], 98)
-            clipped_heatmap = np.clip(heatmap, 0, upper_bound)
-            # Normalize clipped heatmap
-            heatmap_norm = (clipped_heatmap - clipped_heatmap.min()) / (clipped_heatmap.max() - clipped_heatmap.min() + 1e-9) # Add epsilon
-        else:
-            print("    Тепловая карта пуста, нормализация пропущена.")
-            heatmap_norm = heatmap # Keep it as zeros
-
-        # Create visualization
-        plt.figure(figsize=(width / 100, height / 100), dpi=150) # Use slightly higher DPI
-        plt.imshow(original_img)
-        plt.imshow(heatmap_norm, alpha=0.7, cmap='viridis')
-        plt.colorbar(label='Относительная критичность проблемы (Intensity)')
-        plt.title('Тепловая карта проблемных зон UI')
-        plt.axis('off')
-
-        # Save directly to output path
+        # Accumulate, clip at the global 98th percentile, blend and encode in horizontal bands:
+        # full size, report width and Telegram preview in one pass, plus the .npy intensity
+        # sidecar for the report's hotspot crops
         os.makedirs(os.path.dirname(output_heatmap_path), exist_ok=True)
-        plt.savefig(output_heatmap_path, bbox_inches='tight', dpi=150) # Save final version
-        plt.close() # Close plot to free memory
+        heatmap_engine.render_heatmap(original_img, sources, heatmap_engine.default_targets(output_heatmap_path),
+                                      intensity_output=heatmap_engine.intensity_path(output_heatmap_path))
 
-        print(f"    Тепловая карта успешно сгенерирована и сохранена в: {output_heatmap_path}")
-        print(f"--- Успешно: Генерация Тепловой Карты ---")
+        logger.debug(f"Тепловая карта успешно сгенерирована и сохранена в: {output_heatmap_path}")
+        logger.info("--- Успешно: Генерация Тепловой Карты ---")
         return True
 
     except FileNotFoundError as e:
-        print(f"    !!! Ошибка: Файл изображения не найден: {e} !!!")
+        logger.error(f"Файл изображения не найден: {e}")
         return False
     except ImportError:
-        print("    !!! Ошибка: Библиотеки Matplotlib/Numpy/Pillow не найдены. Пожалуйста, установите их. !!!")
+        logger.error("Библиотеки Numpy/Pillow не найдены. Пожалуйста, установите их.")
         return False
     except Exception as e:
-        print(f"    !!! Неожиданная ошибка в generate_heatmap: {e} !!!")
-        traceback.print_exc()
+        logger.error(f"Неожиданная ошибка в generate_heatmap: {e}", exc_info=True)
         return False
 
 # --- Removed run_full_test() and __main__ block ---